@@ -0,0 +1,92 @@
+"""
+Вимірювання холодного старту: кожен етап запускається в новому процесі,
+як після пробудження сервісу на безкоштовному хостингу.
+
+Запуск:
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --runs 5 --db   # + підключення до БД і схема
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Кожен сценарій друкує JSON з часом етапів (мс)
+SCENARIOS = {
+    'imports': '''
+import json, time
+started = time.perf_counter()
+import bot
+print(json.dumps({"imports": (time.perf_counter() - started) * 1000}))
+''',
+    'tokenizer': '''
+import json, time
+from tokenizer import token_counter
+started = time.perf_counter()
+token_counter.load()
+print(json.dumps({"tokenizer": (time.perf_counter() - started) * 1000}))
+''',
+    'openai': '''
+import json, time
+started = time.perf_counter()
+import bot
+bot.get_openai_client()
+print(json.dumps({"openai_client": (time.perf_counter() - started) * 1000}))
+''',
+    'db': '''
+import asyncio, json, time
+import config
+from database import db
+
+async def main():
+    result = {}
+    for mode, fast in (("fast", True), ("full_ddl", False)):
+        config.FAST_STARTUP = fast
+        db.startup_timings = {}
+        await db.connect()
+        result[f"pool_connect_{mode}"] = db.startup_timings["pool_connect"] * 1000
+        result[f"schema_{mode}"] = db.startup_timings["schema"] * 1000
+        await db.close()
+    print(json.dumps(result))
+
+asyncio.run(main())
+''',
+}
+
+
+def run_scenario(code: str) -> tuple:
+    """Запустити сценарій у новому процесі. Повертає (час процесу мс, етапи)"""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True, text=True, env=os.environ.copy()
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return wall_ms, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--db', action='store_true', help='Також виміряти підключення до БД та DDL')
+    args = parser.parse_args()
+
+    scenarios = ['imports', 'tokenizer', 'openai'] + (['db'] if args.db else [])
+    for name in scenarios:
+        samples = {}
+        for _ in range(args.runs):
+            wall_ms, phases = run_scenario(SCENARIOS[name])
+            samples.setdefault(f'{name}_process_wall', []).append(wall_ms)
+            for phase, value in phases.items():
+                samples.setdefault(phase, []).append(value)
+        for phase, values in samples.items():
+            print(f"{phase:>24}: median {statistics.median(values):8.1f} ms | max {max(values):8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Бенчмарк збереження повідомлень: старий покроковий save_message проти
+атомарного запиту SAVE_MESSAGE_QUERY.
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.ingest --messages 500 --concurrency 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import config
+from database import db
+
+# Синтетичні користувачі з від'ємними id, щоб не зачепити реальні дані
+BENCH_USER_BASE = -1_000_000
+
+SAMPLE_TEXTS = [
+    "Dzisiaj był naprawdę dobry dzień, poszedłem na długi spacer po parku i czuję się świetnie.",
+    "Trochę smutno mi dzisiaj, bo tęsknię za rodziną, która mieszka daleko ode mnie.",
+    "Myślę o tym, żeby zacząć uczyć się gotowania, bo zawsze mnie to ciekawiło.",
+    "ok",
+]
+
+
+class CountingConnection:
+    """Обгортка з'єднання, що рахує звернення до сервера (round trips)"""
+
+    def __init__(self, conn, counter: dict):
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name in ('execute', 'fetch', 'fetchrow', 'fetchval', 'executemany'):
+            async def counted(*args, **kwargs):
+                self._counter['round_trips'] += 1
+                return await attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+class CountingPool:
+    """Обгортка пулу, що видає CountingConnection"""
+
+    def __init__(self, pool, counter: dict):
+        self._pool = pool
+        self._counter = counter
+
+    def acquire(self):
+        pool = self._pool
+        counter = self._counter
+
+        class _Acquire:
+            async def __aenter__(self):
+                self._ctx = pool.acquire()
+                conn = await self._ctx.__aenter__()
+                counter['acquires'] += 1
+                return CountingConnection(conn, counter)
+
+            async def __aexit__(self, *exc):
+                return await self._ctx.__aexit__(*exc)
+
+        return _Acquire()
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+async def legacy_save_message(user_id: int, role: str, content: str):
+    """Копія попередньої реалізації save_message (5 запитів + stop_collection)"""
+    async with db.pool.acquire() as conn:
+        stats = await conn.fetchrow(
+            'SELECT total_tokens, collection_active FROM user_stats WHERE user_id = $1', user_id
+        )
+        if not stats:
+            await conn.execute('INSERT INTO user_stats (user_id) VALUES ($1)', user_id)
+            stats = {'total_tokens': 0, 'collection_active': True}
+        if role == 'user':
+            await conn.execute(
+                'UPDATE user_stats SET last_activity_at = CURRENT_TIMESTAMP WHERE user_id = $1',
+                user_id
+            )
+        if not stats['collection_active']:
+            return False
+        tokens_count = await db.count_tokens(content)
+        is_filtered = db.should_filter_message(content, tokens_count)
+        sentiment = db.analyze_sentiment(content) if role == 'user' else None
+        await conn.execute('''
+            INSERT INTO messages
+            (user_id, role, content, tokens_count, sentiment, is_filtered)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        ''', user_id, role, content, tokens_count, sentiment, is_filtered)
+        if not is_filtered:
+            new_total = stats['total_tokens'] + tokens_count
+            await conn.execute('''
+                UPDATE user_stats SET total_tokens = $1, message_count = message_count + 1
+                WHERE user_id = $2
+            ''', new_total, user_id)
+            if new_total >= config.MIN_TOKEN_LIMIT:
+                await db.stop_collection(user_id)
+                return 'limit_reached'
+        return True
+
+
+async def cleanup(users: int):
+    async with db.pool.acquire() as conn:
+        ids = list(range(BENCH_USER_BASE - users, BENCH_USER_BASE + 1))
+        await conn.execute('DELETE FROM messages WHERE user_id = ANY($1::bigint[])', ids)
+        await conn.execute('DELETE FROM user_stats WHERE user_id = ANY($1::bigint[])', ids)
+
+
+async def run(name: str, save, messages: int, users: int, concurrency: int):
+    await cleanup(users)
+    counter = {'round_trips': 0, 'acquires': 0}
+    real_pool = db.pool
+    db.pool = CountingPool(real_pool, counter)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        user_id = BENCH_USER_BASE - (i % users)
+        role = 'user' if i % 2 == 0 else 'assistant'
+        text = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+        async with semaphore:
+            started = time.perf_counter()
+            await save(user_id, role, text)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(i) for i in range(messages)))
+    finally:
+        db.pool = real_pool
+    elapsed = time.perf_counter() - started
+
+    # Перевіряємо втрачені оновлення лічильника total_tokens
+    async with db.pool.acquire() as conn:
+        stored = await conn.fetchval('''
+            SELECT COALESCE(SUM(tokens_count), 0) FROM messages
+            WHERE user_id <= $1 AND user_id >= $2 AND is_filtered = FALSE
+        ''', BENCH_USER_BASE, BENCH_USER_BASE - users)
+        counted = await conn.fetchval('''
+            SELECT COALESCE(SUM(total_tokens), 0) FROM user_stats
+            WHERE user_id <= $1 AND user_id >= $2
+        ''', BENCH_USER_BASE, BENCH_USER_BASE - users)
+
+    latencies.sort()
+    print(
+        f"{name:>8}: {messages / elapsed:8.1f} msg/s | "
+        f"round trips/msg {counter['round_trips'] / messages:.2f} | "
+        f"acquires/msg {counter['acquires'] / messages:.2f} | "
+        f"p50 {statistics.median(latencies):.2f} ms | "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f} ms | "
+        f"lost tokens {stored - counted}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    await db.connect()
+    try:
+        await run('legacy', legacy_save_message, args.messages, args.users, args.concurrency)
+        await run('atomic', db.save_message, args.messages, args.users, args.concurrency)
+    finally:
+        await cleanup(args.users)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
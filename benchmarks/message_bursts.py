@@ -0,0 +1,161 @@
+"""
+Перевірка серій повідомлень через UserActors з асерціями: повідомлення
+кожного користувача обробляються по черзі, без втрат і в порядку надходження;
+одиночне повідомлення не чекає; серія, що набралась під час відповіді,
+зливається в один пакет; пакет не чекає довше max_wait від першого
+повідомлення (якщо модель ще не відповідає на попередній). Також рахує,
+скільки запитів до моделі заощаджено.
+
+Модель замінено заглушкою з фіксованою затримкою, БД не потрібна.
+Будь-яке порушення завершує скрипт з AssertionError.
+
+Запуск:
+    python -m benchmarks.message_bursts --users 50 --debounce-ms 200 --model-ms 300
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+# bot.py створює Bot при імпорті, для симуляції достатньо токена у правильному форматі
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+
+from bot import UserActors
+
+# Допуск планувальника event loop (с)
+TOLERANCE = 0.05
+
+
+class FakeModel:
+    """Заглушка обробки: запам'ятовує пакети з часом початку і кінця, ловить паралельну обробку"""
+
+    def __init__(self, delay_ms: float):
+        self.delay = delay_ms / 1000
+        self.batches = {}  # user_id -> [(початок, кінець, [повідомлення]), ...]
+        self.busy = set()
+        self.overlaps = 0
+
+    async def process(self, user_id: int, messages: list):
+        if user_id in self.busy:
+            self.overlaps += 1
+        self.busy.add(user_id)
+        started = asyncio.get_running_loop().time()
+        try:
+            await asyncio.sleep(self.delay)
+            self.batches.setdefault(user_id, []).append(
+                (started, asyncio.get_running_loop().time(), list(messages))
+            )
+        finally:
+            self.busy.discard(user_id)
+
+
+async def send(actors: UserActors, user_id: int, gaps_ms: list, arrivals: dict) -> list:
+    """Надіслати серію повідомлень з паузами між ними"""
+    sent = []
+    for i, gap in enumerate(gaps_ms):
+        await asyncio.sleep(gap / 1000)
+        message = f'{user_id}:{i}'
+        arrivals[message] = asyncio.get_running_loop().time()
+        actors.submit(user_id, message)
+        sent.append(message)
+    return sent
+
+
+async def wait_idle(actors: UserActors):
+    while actors.active_users:
+        await asyncio.sleep(0.01)
+
+
+def check_user(model: FakeModel, user_id: int, sent: list, arrivals: dict, args):
+    """Порядок, відсутність втрат і обмеження очікування для одного користувача"""
+    batches = model.batches.get(user_id, [])
+    received = [message for _, _, batch in batches for message in batch]
+    assert received == sent, f"користувач {user_id}: порядок або втрати {received} != {sent}"
+
+    max_wait = args.max_wait_ms / 1000
+    previous_end = 0.0
+    for number, (started, finished, batch) in enumerate(batches):
+        first_arrival = arrivals[batch[0]]
+        if number == 0 or first_arrival >= previous_end:
+            # Модель вільна - перший пакет обробляється одразу
+            limit = first_arrival + (TOLERANCE if number == 0 else max_wait + TOLERANCE)
+        else:
+            # Повідомлення чекали, поки модель відповідала на попередній пакет
+            limit = max(first_arrival + max_wait, previous_end) + TOLERANCE
+        assert started <= limit, (
+            f"користувач {user_id}, пакет {number}: чекав {started - first_arrival:.3f} с, "
+            f"межа {limit - first_arrival:.3f} с"
+        )
+        previous_end = finished
+
+
+async def scenario(name: str, gaps_ms: list, expected_sizes, args):
+    """Один користувач, задані паузи між повідомленнями; expected_sizes - розміри пакетів або їх кількість"""
+    model = FakeModel(args.model_ms)
+    actors = UserActors(model.process, args.debounce_ms, args.max_wait_ms)
+    arrivals = {}
+    sent = await send(actors, 1, gaps_ms, arrivals)
+    await wait_idle(actors)
+
+    check_user(model, 1, sent, arrivals, args)
+    sizes = [len(batch) for _, _, batch in model.batches[1]]
+    if isinstance(expected_sizes, int):
+        assert len(sizes) == expected_sizes, f"{name}: пакети {sizes}, очікувалось {expected_sizes} пакети"
+    else:
+        assert sizes == expected_sizes, f"{name}: пакети {sizes}, очікувалось {expected_sizes}"
+    assert not model.overlaps, f"{name}: паралельна обробка одного користувача"
+    first_wait = (model.batches[1][0][0] - arrivals[sent[0]]) * 1000
+    print(f"{name:>32}: {len(sent)} повідомлень -> пакети {sizes}, перше чекало {first_wait:.0f} мс | OK")
+
+
+async def load(args):
+    """Багато користувачів з випадковими серіями одночасно"""
+    rng = random.Random(42)
+    model = FakeModel(args.model_ms)
+    actors = UserActors(model.process, args.debounce_ms, args.max_wait_ms)
+    arrivals = {}
+
+    plans = {
+        user_id: [rng.choice([0, 20, 50, 100, args.debounce_ms * 3]) for _ in range(rng.randint(1, 8))]
+        for user_id in range(args.users)
+    }
+    started = time.perf_counter()
+    sent = await asyncio.gather(*(send(actors, user_id, gaps, arrivals) for user_id, gaps in plans.items()))
+    await wait_idle(actors)
+    elapsed = time.perf_counter() - started
+
+    for user_id, messages in enumerate(sent):
+        check_user(model, user_id, messages, arrivals, args)
+    assert not model.overlaps, "паралельна обробка одного користувача"
+    metrics = actors.metrics
+    assert metrics['messages'] == sum(len(messages) for messages in sent)
+    assert metrics['batches'] == sum(len(batches) for batches in model.batches.values())
+    print(f"{'навантаження':>32}: {metrics['messages']} повідомлень від {args.users} користувачів -> "
+          f"{metrics['batches']} запитів (-{metrics['coalesced'] / metrics['messages']:.0%}), "
+          f"найбільший пакет {metrics['max_batch']}, {elapsed:.1f} с | OK")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--debounce-ms', type=float, default=200)
+    parser.add_argument('--max-wait-ms', type=float, default=1000)
+    parser.add_argument('--model-ms', type=float, default=300)
+    args = parser.parse_args()
+    assert args.debounce_ms * 2 < args.max_wait_ms, "сценарії розраховані на max_wait > 2 * debounce"
+
+    debounce, max_wait, model = args.debounce_ms, args.max_wait_ms, args.model_ms
+    await scenario('одне повідомлення', [0], [1], args)
+    # Перше - одразу, решта надійшли під час відповіді і зливаються в один пакет
+    await scenario('серія з 4 швидких', [0, 30, 30, 30], [1, 3], args)
+    await scenario('паузи довші за debounce', [0, debounce * 2 + model, debounce * 2 + model], [1, 1, 1], args)
+    # Безперервна серія на 2 * max_wait: debounce не спрацьовує, пакети обрізає max_wait
+    # (межу пакета перевіряє check_user, точний розподіл залежить від планувальника)
+    gaps = [0] + [debounce / 2] * int(max_wait * 2 / (debounce / 2))
+    await scenario('довга серія (обмеження max_wait)', gaps, 3, args)
+    await load(args)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""
+Перевірка плану та швидкості читання історії користувача.
+
+Для обох напрямків сортування виконує EXPLAIN і перевіряє, що запит іде по
+idx_messages_user_ts_unfiltered без окремого сортування, потім проходить
+усю історію сторінками (keyset) і порівнює з OFFSET-пагінацією.
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.message_reads --user-id 123 --page 200
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from database import db, USER_MESSAGES_QUERY_ASC, USER_MESSAGES_QUERY_DESC
+
+EXPECTED_INDEX = 'idx_messages_user_ts_unfiltered'
+
+
+def walk_plan(node: dict):
+    yield node
+    for child in node.get('Plans', []):
+        yield from walk_plan(child)
+
+
+async def check_plan(conn, name: str, query: str, args: tuple) -> bool:
+    # Плануємо з конкретними параметрами, як це робить сервер для неіменованих запитів
+    raw = await conn.fetchval(f'EXPLAIN (FORMAT JSON) {query}', *args)
+    plan = json.loads(raw)[0]['Plan']
+    nodes = list(walk_plan(plan))
+    uses_index = any(node.get('Index Name') == EXPECTED_INDEX for node in nodes)
+    has_sort = any(node['Node Type'] == 'Sort' for node in nodes)
+    ok = uses_index and not has_sort
+    print(f"{name:>28}: {'OK' if ok else 'FAIL'} | "
+          f"{' -> '.join(node['Node Type'] for node in nodes)}")
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--page', type=int, default=200)
+    args = parser.parse_args()
+
+    await db.connect()
+    try:
+        async with db.pool.acquire() as conn:
+            # Без цього на маленькій таблиці планувальник обирає seq scan
+            await conn.execute('SET enable_seqscan = off')
+            first = await conn.fetchval(
+                'SELECT id FROM messages WHERE user_id = $1 AND is_filtered = FALSE ORDER BY id LIMIT 1',
+                args.user_id
+            )
+            checks = [
+                ('asc, first page', USER_MESSAGES_QUERY_ASC, (args.user_id, None, None, args.page)),
+                ('asc, after_id', USER_MESSAGES_QUERY_ASC, (args.user_id, first, None, args.page)),
+                ('desc, first page', USER_MESSAGES_QUERY_DESC, (args.user_id, None, None, args.page)),
+                ('desc, after_id', USER_MESSAGES_QUERY_DESC, (args.user_id, first, None, args.page)),
+            ]
+            results = [await check_plan(conn, *check) for check in checks]
+            await conn.execute('RESET enable_seqscan')
+
+            # Keyset: кожна сторінка починається з курсора
+            started = time.perf_counter()
+            pages = rows = 0
+            after_id = None
+            while True:
+                page = await db.get_user_messages(args.user_id, limit=args.page, ascending=True, after_id=after_id)
+                if not page:
+                    break
+                pages += 1
+                rows += len(page)
+                after_id = page[-1]['id']
+            keyset_ms = (time.perf_counter() - started) * 1000
+
+            # OFFSET: кожна сторінка перечитує всі попередні рядки
+            started = time.perf_counter()
+            offset = 0
+            while True:
+                page = await conn.fetch('''
+                    SELECT * FROM messages WHERE user_id = $1 AND is_filtered = FALSE
+                    ORDER BY timestamp, id LIMIT $2 OFFSET $3
+                ''', args.user_id, args.page, offset)
+                if not page:
+                    break
+                offset += len(page)
+            offset_ms = (time.perf_counter() - started) * 1000
+
+        print(f"{rows} повідомлень, {pages} сторінок: keyset {keyset_ms:.1f} мс | offset {offset_ms:.1f} мс")
+    finally:
+        await db.close()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
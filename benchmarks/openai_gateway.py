@@ -0,0 +1,138 @@
+"""
+Перевірка openai_gateway на локальній заглушці OpenAI (benchmarks.openai_stub).
+
+Сценарії:
+- burst: --requests одночасних запитів до заглушки, що приймає лише
+  --capacity одночасно і відповідає 429 на решту. Прямі виклики клієнта
+  (стандартні 2 повтори SDK) порівнюються зі шлюзом: скільки запитів
+  завершились успішно, затримка і скільки 429 отримала заглушка;
+- outage: заглушка відповідає 500 - запобіжник має розімкнутись і
+  відхиляти запити без звернення до сервера, а після відновлення закритись.
+
+Запуск (БД і мережа не потрібні):
+    python -m benchmarks.openai_gateway --requests 200 --capacity 8 --latency-ms 200
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from benchmarks.openai_stub import StubServer
+from openai_gateway import AdaptiveLimiter, CircuitBreaker, CircuitOpenError, OpenAIGateway
+
+MESSAGES = [{"role": "user", "content": "Cześć! Jak minął Twój dzień?"}]
+
+
+def make_gateway(max_retries: int = 6, deadline: float = 60, breaker_failures: int = 5,
+                 breaker_reset: float = 1.0) -> OpenAIGateway:
+    return OpenAIGateway(
+        AdaptiveLimiter(initial=16, minimum=1, maximum=64),
+        CircuitBreaker(breaker_failures, breaker_reset),
+        max_retries=max_retries, deadline_seconds=deadline, base_delay=0.2, max_delay=4.0,
+    )
+
+
+async def burst(name: str, server: StubServer, call, requests: int):
+    server.stats.update(requests=0, served=0, rate_limited=0, errors=0, max_in_flight=0)
+    latencies = []
+    failures = 0
+
+    async def one():
+        nonlocal failures
+        started = time.perf_counter()
+        try:
+            await call()
+            latencies.append((time.perf_counter() - started) * 1000)
+        except Exception:
+            failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = statistics.median(latencies) if latencies else 0.0
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)] if latencies else 0.0
+    print(
+        f"{name:>8}: ok {len(latencies)}/{requests} | failed {failures} | p50 {p50:7.1f} ms | "
+        f"p95 {p95:7.1f} ms | {elapsed:5.1f} s | stub 429: {server.stats['rate_limited']}, "
+        f"max in flight {server.stats['max_in_flight']}"
+    )
+    return failures
+
+
+async def outage(server: StubServer, client: AsyncOpenAI) -> bool:
+    gateway = make_gateway(max_retries=0, breaker_failures=5, breaker_reset=1.0)
+
+    async def call():
+        return await gateway.call(lambda: client.chat.completions.create(model='stub', messages=MESSAGES))
+
+    server.errors = 1.0
+    server.stats.update(requests=0)
+    rejected = 0
+    for _ in range(20):
+        try:
+            await call()
+        except CircuitOpenError:
+            rejected += 1
+        except Exception:
+            pass
+    reached_server = server.stats['requests']
+    opened = gateway.breaker.state == 'open'
+
+    # Після reset_seconds пробний запит проходить і замикає запобіжник
+    server.errors = 0.0
+    await asyncio.sleep(1.1)
+    await call()
+    closed = gateway.breaker.state == 'closed'
+
+    ok = opened and closed and reached_server == 5 and rejected == 15
+    print(
+        f"  outage: {'OK' if ok else 'FAIL'} | до сервера дійшло {reached_server}/20, "
+        f"відхилено запобіжником {rejected}, після відновлення: {gateway.breaker.state}"
+    )
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--capacity', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    args = parser.parse_args()
+
+    server = StubServer(args.latency_ms, capacity=args.capacity, retry_after=args.retry_after)
+    base_url = await server.start()
+    try:
+        # Як клієнт бота раніше: стандартні повтори SDK, без обмеження одночасних запитів
+        direct = AsyncOpenAI(api_key='stub', base_url=base_url)
+        await burst('direct', server, lambda: direct.chat.completions.create(model='stub', messages=MESSAGES),
+                    args.requests)
+
+        client = AsyncOpenAI(api_key='stub', base_url=base_url, max_retries=0)
+        gateway = make_gateway()
+        failures = await burst('gateway', server, lambda: gateway.call(
+            lambda: client.chat.completions.create(model='stub', messages=MESSAGES)
+        ), args.requests)
+        metrics = gateway.get_metrics()
+        print(
+            f"          ліміт {metrics['concurrency_limit']} (зменшень {metrics['limiter_decreases']}), "
+            f"повторів {metrics['retries']}, 429 {metrics['rate_limited']}"
+        )
+
+        ok = await outage(server, client)
+        await direct.close()
+        await client.close()
+    finally:
+        await server.stop()
+
+    if failures or not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""
+Локальна заглушка OpenAI Chat Completions API для перевірки openai_gateway.
+
+Відповідає з заданою затримкою, повертає 429 (з Retry-After), коли
+одночасних запитів більше за --capacity або випадково з імовірністю
+--rate-limit, і 500 з імовірністю --errors. Підтримує stream=True (SSE).
+Статистика - GET /stats.
+
+Запуск окремо (бот підключається через OPENAI_BASE_URL=http://127.0.0.1:8099/v1):
+    python -m benchmarks.openai_stub --port 8099 --latency-ms 300 --capacity 8
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+REPLY = "To brzmi wspaniale! A co jeszcze wydarzyło się dzisiaj?"
+
+
+class StubServer:
+    """Заглушка з налаштуваннями, які можна змінювати під час роботи"""
+
+    def __init__(self, latency_ms: float = 300, jitter_ms: float = 50, capacity: int = 8,
+                 rate_limit: float = 0.0, errors: float = 0.0, retry_after: float = 1.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.capacity = capacity
+        self.rate_limit = rate_limit
+        self.errors = errors
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'served': 0, 'rate_limited': 0, 'errors': 0, 'max_in_flight': 0}
+        self._runner = None
+
+    def _error(self, status: int, message: str, headers: dict = None) -> web.Response:
+        body = {'error': {'message': message, 'type': 'stub_error', 'code': None}}
+        return web.json_response(body, status=status, headers=headers)
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats['requests'] += 1
+        if self.in_flight >= self.capacity or random.random() < self.rate_limit:
+            self.stats['rate_limited'] += 1
+            return self._error(429, 'Rate limit reached', {'retry-after': str(self.retry_after)})
+        if random.random() < self.errors:
+            self.stats['errors'] += 1
+            return self._error(500, 'Internal error')
+
+        self.in_flight += 1
+        self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+        try:
+            delay = max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            usage = {'prompt_tokens': 100, 'completion_tokens': 15, 'total_tokens': 115}
+            base = {'id': 'chatcmpl-stub', 'created': int(time.time()), 'model': body.get('model', 'stub')}
+
+            if not body.get('stream'):
+                await asyncio.sleep(delay)
+                self.stats['served'] += 1
+                return web.json_response({
+                    **base, 'object': 'chat.completion', 'usage': usage,
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': REPLY}}],
+                })
+
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            words = REPLY.split(' ')
+            for i, word in enumerate(words):
+                await asyncio.sleep(delay / len(words))
+                chunk = {**base, 'object': 'chat.completion.chunk', 'choices': [
+                    {'index': 0, 'finish_reason': None, 'delta': {'content': word if i == 0 else ' ' + word}}
+                ]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            final = {**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage}
+            await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            await response.write_eof()
+            self.stats['served'] += 1
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, 'in_flight': self.in_flight})
+
+    async def start(self, port: int = 0) -> str:
+        """Запустити сервер; повертає base_url для клієнта OpenAI"""
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.completions)
+        app.router.add_get('/stats', self.get_stats)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--capacity', type=int, default=8, help='Одночасних запитів до 429')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Імовірність випадкового 429')
+    parser.add_argument('--errors', type=float, default=0.0, help='Імовірність 500')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = StubServer(args.latency_ms, capacity=args.capacity, rate_limit=args.rate_limit,
+                        errors=args.errors, retry_after=args.retry_after)
+    base_url = await server.start(args.port)
+    print(f"Заглушка OpenAI: {base_url} (статистика: http://127.0.0.1:{args.port}/stats)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Бенчмарк /quality: попередній підрахунок у Python по всіх повідомленнях
+проти одного агрегатного запиту MESSAGE_BREAKDOWN_QUERY.
+
+Для кожного розміру історії створює синтетичного користувача, перевіряє,
+що звіт validate_data_quality збігається з попередньою реалізацією
+(порядок ключів sentiment_distribution тепер від найчисленніших), і міряє затримку.
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.quality_report --sizes 100 1000 10000 --repeat 5
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+import config
+from database import db
+from export_jsonl import exporter
+
+# Синтетичний користувач з від'ємним id, щоб не зачепити реальні дані
+BENCH_USER_ID = -2_000_000
+
+SAMPLE_TEXT = "Dzisiaj był naprawdę dobry dzień, poszedłem na długi spacer po parku. " * 6
+
+
+async def legacy_validate_data_quality(user_id: int) -> dict:
+    """Копія попередньої реалізації: всі рядки разом з текстом передаються в Python"""
+    stats = await db.get_user_stats(user_id)
+    messages = await db.get_user_messages(user_id)
+    if not stats or not messages:
+        return {'valid': False}
+
+    user_messages = [m for m in messages if m['role'] == 'user']
+    assistant_messages = [m for m in messages if m['role'] == 'assistant']
+    sentiments = {}
+    for msg in user_messages:
+        sentiment = msg.get('sentiment', 'neutral')
+        sentiments[sentiment] = sentiments.get(sentiment, 0) + 1
+
+    avg_tokens = stats['total_tokens'] / stats['message_count'] if stats['message_count'] > 0 else 0
+    is_sufficient = stats['total_tokens'] >= config.MIN_TOKEN_LIMIT
+    is_balanced = len(user_messages) > 0 and len(assistant_messages) > 0
+    return {
+        'valid': is_sufficient and is_balanced,
+        'total_tokens': stats['total_tokens'],
+        'total_messages': len(messages),
+        'user_messages': len(user_messages),
+        'assistant_messages': len(assistant_messages),
+        'avg_tokens_per_message': round(avg_tokens, 2),
+        'sentiment_distribution': sentiments,
+        'is_sufficient': is_sufficient,
+        'is_balanced': is_balanced,
+        'progress_percent': round((stats['total_tokens'] / config.MIN_TOKEN_LIMIT) * 100, 2)
+    }
+
+
+async def cleanup():
+    async with db.pool.acquire() as conn:
+        await conn.execute('DELETE FROM messages WHERE user_id = $1', BENCH_USER_ID)
+        await conn.execute('DELETE FROM user_stats WHERE user_id = $1', BENCH_USER_ID)
+
+
+async def seed(size: int, seed: int = 42):
+    """Історія з чергуванням ролей, випадковими настроями і частиною відфільтрованих рядків"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(size):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        sentiment = rng.choice(['positive', 'negative', 'neutral', None]) if role == 'user' else None
+        records.append((BENCH_USER_ID, role, SAMPLE_TEXT, 60, sentiment, rng.random() < 0.1))
+
+    async with db.pool.acquire() as conn:
+        await conn.copy_records_to_table(
+            'messages', records=records,
+            columns=['user_id', 'role', 'content', 'tokens_count', 'sentiment', 'is_filtered'],
+        )
+        await conn.execute('''
+            INSERT INTO user_stats (user_id, total_tokens, message_count)
+            SELECT $1, COALESCE(SUM(tokens_count), 0), COUNT(*) FROM messages
+            WHERE user_id = $1 AND is_filtered = FALSE
+        ''', BENCH_USER_ID)
+
+
+async def measure(func, repeat: int) -> tuple:
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await func(BENCH_USER_ID)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(latencies)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    await db.connect()
+    mismatches = 0
+    try:
+        for size in args.sizes:
+            await cleanup()
+            await seed(size)
+            legacy, legacy_ms = await measure(legacy_validate_data_quality, args.repeat)
+            current, current_ms = await measure(exporter.validate_data_quality, args.repeat)
+            same = legacy == current
+            mismatches += not same
+            print(f"{size:>7} повідомлень: legacy {legacy_ms:8.1f} мс | aggregate {current_ms:7.1f} мс | "
+                  f"x{legacy_ms / current_ms:.1f} | {'OK' if same else 'MISMATCH'}")
+    finally:
+        await cleanup()
+        await db.close()
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+"""
+Перевірка розподілу нагадувань між кількома процесами через захоплення рядків.
+
+Створює синтетичних користувачів, запускає --processes процесів, кожен з яких
+захоплює пакети через Database.claim_reminders і "відправляє" нагадування
+(затримка замість Telegram). Один додатковий процес захоплює пакет і
+"падає" без відправки - його користувачі мають дістатися іншим лише після
+закінчення захоплення. Наприкінці перевіряє, що кожен користувач отримав
+рівно одне нагадування.
+
+Захоплює ВСІХ користувачів, яким належить нагадування, тож запускати тільки
+на локальній тестовій БД (скрипт відмовиться, якщо там є реальні користувачі).
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.reminder_claims --users 2000 --processes 4 --batch 100
+"""
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+from database import db
+
+# Синтетичні користувачі з від'ємними id, щоб не зачепити реальні дані
+BENCH_USER_BASE = -4_000_000
+CRASH_LEASE_SECONDS = 3
+
+
+async def seed(users: int):
+    async with db.pool.acquire() as conn:
+        await conn.execute('DELETE FROM user_stats WHERE user_id <= $1', BENCH_USER_BASE)
+        await conn.execute('''
+            INSERT INTO user_stats (user_id, reminders_enabled, collection_active, last_activity_at)
+            SELECT $1 - g, TRUE, TRUE, NOW() - INTERVAL '1 day' FROM generate_series(0, $2 - 1) AS g
+        ''', BENCH_USER_BASE, users)
+
+
+async def cleanup():
+    async with db.pool.acquire() as conn:
+        await conn.execute('DELETE FROM user_stats WHERE user_id <= $1', BENCH_USER_BASE)
+
+
+async def claim_and_send(worker_id: str, batch: int, send_ms: float, crash: bool) -> list:
+    """Один екземпляр бота: захоплює пакети, поки є що захоплювати"""
+    await db.connect(max_size=2)
+    sent = []
+    try:
+        while True:
+            lease = CRASH_LEASE_SECONDS if crash else config.REMINDER_CLAIM_LEASE_SECONDS
+            user_ids = await db.claim_reminders(worker_id, batch, lease)
+            if not user_ids:
+                return sent
+            if crash:
+                # "Падіння": захоплення залишаються в БД до закінчення терміну
+                return []
+            await asyncio.sleep(send_ms * len(user_ids) / 1000)
+            await db.update_last_reminders(user_ids)
+            sent.extend(user_ids)
+    finally:
+        await db.close()
+
+
+def run_worker(args: tuple) -> list:
+    return asyncio.run(claim_and_send(*args))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--send-ms', type=float, default=1.0, help='Затримка "відправки" одного нагадування')
+    args = parser.parse_args()
+
+    await db.connect()
+    try:
+        async with db.pool.acquire() as conn:
+            real_users = await conn.fetchval('SELECT COUNT(*) FROM user_stats WHERE user_id > 0')
+        if real_users:
+            print(f"У БД є {real_users} реальних користувачів - запускайте на окремій тестовій БД")
+            sys.exit(2)
+        await seed(args.users)
+    finally:
+        await db.close()
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=args.processes + 1) as executor:
+        # Спершу "падаючий" екземпляр захоплює пакет і зникає
+        await loop.run_in_executor(executor, run_worker, ('crashed', args.batch, args.send_ms, True))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, run_worker, (f'worker-{i}', args.batch, args.send_ms, False))
+            for i in range(args.processes)
+        ))
+        elapsed = time.perf_counter() - started
+        first_round = sum(len(sent) for sent in results)
+
+        # Після закінчення захоплення користувачі "впалого" екземпляра дістаються іншим
+        await asyncio.sleep(CRASH_LEASE_SECONDS)
+        results.append(await loop.run_in_executor(executor, run_worker, ('recovery', args.batch, args.send_ms, False)))
+
+    counts = Counter(user_id for sent in results for user_id in sent)
+    duplicates = sum(1 for count in counts.values() if count > 1)
+    missing = args.users - len(counts)
+    per_process = [len(sent) for sent in results[:-1]]
+
+    print(f"{args.processes} процесів: {first_round} нагадувань за {elapsed:.2f} с, розподіл {per_process}")
+    print(f"Після закінчення захоплення: {len(results[-1])} (очікувалось {args.batch})")
+    print(f"Дублікатів: {duplicates}, пропущено: {missing}")
+
+    await db.connect()
+    try:
+        await cleanup()
+    finally:
+        await db.close()
+
+    if duplicates or missing or len(results[-1]) != min(args.batch, args.users):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""
+Бенчмарк затримки відповіді: попередній послідовний get_ai_response
+(збереження -> OpenAI -> збереження) проти конвеєра, де запит до OpenAI
+йде паралельно зі збереженням, а відповідь асистента записується у фоні.
+
+OpenAI замінено заглушкою з фіксованою затримкою, БД - справжня.
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.reply_pipeline --messages 200 --users 10 --openai-ms 300
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from types import SimpleNamespace
+
+# bot.py створює Bot при імпорті, для бенчмарку достатньо токена у правильному форматі
+os.environ.setdefault('TELEGRAM_TOKEN', '0:benchmark')
+
+import bot
+from database import db
+from history import history_store
+
+# Синтетичні користувачі з від'ємними id, щоб не зачепити реальні дані
+BENCH_USER_BASE = -3_000_000
+
+SAMPLE_TEXT = "Dzisiaj był naprawdę dobry dzień, poszedłem na długi spacer po parku i czuję się świetnie."
+
+
+class StubCompletions:
+    """Заглушка OpenAI: відповідь через фіксований час"""
+
+    def __init__(self, delay_ms: float):
+        self.delay = delay_ms / 1000
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.delay)
+        message = SimpleNamespace(content="To brzmi wspaniale! A co jeszcze wydarzyło się dzisiaj?")
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=15)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+async def legacy_get_ai_response(user_id: int, user_message: str) -> str:
+    """Копія попереднього послідовного потоку"""
+    await history_store.load(user_id)
+    if await db.save_message(user_id, "user", user_message) == 'limit_reached':
+        return await bot.limit_reached_message(user_id)
+    await history_store.add(user_id, "user", user_message)
+    history = await history_store.get(user_id)
+    ai_message, usage = await bot.request_completion(history, None)
+    await db.save_message(user_id, "assistant", ai_message)
+    await history_store.add(user_id, "assistant", ai_message)
+    return ai_message
+
+
+async def cleanup(users: int):
+    async with db.pool.acquire() as conn:
+        ids = list(range(BENCH_USER_BASE - users, BENCH_USER_BASE + 1))
+        await conn.execute('DELETE FROM messages WHERE user_id = ANY($1::bigint[])', ids)
+        await conn.execute('DELETE FROM user_stats WHERE user_id = ANY($1::bigint[])', ids)
+    for user_id in ids:
+        await history_store.clear(user_id)
+
+
+async def run(name: str, respond, messages: int, users: int):
+    await cleanup(users)
+    latencies = []
+
+    async def conversation(user_id: int, count: int):
+        # Повідомлення одного користувача йдуть по черзі, як у чаті
+        for _ in range(count):
+            started = time.perf_counter()
+            await respond(user_id, SAMPLE_TEXT)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(conversation(BENCH_USER_BASE - i, messages // users) for i in range(users)))
+    await bot.drain_background_tasks()
+    elapsed = time.perf_counter() - started
+
+    async with db.pool.acquire() as conn:
+        stored = await conn.fetchval(
+            'SELECT COUNT(*) FROM messages WHERE user_id <= $1 AND user_id >= $2',
+            BENCH_USER_BASE, BENCH_USER_BASE - users
+        )
+
+    latencies.sort()
+    print(
+        f"{name:>10}: p50 {statistics.median(latencies):7.1f} ms | "
+        f"p95 {latencies[int(len(latencies) * 0.95) - 1]:7.1f} ms | "
+        f"{len(latencies) / elapsed:6.1f} replies/s | saved {stored} rows"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--openai-ms', type=float, default=300)
+    args = parser.parse_args()
+
+    bot._openai_client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions(args.openai_ms)))
+    await db.connect()
+    try:
+        await run('sequential', legacy_get_ai_response, args.messages, args.users)
+        await run('pipelined', lambda user_id, text: bot.get_ai_response(user_id, [text]), args.messages, args.users)
+        print(f"Фонові задачі: {bot.background_metrics}, помилки збереження: {db.save_errors}")
+    finally:
+        await cleanup(args.users)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
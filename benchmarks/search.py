@@ -0,0 +1,67 @@
+"""
+Перевірка плану та швидкості повнотекстового пошуку.
+
+Виконує EXPLAIN для SEARCH_MESSAGES_QUERY і перевіряє, що запит іде через
+GIN-індекс idx_messages_search, потім проходить усі результати сторінками
+(keyset) і порівнює з послідовним скануванням через ILIKE.
+
+Запуск (потрібна робоча БД у DATABASE_URL):
+    python -m benchmarks.search --query "dobry dzień" --page 50
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.message_reads import walk_plan
+from database import db, SEARCH_MESSAGES_QUERY
+
+EXPECTED_INDEX = 'idx_messages_search'
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--query', required=True)
+    parser.add_argument('--page', type=int, default=50)
+    args = parser.parse_args()
+
+    await db.connect()
+    try:
+        async with db.pool.acquire() as conn:
+            raw = await conn.fetchval(f'EXPLAIN (FORMAT JSON) {SEARCH_MESSAGES_QUERY}', args.query, None, None, args.page)
+            nodes = list(walk_plan(json.loads(raw)[0]['Plan']))
+            uses_index = any(node.get('Index Name') == EXPECTED_INDEX for node in nodes)
+            print(f"План: {'OK' if uses_index else 'FAIL'} | {' -> '.join(node['Node Type'] for node in nodes)}")
+
+            # Keyset: кожна сторінка починається з курсора
+            started = time.perf_counter()
+            pages = rows = 0
+            before_id = None
+            while True:
+                page = await db.search_messages(args.query, limit=args.page, before_id=before_id)
+                if not page:
+                    break
+                pages += 1
+                rows += len(page)
+                before_id = page[-1]['id']
+            search_ms = (time.perf_counter() - started) * 1000
+
+            # ILIKE: послідовне сканування всієї таблиці
+            started = time.perf_counter()
+            ilike_rows = await conn.fetchval(
+                'SELECT COUNT(*) FROM messages WHERE content ILIKE $1', f'%{args.query}%'
+            )
+            ilike_ms = (time.perf_counter() - started) * 1000
+
+        print(f"tsvector: {rows} результатів, {pages} сторінок за {search_ms:.1f} мс | "
+              f"ILIKE: {ilike_rows} результатів за {ilike_ms:.1f} мс")
+    finally:
+        await db.close()
+
+    if not uses_index:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+Мікробенчмарк аналізу настрою та фільтрації: попередні покрокові перевірки
+`in` проти скомпільованого TextMatcher (окремі тексти та пакет).
+
+Запуск:
+    python -m benchmarks.text_matching --texts 20000
+"""
+import argparse
+import random
+import time
+
+import config
+from text_analysis import TextMatcher
+
+matchers = {
+    engine: TextMatcher(
+        config.POSITIVE_WORDS, config.NEGATIVE_WORDS, config.TECHNICAL_PATTERNS,
+        config.EXCLUDED_COMMANDS, engine=engine,
+    )
+    for engine in ('substring', 'regex')
+}
+
+FRAGMENTS = [
+    "Dzisiaj był naprawdę dobry dzień",
+    "poszedłem na długi spacer po parku",
+    "czuję się świetnie",
+    "trochę smutno mi dzisiaj",
+    "bo tęsknię za rodziną, która mieszka daleko",
+    "myślę o tym, żeby zacząć uczyć się gotowania",
+    "w pracy było okropnie, szef znowu krzyczał",
+    "kocham takie spokojne wieczory z herbatą",
+    "nie podoba mi się to, co dzieje się w mieście",
+    "zobacz https://example.com/artykul",
+    "cieszę się, że w końcu mamy weekend 😊",
+    "głowa mnie boli od rana 😢",
+    "ok",
+    "a Ty jak się masz?",
+    "Szczęśliwy jestem, bo zdałem egzamin! 👍",
+]
+
+
+def legacy_flags(text: str, tokens_count: int):
+    """Копія попередньої логіки analyze_sentiment + should_filter_message"""
+    text_lower = text.lower()
+    positive_words = ['dobrze', 'świetnie', 'super', 'klasowo', 'doskonale',
+                      'kocham', 'cieszę się', 'szczęśliwy', '😊', '😄', '❤️', '👍']
+    negative_words = ['źle', 'okropnie', 'smutno', 'boli', 'nie podoba mi się',
+                      'nienawidzę', 'tęsknię', '😢', '😞', '😠', '💔']
+    positive_count = sum(1 for word in positive_words if word in text_lower)
+    negative_count = sum(1 for word in negative_words if word in text_lower)
+    if positive_count > negative_count:
+        sentiment = 'positive'
+    elif negative_count > positive_count:
+        sentiment = 'negative'
+    else:
+        sentiment = 'neutral'
+
+    if any(text.startswith(cmd) for cmd in config.EXCLUDED_COMMANDS):
+        filtered = True
+    elif tokens_count < config.MIN_MESSAGE_TOKENS:
+        filtered = True
+    else:
+        filtered = any(pattern in text for pattern in ['http://', 'https://', 'www.'])
+    return sentiment, filtered
+
+
+def matcher_flags(matcher: TextMatcher, text: str, tokens_count: int):
+    flags = matcher.scan(text)
+    return flags.sentiment, matcher.should_filter(text, tokens_count, flags)
+
+
+def make_corpus(size: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        parts = rng.choices(FRAGMENTS, k=rng.choice([1, 2, 3, 5, 8, 20]))
+        text = ", ".join(parts) + rng.choice([".", "!", "?", "..."])
+        if rng.random() < 0.05:
+            text = rng.choice(config.EXCLUDED_COMMANDS) + " " + text
+        if rng.random() < 0.3:
+            text = text.capitalize()
+        corpus.append(text)
+    return corpus
+
+
+def measure(name: str, func, corpus: list, total_chars: int):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:>18}: {len(corpus) / elapsed:10.0f} texts/s | {total_chars / elapsed / 1e6:6.2f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--extra-words', type=int, nargs='*', default=[32, 128, 512])
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.texts)
+    tokens = [len(text.split()) * 2 for text in corpus]  # Наближено, без токенізатора
+    total_chars = sum(len(text) for text in corpus)
+
+    print(f"Корпус: {len(corpus)} текстів, {total_chars / len(corpus):.0f} символів у середньому")
+    measure('legacy', lambda: [legacy_flags(t, c) for t, c in zip(corpus, tokens)], corpus, total_chars)
+
+    for engine, matcher in matchers.items():
+        mismatches = sum(
+            legacy_flags(text, count) != matcher_flags(matcher, text, count)
+            for text, count in zip(corpus, tokens)
+        )
+        batch = [flags.sentiment for flags in matcher.scan_many(corpus)]
+        mismatches += sum(legacy_flags(text, 0)[0] != sentiment for text, sentiment in zip(corpus, batch))
+        print(f"{engine}: розбіжностей з попередньою логікою: {mismatches}")
+
+        measure(engine, lambda: [matcher_flags(matcher, t, c) for t, c in zip(corpus, tokens)], corpus, total_chars)
+        measure(f'{engine} batch', lambda: matcher.scan_many(corpus), corpus, total_chars)
+
+    # Розширені словники: з якого розміру вигідніший regex
+    for extra in args.extra_words:
+        rng = random.Random(extra)
+        words = [''.join(rng.choices('abcdefghijklmnoprstuwyząćęłńóśźż', k=rng.randint(5, 10))) for _ in range(extra)]
+        print(f"Словники + {extra} слів:")
+        for engine in ('substring', 'regex'):
+            matcher = TextMatcher(
+                config.POSITIVE_WORDS + words[::2], config.NEGATIVE_WORDS + words[1::2],
+                config.TECHNICAL_PATTERNS, config.EXCLUDED_COMMANDS, engine=engine,
+            )
+            measure(f'{engine} +{extra}', lambda: matcher.scan_many(corpus), corpus, total_chars)
+
+
+if __name__ == '__main__':
+    main()
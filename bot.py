@@ -1,17 +1,35 @@
+import time
+_import_started = time.perf_counter()
+
 import asyncio
+import importlib
 import logging
+import os
+import multiprocessing
+import multiprocessing.connection
 import random
+import signal
+import socket
 
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command
-from openai import AsyncOpenAI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 import config
 from database import db
+from dedup import UpdateDeduplicator
+from broadcast import TokenBucket, fan_out
 from export_jsonl import exporter
+from history import history_store
+from metrics import SIZE_BUCKETS, TOKEN_BUCKETS, Histogram, registry
+from openai_gateway import CircuitOpenError, DeadlineExceededError, openai_gateway
+from tokenizer import token_counter
+from webhook_queue import QueuedRequestHandler
+
+# Час етапів запуску (секунди)
+startup_timings = {'imports': time.perf_counter() - _import_started}
 
 # Налаштування логування
 logging.basicConfig(level=logging.INFO)
@@ -21,77 +39,459 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=config.TELEGRAM_TOKEN)
 dp = Dispatcher()
 
-# Ініціалізація OpenAI клієнта
-client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
-
-# Ініціалізація планувальника
-scheduler = AsyncIOScheduler()
-
-# Словник для зберігання історії розмов (тимчасово, в пам'яті)
-user_conversions = {}
-
-
-def get_conversation_history(user_id: int) -> list:
-    """Отримати історію розмови користувача"""
-    if user_id not in user_conversions:
-        user_conversions[user_id] = [
-            {"role": "system", "content": config.SYSTEM_PROMPT}
-        ]
-    return user_conversions[user_id]
-
-
-def add_message_to_history(user_id: int, role: str, content: str):
-    """Додати повідомлення до історії"""
-    history = get_conversation_history(user_id)
-    history.append({"role": role, "content": content})
-
-    # Обмежуємо історію останніми 10 повідомленнями (без system prompt)
-    if len(history) > 11:  # 1 system + 10 messages
-        user_conversions[user_id] = [history[0]] + history[-10:]
-
+# Повторні доставки оновлень відкидаються до будь-якого обробника
+update_deduplicator = UpdateDeduplicator(config.UPDATE_DEDUP_SIZE)
+dp.update.outer_middleware(update_deduplicator)
+
+
+@dp.message.outer_middleware()
+async def handler_metrics(handler, event: types.Message, data: dict):
+    """
+    Час обробки команд окремо для кожної команди
+
+    Текст лише ставиться в чергу користувача (UserActors), тож його час
+    відповіді міряє bot_reply_seconds, а не цей обробник
+    """
+    if not (event.text and event.text.startswith('/')):
+        return await handler(event, data)
+    command = event.text.split(maxsplit=1)[0].split('@')[0]
+    command = command if command in METRIC_COMMANDS else 'other'
+    with HANDLER_SECONDS.time(command):
+        return await handler(event, data)
+
+# OpenAI клієнт створюється при першому зверненні (імпорт openai повільний)
+_openai_client = None
+
+# Фактичні токени запитів до OpenAI (з поля usage відповіді)
+openai_usage = {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'last_prompt_tokens': 0}
+
+# Затримки OpenAI: час до першого токена (TTFT) і повний час відповіді
+openai_timings = {
+    'requests': 0, 'streamed': 0,
+    'ttft_ms_total': 0.0, 'last_ttft_ms': 0.0, 'max_ttft_ms': 0.0,
+    'total_ms_total': 0.0, 'last_total_ms': 0.0, 'max_total_ms': 0.0,
+}
+
+# Метрики Prometheus (/metrics)
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Час обробника команди (відповіді на текст - bot_reply_seconds)', ('command',))
+REPLY_SECONDS = Histogram('bot_reply_seconds', 'Час від початку обробки серії повідомлень до повної відповіді')
+OPENAI_SECONDS = Histogram('openai_request_seconds', 'Повний час запиту до OpenAI разом з повторами', ('streamed',))
+OPENAI_TTFT_SECONDS = Histogram('openai_ttft_seconds', 'Час до першого токена відповіді OpenAI', ('streamed',))
+OPENAI_TOKENS = Histogram('openai_tokens', 'Токени запиту та відповіді OpenAI', ('kind',), buckets=TOKEN_BUCKETS)
+REMINDER_RUN_SECONDS = Histogram('reminder_run_seconds', 'Тривалість розсилки нагадувань')
+EXPORT_SECONDS = Histogram('export_seconds', 'Тривалість експорту даних користувача')
+EXPORT_BYTES = Histogram('export_bytes', 'Розмір файлів експорту користувача', buckets=SIZE_BUCKETS)
+# Команди з окремою міткою в bot_handler_seconds (решта - 'other', щоб не плодити ряди)
+METRIC_COMMANDS = {'/start', '/help', '/stats', '/stop', '/reminders', '/quality', '/export', '/search'}
+
+# Фонові задачі збереження (відповіді асистента записуються після відправки)
+background_tasks = set()
+background_metrics = {'started': 0, 'completed': 0, 'failed': 0}
+# Останнє збереження кожного користувача: наступне чекає на нього (save_in_order)
+save_chains = {}
+
+# Ідентифікатор екземпляра (для захоплення нагадувань у БД)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Результат останньої розсилки нагадувань
+last_reminder_run = {}
+
+# Максимальна довжина одного повідомлення Telegram
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+
+# Планувальник створюється в main()
+scheduler: AsyncIOScheduler = None
+webhook_handler: QueuedRequestHandler = None
+
+
+def get_openai_client():
+    """Отримати OpenAI клієнт (створюється при першому виклику)"""
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        # Повтори виконує openai_gateway (з урахуванням ліміту одночасних запитів)
+        _openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_BASE_URL, max_retries=0)
+    return _openai_client
+
+
+def log_startup_timings():
+    """Вивести в лог час етапів запуску"""
+    phases = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in startup_timings.items())
+    logger.info(f"⏱ Час запуску: {phases}")
+
+
+def split_message(text: str) -> list:
+    """Розбити текст на частини, що вміщаються в одне повідомлення Telegram"""
+    return [text[i:i + TELEGRAM_MAX_MESSAGE_CHARS] for i in range(0, len(text), TELEGRAM_MAX_MESSAGE_CHARS)] or [text]
+
+
+class StreamingReply:
+    """
+    Відповідь, що з'являється в Telegram під час стрімінгу
+
+    Перший непорожній фрагмент одразу надсилається повідомленням, далі воно
+    редагується не частіше ніж раз на edit_interval секунд (обмеження Telegram
+    на редагування). finish() показує повний текст, а те, що не вмістилось
+    у 4096 символів, надсилає окремими повідомленнями.
+    """
+
+    def __init__(self, message: types.Message, edit_interval: float):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.parts = []
+        self.sent: types.Message = None
+        self.shown = ''
+        self.last_edit = 0.0
+        self.edits = 0
+
+    async def _show(self, text: str):
+        text = text[:TELEGRAM_MAX_MESSAGE_CHARS]
+        if text == self.shown or not text.strip():
+            return
+        try:
+            if self.sent is None:
+                self.sent = await self.message.answer(text)
+            else:
+                await self.sent.edit_text(text)
+                self.edits += 1
+            self.shown = text
+        except Exception as e:
+            # Пропущене редагування не критичне: наступне або finish() покаже актуальний текст
+            logger.warning(f"Не вдалося оновити відповідь у Telegram: {e}")
+        self.last_edit = time.monotonic()
+
+    async def add(self, delta: str):
+        """Додати фрагмент відповіді"""
+        self.parts.append(delta)
+        if self.sent is None or time.monotonic() - self.last_edit >= self.edit_interval:
+            await self._show(''.join(self.parts))
+
+    async def finish(self, text: str):
+        """Показати остаточний текст"""
+        chunks = split_message(text)
+        if self.sent is None:
+            for chunk in chunks:
+                await self.message.answer(chunk)
+            return
+        if chunks[0] != self.shown:
+            try:
+                await self.sent.edit_text(chunks[0])
+            except Exception as e:
+                logger.warning(f"Не вдалося оновити відповідь у Telegram: {e}")
+                await self.message.answer(chunks[0])
+        for chunk in chunks[1:]:
+            await self.message.answer(chunk)
+
+    async def cancel(self):
+        """Прибрати частково показану відповідь"""
+        if self.sent is not None:
+            try:
+                await self.sent.delete()
+            except Exception as e:
+                logger.warning(f"Не вдалося видалити відповідь у Telegram: {e}")
+
+
+def record_openai_timing(started: float, first_token_at: float, streamed: bool):
+    """Записати TTFT і повний час відповіді OpenAI"""
+    finished = time.perf_counter()
+    ttft_ms = ((first_token_at or finished) - started) * 1000
+    total_ms = (finished - started) * 1000
+    openai_timings['requests'] += 1
+    openai_timings['streamed'] += int(streamed)
+    openai_timings['ttft_ms_total'] += ttft_ms
+    openai_timings['last_ttft_ms'] = ttft_ms
+    openai_timings['max_ttft_ms'] = max(openai_timings['max_ttft_ms'], ttft_ms)
+    openai_timings['total_ms_total'] += total_ms
+    openai_timings['last_total_ms'] = total_ms
+    openai_timings['max_total_ms'] = max(openai_timings['max_total_ms'], total_ms)
+    label = 'true' if streamed else 'false'
+    OPENAI_TTFT_SECONDS.observe(ttft_ms / 1000, label)
+    OPENAI_SECONDS.observe(total_ms / 1000, label)
+
+
+async def stream_completion(history: list, on_delta) -> tuple:
+    """
+    Запит до OpenAI зі стрімінгом
+
+    Returns:
+        (повний текст, usage, момент першого токена)
+    """
+    stream = await get_openai_client().chat.completions.create(
+        model=config.OPENAI_MODEL,
+        messages=history,
+        max_tokens=1000,
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parts = []
+    usage = None
+    first_token_at = None
+    async for chunk in stream:
+        # Останній фрагмент містить тільки usage, без choices
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        delta = chunk.choices[0].delta.content
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        parts.append(delta)
+        await on_delta(delta)
+    return ''.join(parts), usage, first_token_at
+
+
+def run_in_background(coro, name: str):
+    """Запустити задачу у фоні з обліком помилок (посилання тримаємо, щоб задачу не зібрав GC)"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    background_metrics['started'] += 1
+
+    def done(task: asyncio.Task):
+        background_tasks.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            background_metrics['failed'] += 1
+            if not task.cancelled():
+                logger.error(f"Помилка фонової задачі {name}: {task.exception()}")
+        else:
+            background_metrics['completed'] += 1
+
+    task.add_done_callback(done)
+    return task
+
+
+def save_in_order(user_id: int, role: str, content: str, telegram_message_id: int = None) -> asyncio.Task:
+    """
+    Зберегти повідомлення у фоні після попередніх збережень цього користувача
+
+    Відповідь асистента пишеться у фоні, тож наступне повідомлення користувача
+    могло потрапити в messages раніше за неї і зіпсувати порядок пар в експорті
+    """
+    previous = save_chains.get(user_id)
+
+    async def save():
+        if previous is not None:
+            # Потрібен лише порядок, результат попереднього збереження не важливий
+            await asyncio.wait([previous])
+        return await db.save_message(user_id, role, content, telegram_message_id)
+
+    task = run_in_background(save(), name=f'save_{role}_message')
+    save_chains[user_id] = task
+
+    def done(task: asyncio.Task):
+        if save_chains.get(user_id) is task:
+            del save_chains[user_id]
+
+    task.add_done_callback(done)
+    return task
+
+
+async def drain_background_tasks():
+    """Дочекатися фонових задач (перед зупинкою)"""
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+
+class UserActors:
+    """
+    Послідовна обробка повідомлень кожного користувача зі злиттям серій
+
+    Для кожного користувача з повідомленнями в черзі працює одна фонова
+    задача, тож відповіді одному користувачу не генеруються паралельно, а
+    історія поповнюється в порядку надходження. Перше повідомлення від
+    користувача без поточної відповіді обробляється одразу. Повідомлення,
+    що надійшли під час обробки, утворюють наступний пакет: перед ним бот
+    чекає, поки серія затихне на debounce_ms, але не довше max_wait_ms від
+    першого повідомлення пакета. Пакет передається в process(user_id, messages).
+    """
+
+    def __init__(self, process, debounce_ms: float, max_wait_ms: float):
+        self.process = process
+        self.debounce = debounce_ms / 1000
+        self.max_wait = max_wait_ms / 1000
+        self._pending = {}  # user_id -> повідомлення, що чекають на обробку
+        self._first_arrival = {}  # user_id -> час надходження першого повідомлення в черзі
+        self._arrived = {}  # user_id -> Event про нове повідомлення (поки збирається пакет)
+        self._workers = {}  # user_id -> задача обробки
+        self.metrics = {'messages': 0, 'batches': 0, 'coalesced': 0, 'max_batch': 0, 'failed_batches': 0}
+
+    def submit(self, user_id: int, message):
+        """Поставити повідомлення в чергу користувача"""
+        if user_id not in self._pending:
+            self._pending[user_id] = []
+            self._first_arrival[user_id] = asyncio.get_running_loop().time()
+        self._pending[user_id].append(message)
+        self.metrics['messages'] += 1
+        if user_id in self._arrived:
+            self._arrived[user_id].set()
+        if user_id not in self._workers:
+            self._workers[user_id] = run_in_background(self._run(user_id), name='user_actor')
+
+    @property
+    def active_users(self) -> int:
+        return len(self._workers)
+
+    async def _collect(self, user_id: int):
+        """Чекати, поки серія повідомлень затихне"""
+        if self.debounce <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = self._first_arrival[user_id] + self.max_wait
+        arrived = self._arrived[user_id] = asyncio.Event()
+        try:
+            while True:
+                timeout = min(self.debounce, deadline - loop.time())
+                if timeout <= 0:
+                    return
+                arrived.clear()
+                try:
+                    await asyncio.wait_for(arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    return
+        finally:
+            del self._arrived[user_id]
+
+    async def _run(self, user_id: int):
+        first = True
+        try:
+            while self._pending.get(user_id):
+                # Перший пакет не чекає: одиночне повідомлення отримує відповідь без затримки
+                if not first:
+                    await self._collect(user_id)
+                first = False
+                batch = self._pending.pop(user_id)
+                del self._first_arrival[user_id]
+                self.metrics['batches'] += 1
+                self.metrics['coalesced'] += len(batch) - 1
+                self.metrics['max_batch'] = max(self.metrics['max_batch'], len(batch))
+                try:
+                    await self.process(user_id, batch)
+                except Exception as e:
+                    self.metrics['failed_batches'] += 1
+                    logger.error(f"Помилка обробки повідомлень користувача {user_id}: {e}")
+        finally:
+            del self._workers[user_id]
+
+
+async def limit_reached_message(user_id: int) -> str:
+    stats = await db.get_user_stats(user_id)
+    return (
+        f"🎉 Witaj! Zebraliśmy wystarczającą ilość danych, aby stworzyć Twój osobisty model!\n\n"
+        f"📊 Statystyki:\n"
+        f"• Łączna liczba tokenów: {stats['total_tokens']:,}\n"
+        f"• Wiadomości: {stats['message_count']}\n\n"
+        f"Zbieranie danych zakończone. Teraz możemy przejść do szkolenia modelu w Twoim stylu! 🚀"
+    )
 
-async def get_ai_response(user_id: int, user_message: str) -> str:
-    """Отримати відповідь від OpenAI"""
-    try:
-        # Зберігаємо повідомлення користувача
-        save_result = await db.save_message(user_id, "user", user_message)
-
-        #Перевіряємо чи досягнуто ліміт
-        if save_result == 'limit_reached':
-            stats = await db.get_user_stats(user_id)
-            return (
-                f"🎉 Witaj! Zebraliśmy wystarczającą ilość danych, aby stworzyć Twój osobisty model!\n\n"
-                f"📊 Statystyki:\n"
-                f"• Łączna liczba tokenów: {stats['total_tokens']:,}\n"
-                f"• Wiadomości: {stats['message_count']}\n\n"
-                f"Zbieranie danych zakończone. Teraz możemy przejść do szkolenia modelu w Twoim stylu! 🚀"
-            )
 
-        # Додаємо повідомлення користувача до історії
-        add_message_to_history(user_id, "user", user_message)
+async def request_completion(history: list, on_delta) -> tuple:
+    """Запит до OpenAI (зі стрімінгом, якщо є on_delta). Повертає (текст, usage)"""
+    started = time.perf_counter()
+    streamed = on_delta is not None and config.OPENAI_STREAMING
+    if streamed:
+        shown = False
 
-        # Отримуємо історію для контексту
-        history = get_conversation_history(user_id)
+        async def show(delta: str):
+            nonlocal shown
+            shown = True
+            await on_delta(delta)
 
-        # Запит до OpenAI API
-        response = await client.chat.completions.create(
+        # Стрім повторюємо, тільки поки користувач ще нічого не побачив
+        ai_message, usage, first_token_at = await openai_gateway.call(
+            lambda: stream_completion(history, show), retryable=lambda: not shown
+        )
+    else:
+        response = await openai_gateway.call(lambda: get_openai_client().chat.completions.create(
             model=config.OPENAI_MODEL,
             messages=history,
             max_tokens=1000,
             temperature=0.7
-        )
+        ))
+        ai_message, usage, first_token_at = response.choices[0].message.content, response.usage, None
+    record_openai_timing(started, first_token_at, streamed)
+
+    if usage:
+        openai_usage['requests'] += 1
+        openai_usage['prompt_tokens'] += usage.prompt_tokens
+        openai_usage['completion_tokens'] += usage.completion_tokens
+        openai_usage['last_prompt_tokens'] = usage.prompt_tokens
+        OPENAI_TOKENS.observe(usage.prompt_tokens, 'prompt')
+        OPENAI_TOKENS.observe(usage.completion_tokens, 'completion')
+    return ai_message, usage
+
+
+async def get_ai_response(user_id: int, user_messages: list, on_delta=None, telegram_message_ids: list = None) -> str:
+    """
+    Отримати відповідь від OpenAI на серію повідомлень користувача
+
+    Кожне повідомлення зберігається окремим рядком (зі своїм telegram_message_id),
+    а в OpenAI серія йде одним повідомленням. Якщо передано on_delta і стрімінг
+    увімкнено, фрагменти відповіді передаються в on_delta в міру надходження.
+    Повертає повний текст або None, якщо всі повідомлення вже збережено
+    (повторна доставка, оброблена іншим процесом).
+    """
+    telegram_message_ids = telegram_message_ids or [None] * len(user_messages)
+    user_message = "\n".join(user_messages)
+    try:
+        # OpenAI недоступний: відповідаємо одразу, повідомлення не зберігаємо (користувач надішле його знову)
+        if not openai_gateway.available():
+            return config.OPENAI_UNAVAILABLE_MESSAGE
+
+        # Історію відновлюємо з БД до збереження, щоб нове повідомлення не потрапило в неї двічі
+        await history_store.load(user_id)
+
+        # Перед запитом до OpenAI потрібна лише відповідь, чи не вичерпано ліміт.
+        # Далеко від ліміту повідомлення зберігаються паралельно із запитом,
+        # поблизу - як раніше, до запиту
+        near_limit = await db.may_reach_limit(user_id, user_message)
+        save_tasks = [
+            save_in_order(user_id, "user", text, message_id)
+            for text, message_id in zip(user_messages, telegram_message_ids)
+        ]
+        if near_limit:
+            saved = await asyncio.gather(*save_tasks)
+            if all(result == 'duplicate' for result in saved):
+                return None
+            if 'limit_reached' in saved:
+                return await limit_reached_message(user_id)
 
-        # Отримуємо відповідь
-        ai_message = response.choices[0].message.content
+        # Історія для контексту (обрізана під бюджет токенів) разом з новим повідомленням.
+        # До самої історії воно додається лише після збереження, тож дублікат туди не потрапить
+        history = await history_store.get(user_id, pending=user_message)
 
-        # Зберігаємо відповідь асистента
-        await db.save_message(user_id, "assistant", ai_message)
+        # Запит до OpenAI API
+        completion = asyncio.create_task(request_completion(history, on_delta))
+        if not near_limit:
+            saved = await asyncio.gather(*save_tasks)
+            if all(result == 'duplicate' for result in saved):
+                completion.cancel()
+                return None
+            if 'limit_reached' in saved:
+                # Швидка перевірка помилилась (одночасні повідомлення) - відповідь вже не потрібна
+                completion.cancel()
+                return await limit_reached_message(user_id)
+
+        # Додаємо до історії повідомлення користувача, які справді збережено
+        await history_store.add(user_id, "user", "\n".join(
+            text for text, result in zip(user_messages, saved) if result != 'duplicate'
+        ))
+
+        ai_message, usage = await completion
+
+        # Додаємо відповідь асистента до історії (кількість токенів - з usage, без кодування)
+        await history_store.add(
+            user_id, "assistant", ai_message, tokens=usage.completion_tokens if usage else None
+        )
 
-        # Додаємо відповідь асистента до історії
-        add_message_to_history(user_id, "assistant", ai_message)
+        # Зберігаємо відповідь асистента у фоні: користувач не чекає на запис у БД,
+        # а наступне повідомлення користувача збережеться вже після неї
+        save_in_order(user_id, "assistant", ai_message)
 
         return ai_message
 
+    except (CircuitOpenError, DeadlineExceededError) as e:
+        logger.warning(f"OpenAI не відповів користувачу {user_id}: {e}")
+        return config.OPENAI_UNAVAILABLE_MESSAGE
     except Exception as e:
         logger.error(f"Помилка при отриманні відповіді від OpenAI: {e}")
         return "Przepraszamy, wystąpił błąd podczas przetwarzania Twojego zapytania. Spróbuj ponownie."
@@ -305,7 +705,9 @@ async def cmd_export(message: types.Message):
 
     await message.answer("⏳ Eksportuję dane... Może to chwilę potrwać.")
 
+    started = time.perf_counter()
     result = await exporter.export_user_data(user_id)
+    EXPORT_SECONDS.observe(time.perf_counter() - started)
 
     if not result['success']:
         error = result.get('error', 'Nieznany błąd')
@@ -313,6 +715,7 @@ async def cmd_export(message: types.Message):
         return
 
     stats = result['stats']
+    EXPORT_BYTES.observe(sum(os.path.getsize(path) for path in result['files']))
 
     response = (
         f"✅ Eksport zakończony!\n\n"
@@ -330,88 +733,251 @@ async def cmd_export(message: types.Message):
 
     await message.answer(response, parse_mode="Markdown")
 
+    # Файли, більші за ліміт Telegram, ділимо на частини по цілих розмовах
+    files = []
+    for path in result['files']:
+        if os.path.getsize(path) > config.TELEGRAM_MAX_UPLOAD_BYTES:
+            files.extend(exporter.split_file(path, config.TELEGRAM_MAX_UPLOAD_BYTES, config.EXPORT_COMPRESSION))
+        else:
+            files.append(path)
+
     # Відправляємо файл користувачу
-    try:
-        doc = types.FSInputFile(result['file'])
-        await message.answer_document(doc, caption="📎 Twój plik dla Fine-tuning")
-    except Exception as e:
-        logger.error(f"Помилка відправки файлу: {e}")
+    for number, path in enumerate(files, start=1):
+        caption = "📎 Twój plik dla Fine-tuning"
+        if len(files) > 1:
+            caption += f" (część {number}/{len(files)})"
+        try:
+            doc = types.FSInputFile(path)
+            await message.answer_document(doc, caption=caption)
+        except Exception as e:
+            logger.error(f"Помилка відправки файлу: {e}")
+            await message.answer(
+                "⚠️ Nie udało się wysłać pliku przez Telegram.\n"
+                f"Plik zapisany lokalnie: {path}"
+            )
+
+
+@dp.message(Command("search"))
+async def cmd_search(message: types.Message):
+    """Повнотекстовий пошук по зібраних повідомленнях (тільки для адміністраторів)"""
+    if message.from_user.id not in config.ADMIN_USER_IDS:
+        await message.answer("⛔ To polecenie jest dostępne tylko dla administratorów.")
+        return
+
+    # /search [user=<id>] [before=<id>] fraza
+    args = message.text.split()[1:]
+    options = {}
+    while args and args[0].partition('=')[0] in ('user', 'before') and args[0].partition('=')[2].isdigit():
+        key, _, value = args.pop(0).partition('=')
+        options[key] = int(value)
+    query = ' '.join(args)
+
+    if not query:
         await message.answer(
-            "⚠️ Nie udało się wysłać pliku przez Telegram.\n"
-            f"Plik zapisany lokalnie: {result['file']}"
+            "Użyj:\n"
+            "/search fraza - szukaj we wszystkich wiadomościach\n"
+            "/search user=<id> fraza - tylko wiadomości użytkownika\n"
+            "/search \"dokładna fraza\" -wykluczone"
         )
+        return
+
+    results = await db.search_messages(
+        query, user_id=options.get('user'), limit=config.SEARCH_PAGE_SIZE, before_id=options.get('before')
+    )
+    if not results:
+        await message.answer("🔍 Nic nie znaleziono.")
+        return
+
+    lines = [f"🔍 Wyniki dla: {query}\n"]
+    for row in results:
+        content = row['content'] if len(row['content']) <= 200 else row['content'][:200] + "…"
+        filtered = " · odfiltrowana" if row['is_filtered'] else ""
+        lines.append(
+            f"#{row['id']} · user {row['user_id']} · {row['role']} · "
+            f"{row['timestamp']:%Y-%m-%d %H:%M}{filtered}\n{content}\n"
+        )
+
+    if len(results) == config.SEARCH_PAGE_SIZE:
+        user_option = f"user={options['user']} " if 'user' in options else ""
+        lines.append(f"Dalej: /search {user_option}before={results[-1]['id']} {query}")
+
+    # Без parse_mode: у текстах користувачів можуть бути символи розмітки
+    await message.answer("\n".join(lines))
 
 
 @dp.message(F.text)
 async def handle_message(message: types.Message):
     """Обробник текстових повідомлень"""
-    user_id = message.from_user.id
-    user_message = message.text
+    # Відповідь формує черга користувача: серія повідомлень - один запит до AI.
+    # У чергу - одразу, без запитів до Telegram, щоб не переставити повідомлення місцями
+    user_actors.submit(message.from_user.id, message)
 
-    # Показуємо, що бот "друкує"
-    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
 
-    # Отримуємо відповідь від AI
-    ai_response = await get_ai_response(user_id, user_message)
+async def show_typing(chat_id: int):
+    """Показати, що бот "друкує" (помилка не заважає відповіді)"""
+    try:
+        await bot.send_chat_action(chat_id=chat_id, action="typing")
+    except Exception as e:
+        logger.warning(f"Не вдалося показати набір тексту в чаті {chat_id}: {e}")
+
+
+async def reply_to_messages(user_id: int, messages: list):
+    """Відповісти на серію повідомлень користувача одним запитом до AI"""
+    with REPLY_SECONDS.time():
+        # Показуємо, що бот "друкує" - паралельно з запитом до AI
+        run_in_background(show_typing(messages[-1].chat.id), name='show_typing')
+
+        # Отримуємо відповідь від AI (при стрімінгу вона з'являється частинами)
+        reply = StreamingReply(messages[-1], config.STREAM_EDIT_INTERVAL_SECONDS)
+        # id повідомлення унікальний лише в межах чату: ключ (user_id, id) надійний тільки в приватному
+        telegram_message_ids = None
+        if config.MESSAGE_DEDUP_ENABLED:
+            telegram_message_ids = [
+                message.message_id if message.chat.type == 'private' else None for message in messages
+            ]
+        ai_response = await get_ai_response(user_id, [message.text for message in messages],
+                                            on_delta=reply.add, telegram_message_ids=telegram_message_ids)
+        if ai_response is None:
+            # Повторна доставка: відповідь на це повідомлення вже надіслано
+            await reply.cancel()
+            return
 
-    # Відправляємо відповідь користувачу
-    await message.answer(ai_response)
+        # Відправляємо відповідь користувачу
+        await reply.finish(ai_response)
+
+
+# Черги повідомлень користувачів
+user_actors = UserActors(reply_to_messages, config.COALESCE_DEBOUNCE_MS, config.COALESCE_MAX_WAIT_MS)
+
+
+def generation_overloaded() -> bool:
+    """Чи досягнуто ліміту відповідей, що генеруються одночасно"""
+    return 0 < config.WEBHOOK_MAX_ACTIVE_USERS <= user_actors.active_users
+
+
+# Метрики компонентів у /metrics: перелічені ключі - counter, решта - gauge
+registry.add_source('bot_background_tasks', lambda: background_metrics, 'Фонові задачі бота',
+                    counters=('started', 'completed', 'failed'))
+registry.add_source('bot_user_actors', lambda: {**user_actors.metrics, 'active_users': user_actors.active_users},
+                    'Черги повідомлень користувачів', counters=('messages', 'batches', 'coalesced', 'failed_batches'))
+registry.add_source('bot_updates', update_deduplicator.get_metrics, 'Оновлення Telegram і відкинуті повторні доставки',
+                    counters=('updates', 'duplicates'))
+registry.add_source('openai_usage', lambda: openai_usage, 'Токени запитів до OpenAI за полем usage',
+                    counters=('requests', 'prompt_tokens', 'completion_tokens'))
+registry.add_source('openai_timings', lambda: openai_timings, 'Час до першого токена і повний час відповіді OpenAI',
+                    counters=('requests', 'streamed', 'ttft_ms_total', 'total_ms_total'))
+registry.add_source('openai_gateway', openai_gateway.get_metrics, 'Запити через шлюз OpenAI, ліміт і запобіжник',
+                    counters=('requests', 'succeeded', 'failed', 'retries', 'rate_limited', 'transient_errors',
+                              'deadline_exceeded', 'limiter_increases', 'limiter_decreases', 'limiter_waited',
+                              'circuit_opened', 'circuit_rejected'))
+registry.add_source('reminders_last_run', lambda: last_reminder_run, 'Остання розсилка нагадувань')
+registry.add_source('db', db.get_metrics, "Пул з'єднань і помилки збереження",
+                    counters=('save_errors', 'duplicate_messages'))
+registry.add_source('db_stats_cache', lambda: db.stats_cache.get_metrics() if db.stats_cache else {},
+                    'Кеш статистики користувачів', counters=('hits', 'misses', 'invalidations'))
+registry.add_source('db_write_behind', lambda: db.write_behind.get_metrics() if db.write_behind else {},
+                    'Відкладений запис повідомлень',
+                    counters=('flush_count', 'flush_failures', 'rows_flushed', 'rows_dropped'))
+registry.add_source('tokenizer', token_counter.get_metrics, 'Підрахунок токенів і його кеш',
+                    counters=('cache_hits', 'cache_misses', 'encoded_texts', 'encode_seconds'))
+registry.add_source('history', history_store.get_metrics, 'Історії розмов і розмір контексту OpenAI',
+                    counters=('rehydrations', 'rehydrate_failures', 'context_requests', 'context_tokens',
+                              'untrimmed_tokens', 'saved_tokens', 'trimmed_messages', 'hits',
+                              'lru_evictions', 'idle_evictions'))
 
 
 async def send_hourly_reminders():
     """Функція для відправки щогодинних нагадувань"""
     try:
-        # Отримуємо список користувачів з увімкненими нагадуваннями
-        user_ids = await db.get_users_for_reminders()
+        async def send_reminder(user_id: int):
+            # Вибираємо випадкове повідомлення
+            await bot.send_message(user_id, random.choice(config.REMINDER_MESSAGES))
+
+        # Користувачів захоплюємо пакетами: інші екземпляри бота в цей час беруть інші пакети
+        started = time.perf_counter()
+        totals = {'users': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'retry_after_seconds': 0.0, 'batches': 0}
+        # Один ліміт на весь запуск (а не на пакет); частка ліміту бота для цього екземпляра
+        bucket = TokenBucket(config.REMINDER_RATE_PER_SECOND / config.REMINDER_INSTANCES)
+        while True:
+            user_ids = await db.claim_reminders(
+                WORKER_ID, config.REMINDER_CLAIM_BATCH, config.REMINDER_CLAIM_LEASE_SECONDS
+            )
+            if not user_ids:
+                break
+
+            # Розсилка з глобальним лімітом швидкості, час нагадування записується пакетами
+            stats = await fan_out(
+                user_ids,
+                send_reminder,
+                db.update_last_reminders,
+                bucket=bucket,
+                concurrency=config.REMINDER_CONCURRENCY,
+                batch_size=config.REMINDER_BATCH_SIZE,
+            )
+            totals['batches'] += 1
+            for key in ('users', 'sent', 'failed', 'retried', 'retry_after_seconds'):
+                totals[key] += stats[key]
 
-        if not user_ids:
+        elapsed = time.perf_counter() - started
+        REMINDER_RUN_SECONDS.observe(elapsed)
+        if not totals['users']:
             logger.info("Немає користувачів для нагадувань")
             return
 
-        logger.info(f"Відправка нагадувань для {len(user_ids)} користувачів")
-
-        for user_id in user_ids:
-            try:
-                # Вибираємо випадкове повідомлення
-                reminder_text = random.choice(config.REMINDER_MESSAGES)
-
-                # Відправляємо нагадування
-                await bot.send_message(user_id, reminder_text)
-
-                # Оновлюємо час останнього нагадування
-                await db.update_last_reminder(user_id)
-
-                logger.info(f"Нагадування відправлено користувачу {user_id}")
-
-                # Невелика затримка між повідомленнями
-                await asyncio.sleep(0.5)
+        totals['duration_seconds'] = round(elapsed, 2)
+        totals['per_second'] = round(totals['sent'] / elapsed, 2) if elapsed else 0.0
+        last_reminder_run.update(totals, finished_at=time.time())
 
-            except Exception as e:
-                logger.error(f"Помилка відправки нагадування користувачу {user_id}: {e}")
+        logger.info(
+            f"Нагадування відправлено: {totals['sent']}/{totals['users']} за {totals['duration_seconds']} с "
+            f"({totals['per_second']} повідомлень/с), помилок {totals['failed']}, повторів після 429 {totals['retried']}"
+        )
 
     except Exception as e:
         logger.error(f"Помилка в send_hourly_reminders: {e}")
 
 
-async def main():
-    """Головна функція запуску бота"""
-    logger.info("Бот запускається...")
+async def main(worker_index: int = 0, ready=None):
+    """
+    Головна функція запуску бота
+
+    Args:
+        worker_index: Номер процесу при WEB_WORKERS > 1. Тільки основний (0)
+            встановлює webhook і запускає планувальник нагадувань
+        ready: multiprocessing.Event, що встановлюється коли процес готовий
+    """
+    global scheduler, webhook_handler
+    primary = worker_index == 0
+    logger.info("Бот запускається..." if primary else f"Воркер {worker_index} запускається...")
+    main_started = time.perf_counter()
     try:
+        # Токенізатор: у швидкому режимі вантажимо у фоні, інакше одразу
+        if config.FAST_STARTUP:
+            token_counter.warm()
+        else:
+            started = time.perf_counter()
+            token_counter.load()
+            get_openai_client()
+            startup_timings['tokenizer'] = time.perf_counter() - started
+
         # Підключаємося до бази даних
         await db.connect()
+        startup_timings.update(db.startup_timings)
+
+        # Налаштовуємо scheduler для нагадувань (один на всі процеси)
+        if primary:
+            scheduler = AsyncIOScheduler()
+            scheduler.add_job(
+                send_hourly_reminders,
+                trigger=IntervalTrigger(hours=config.REMINDER_INTERVAL_HOURS),
+                id='hourly_reminders',
+                name='Щогодинні нагадування',
+                replace_existing=True
+            )
 
-        # Налаштовуємо scheduler для нагадувань
-        scheduler.add_job(
-            send_hourly_reminders,
-            trigger=IntervalTrigger(hours=config.REMINDER_INTERVAL_HOURS),
-            id='hourly_reminders',
-            name='Щогодинні нагадування',
-            replace_existing=True
-        )
-
-        # Запускаємо scheduler
-        scheduler.start()
-        logger.info(f"✅ Планувальник запущено. Нагадування кожні {config.REMINDER_INTERVAL_HOURS} год.")
+            # Запускаємо scheduler
+            scheduler.start()
+            logger.info(f"✅ Планувальник запущено. Нагадування кожні {config.REMINDER_INTERVAL_HOURS} год.")
 
         # ----------Для локального використання бота--------------
         # # Видаляємо старі апдейти
@@ -430,55 +996,176 @@ async def main():
             webhook_path = f"/webhook/{config.TELEGRAM_TOKEN}"
             webhook_url = f"{config.WEBHOOK_URL}{webhook_path}"
 
-            await bot.set_webhook(
-                url=webhook_url,
-                drop_pending_updates=True
-            )
-            logger.info(f"Webhook встановлено: {webhook_url}")
+            if primary:
+                started = time.perf_counter()
+                await bot.set_webhook(
+                    url=webhook_url,
+                    drop_pending_updates=True
+                )
+                startup_timings['webhook'] = time.perf_counter() - started
+                logger.info(f"Webhook встановлено: {webhook_url}")
 
             # Створюємо web додаток
             app = web.Application()
 
             # Health check endpoint (щоб Render бачив що сервіс живий)
             async def health_check(request):
-                return web.json_response({"status": "ok", "bot": "running"})
+                return web.json_response({
+                    "status": "ok",
+                    "bot": "running",
+                    "startup_ms": {name: round(seconds * 1000, 1) for name, seconds in startup_timings.items()},
+                    "webhook_queue": webhook_handler.get_metrics(),
+                })
+
+            # Метрики у форматі Prometheus (кожен воркер віддає свої, з міткою worker;
+            # при кількох воркерах надійно лише через окремий порт METRICS_PORT + номер воркера)
+            async def metrics_endpoint(request):
+                if config.METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {config.METRICS_TOKEN}":
+                    return web.Response(status=401, text="Unauthorized")
+                return web.Response(
+                    body=registry.render().encode('utf-8'),
+                    headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+                )
 
             app.router.add_get("/", health_check)
             app.router.add_get("/health", health_check)
+            app.router.add_get("/metrics", metrics_endpoint)
 
-            # Налаштовуємо webhook handler
-            webhook_requests_handler = SimpleRequestHandler(
+            # Налаштовуємо webhook handler: відповідь Telegram одразу, обробка з черги
+            webhook_handler = QueuedRequestHandler(
                 dispatcher=dp,
                 bot=bot,
+                workers=config.WEBHOOK_QUEUE_WORKERS,
+                max_size=config.WEBHOOK_QUEUE_SIZE,
+                busy_text=config.BUSY_MESSAGE,
+                overloaded=generation_overloaded,
             )
-            webhook_requests_handler.register(app, path=webhook_path)
+            webhook_handler.register(app, path=webhook_path)
+            registry.add_source('webhook_queue', webhook_handler.get_metrics, 'Черга оновлень webhook',
+                                counters=('received', 'processed', 'failed', 'dropped_queue_full',
+                                          'dropped_overloaded', 'busy_replies'))
+            if config.WEB_WORKERS > 1:
+                registry.const_labels['worker'] = str(worker_index)
             setup_application(app, dp, bot=bot)
 
             # Запускаємо web сервер
             runner = web.AppRunner(app)
             await runner.setup()
-            site = web.TCPSite(runner, host="0.0.0.0", port=config.PORT)
+            # При кількох процесах ядро розподіляє з'єднання між їхніми сокетами (SO_REUSEPORT)
+            site = web.TCPSite(runner, host="0.0.0.0", port=config.PORT, reuse_port=config.WEB_WORKERS > 1 or None)
             await site.start()
+            if config.METRICS_PORT:
+                metrics_app = web.Application()
+                metrics_app.router.add_get("/metrics", metrics_endpoint)
+                metrics_runner = web.AppRunner(metrics_app)
+                await metrics_runner.setup()
+                await web.TCPSite(metrics_runner, host="0.0.0.0", port=config.METRICS_PORT + worker_index).start()
+                logger.info(f"Метрики воркера {worker_index} на порті {config.METRICS_PORT + worker_index}")
+            if ready is not None:
+                ready.set()
 
             logger.info(f"Web сервер запущено на порті {config.PORT}")
             logger.info("Бот працює у webhook режимі. Для зупинки натисніть Ctrl+C")
 
+            startup_timings['total'] = startup_timings['imports'] + time.perf_counter() - main_started
+            log_startup_timings()
+
+            # Імпортуємо openai у фоні, щоб перший запит не чекав на нього
+            if config.FAST_STARTUP:
+                await asyncio.to_thread(importlib.import_module, 'openai')
+
             # Тримаємо сервер живим
             await asyncio.Event().wait()
 
         else:
             # POLLING режим (для локальної розробки)
             logger.info("Запуск у POLLING режимі (локальна розробка)")
+            started = time.perf_counter()
             await bot.delete_webhook(drop_pending_updates=True)
+            startup_timings['webhook'] = time.perf_counter() - started
+            startup_timings['total'] = startup_timings['imports'] + time.perf_counter() - main_started
+            log_startup_timings()
             await dp.start_polling(bot)
 
     except Exception as e:
         logger.error(f"Помилка при запуску бота: {e}")
     finally:
-        scheduler.shutdown()
+        if scheduler and scheduler.running:
+            scheduler.shutdown()
+        # Дописуємо оновлення з черги, фонові та відкладені повідомлення перед закриттям пулу
+        if webhook_handler:
+            await webhook_handler.drain()
+        await drain_background_tasks()
+        await db.flush_writes()
         await db.close()
         await bot.session.close()
 
 
+def run_worker(worker_index: int, ready):
+    """Точка входу процесу-воркера"""
+    # Окрема група процесів: Ctrl+C отримує тільки головний процес і пересилає його один раз
+    os.setpgrp()
+    asyncio.run(main(worker_index, ready))
+
+
+def run_workers(count: int):
+    """
+    Запуск кількох процесів бота на одному порті
+
+    Основний воркер стартує першим (схема БД, webhook, планувальник), решта -
+    після того як він почав приймати запити. SIGTERM від хостингу пересилається
+    воркерам як SIGINT, щоб кожен дописав відкладені повідомлення і закрив пул.
+    """
+    if config.WRITE_BEHIND_REQUESTED:
+        logger.warning("WRITE_BEHIND_ENABLED ігнорується при WEB_WORKERS > 1: лічильники у пам'яті кожного процесу розійдуться")
+    logger.warning(
+        "WEB_WORKERS > 1: повідомлення одного користувача можуть обробляти різні воркери - "
+        "порядок відповідей і злиття серій гарантуються лише в межах процесу"
+    )
+    if not config.METRICS_PORT:
+        logger.warning("WEB_WORKERS > 1 без METRICS_PORT: /metrics віддає випадковий воркер, rate() по ньому некоректний")
+    context = multiprocessing.get_context('spawn')
+    workers = []
+
+    def start(index: int):
+        ready = context.Event()
+        process = context.Process(target=run_worker, args=(index, ready), name=f'bot-worker-{index}')
+        process.start()
+        workers.append(process)
+        return ready
+
+    def forward(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, forward)
+    try:
+        ready = start(0)
+        while not ready.wait(timeout=1):
+            if not workers[0].is_alive():
+                raise RuntimeError("Основний воркер завершився під час запуску")
+        for index in range(1, count):
+            start(index)
+        logger.info(f"Запущено {count} воркерів на порті {config.PORT}")
+
+        # Якщо будь-який воркер впав - зупиняємо всі, хостинг перезапустить сервіс
+        multiprocessing.connection.wait([process.sentinel for process in workers])
+        logger.error("Воркер завершився, зупиняємо решту")
+    except KeyboardInterrupt:
+        logger.info("Зупинка воркерів...")
+    finally:
+        for process in workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if config.WEBHOOK_URL and config.WEB_WORKERS > 1:
+        run_workers(config.WEB_WORKERS)
+    else:
+        if config.WEB_WORKERS > 1:
+            logger.warning("WEB_WORKERS > 1 підтримується тільки у webhook режимі, запуск одного процесу")
+        asyncio.run(main())
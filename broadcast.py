@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Глобальний ліміт швидкості відправки
+
+    Токени поповнюються зі швидкістю rate за секунду до capacity. Після 429
+    від Telegram pause() зупиняє видачу токенів для всіх відправників, бо
+    обмеження flood control діє на бота цілком, а не на окремий чат.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    self.updated = time.monotonic()
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def fan_out(user_ids: list, send, on_sent, bucket: TokenBucket, concurrency: int,
+                  batch_size: int, max_retries: int = 3) -> dict:
+    """
+    Розіслати повідомлення багатьом користувачам
+
+    Args:
+        send: async send(user_id) - відправка одному користувачу
+        on_sent: async on_sent(user_ids) - викликається пакетами по batch_size успішних відправок
+        bucket: Ліміт швидкості для всіх відправників (один на всю розсилку,
+            щоб він не поповнювався з кожним викликом)
+        concurrency: Скільки відправок одночасно
+
+    Returns:
+        dict зі статистикою розсилки
+    """
+    queue = iter(user_ids)
+    pending = []
+    flushes = []
+    stats = {'users': len(user_ids), 'sent': 0, 'failed': 0, 'retried': 0, 'retry_after_seconds': 0.0}
+    started = time.perf_counter()
+
+    async def flush(batch: list):
+        try:
+            await on_sent(batch)
+        except Exception as e:
+            logger.error(f"Помилка збереження результатів розсилки ({len(batch)} користувачів): {e}")
+
+    async def worker():
+        nonlocal pending
+        for user_id in queue:
+            for attempt in range(max_retries + 1):
+                await bucket.acquire()
+                try:
+                    await send(user_id)
+                except TelegramRetryAfter as e:
+                    # Flood control: чекаємо скільки просить Telegram і пробуємо ще раз
+                    bucket.pause(e.retry_after)
+                    stats['retried'] += 1
+                    stats['retry_after_seconds'] += e.retry_after
+                    if attempt < max_retries:
+                        continue
+                    stats['failed'] += 1
+                    logger.error(f"Повідомлення користувачу {user_id} не відправлено: ліміт Telegram")
+                except Exception as e:
+                    stats['failed'] += 1
+                    logger.error(f"Помилка відправки повідомлення користувачу {user_id}: {e}")
+                else:
+                    stats['sent'] += 1
+                    pending.append(user_id)
+                    if len(pending) >= batch_size:
+                        batch, pending = pending, []
+                        flushes.append(asyncio.create_task(flush(batch)))
+                break
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    if pending:
+        flushes.append(asyncio.create_task(flush(pending)))
+    await asyncio.gather(*flushes)
+
+    elapsed = time.perf_counter() - started
+    stats['duration_seconds'] = round(elapsed, 2)
+    stats['per_second'] = round(stats['sent'] / elapsed, 2) if elapsed else 0.0
+    return stats
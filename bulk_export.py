@@ -0,0 +1,195 @@
+"""
+Масовий експорт усіх користувачів із завершеним збором даних у шардовані JSONL файли.
+
+Користувачі експортуються паралельно (не більше --concurrency з'єднань з БД),
+JSON кодується в пулі процесів, кожен користувач потрапляє в шард user_id % --shards.
+Наприкінці записується manifest.json з кількостями, токенами та контрольними сумами.
+
+Запуск:
+    python bulk_export.py --output-dir exports/2024-01-01 --shards 8 --concurrency 4 --workers 4
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from database import db
+from export_jsonl import ConversationGrouper, DataExporter
+
+logger = logging.getLogger(__name__)
+
+# Скільки розмов відправляти в процес-кодувальник за раз
+ENCODE_CHUNK_CONVERSATIONS = 256
+
+
+def encode_conversations(conversations: list) -> bytes:
+    """Кодування розмов у рядки JSONL (виконується в окремому процесі)"""
+    lines = []
+    for conversation in conversations:
+        messages = [{'role': role, 'content': content} for role, content in conversation]
+        formatted = DataExporter.format_conversation_for_finetuning(messages)
+        lines.append(json.dumps(formatted, ensure_ascii=False))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class Shard:
+    """Один вихідний файл з контрольною сумою та лічильниками"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.lock = asyncio.Lock()
+        self.sha256 = hashlib.sha256()
+        self.users = 0
+        self.conversations = 0
+        self.messages = 0
+        self.tokens = 0
+        self.bytes = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.bytes += len(data)
+
+    def close(self):
+        self.file.close()
+
+    def manifest(self) -> dict:
+        return {
+            'file': os.path.basename(self.path),
+            'users': self.users,
+            'conversations': self.conversations,
+            'messages': self.messages,
+            'tokens': self.tokens,
+            'bytes': self.bytes,
+            'sha256': self.sha256.hexdigest(),
+        }
+
+
+class BulkExporter:
+    """Паралельний експорт багатьох користувачів у шарди"""
+
+    def __init__(self, output_dir: str, shards: int, concurrency: int, workers: int):
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.workers = workers
+        os.makedirs(output_dir, exist_ok=True)
+        self.shards = [
+            Shard(os.path.join(output_dir, f'finetuning_data_shard_{i:03d}_of_{shards:03d}.jsonl'))
+            for i in range(shards)
+        ]
+        self.failed_users = []
+
+    async def export_user(self, user: dict, executor: ProcessPoolExecutor):
+        """Експорт одного користувача: читаємо курсором, кодуємо пакетами в пулі процесів"""
+        loop = asyncio.get_running_loop()
+        shard = self.shards[user['user_id'] % len(self.shards)]
+        grouper = ConversationGrouper()
+        chunk = []
+        encoded = []
+        conversations = messages = 0
+
+        def take(conversation):
+            nonlocal conversations, messages
+            chunk.append([(msg['role'], msg['content']) for msg in conversation])
+            conversations += 1
+            messages += len(conversation)
+
+        async for msg in db.iter_user_messages(user['user_id']):
+            conversation = grouper.add(msg)
+            if conversation:
+                take(conversation)
+            if len(chunk) >= ENCODE_CHUNK_CONVERSATIONS:
+                encoded.append(loop.run_in_executor(executor, encode_conversations, chunk))
+                chunk = []
+        conversation = grouper.finish()
+        if conversation:
+            take(conversation)
+        if chunk:
+            encoded.append(loop.run_in_executor(executor, encode_conversations, chunk))
+
+        # Рядки користувача пишемо в шард підряд: дані одного користувача обмежені лімітом токенів,
+        # тож тримати їх у пам'яті до запису недорого, а збій не залишає в шарді часткових даних
+        data = await asyncio.gather(*encoded)
+        async with shard.lock:
+            for part in data:
+                shard.write(part)
+            shard.users += 1
+            shard.conversations += conversations
+            shard.messages += messages
+            shard.tokens += user['total_tokens']
+
+    async def run(self, users: list) -> dict:
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            async def guarded(user: dict):
+                async with semaphore:
+                    try:
+                        await self.export_user(user, executor)
+                    except Exception as e:
+                        logger.error(f"Помилка експорту для користувача {user['user_id']}: {e}")
+                        self.failed_users.append(user['user_id'])
+
+            await asyncio.gather(*(guarded(user) for user in users))
+
+        for shard in self.shards:
+            shard.close()
+
+        elapsed = time.perf_counter() - started
+        total_bytes = sum(shard.bytes for shard in self.shards)
+        manifest = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'users': sum(shard.users for shard in self.shards),
+            'failed_users': self.failed_users,
+            'conversations': sum(shard.conversations for shard in self.shards),
+            'messages': sum(shard.messages for shard in self.shards),
+            'tokens': sum(shard.tokens for shard in self.shards),
+            'bytes': total_bytes,
+            'duration_seconds': round(elapsed, 3),
+            'users_per_second': round(len(users) / elapsed, 2) if elapsed else 0.0,
+            'mb_per_second': round(total_bytes / elapsed / 1e6, 2) if elapsed else 0.0,
+            'shards': [shard.manifest() for shard in self.shards],
+        }
+
+        with open(os.path.join(self.output_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        return manifest
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output-dir', default=f"exports/{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=4, help="Скільки користувачів (з'єднань з БД) одночасно")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Процеси для кодування JSON')
+    parser.add_argument('--min-tokens', type=int, default=0, help='Мінімум токенів у користувача')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    await db.connect(max_size=args.concurrency + 1)
+    try:
+        users = await db.get_completed_users(args.min_tokens)
+        logger.info(f"Користувачів для експорту: {len(users)}")
+
+        exporter = BulkExporter(args.output_dir, args.shards, args.concurrency, args.workers)
+        manifest = await exporter.run(users)
+
+        logger.info(
+            f"Експорт завершено: {manifest['users']} користувачів, {manifest['conversations']} розмов, "
+            f"{manifest['bytes'] / 1e6:.1f} MB за {manifest['duration_seconds']} с "
+            f"({manifest['users_per_second']} users/s, {manifest['mb_per_second']} MB/s) -> {args.output_dir}"
+        )
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
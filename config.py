@@ -17,9 +17,54 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 # Якщо встановлено - бот працює в webhook режимі (на Render)
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 10000))
+# Процеси, що слухають один порт (SO_REUSEPORT). Тільки для webhook режиму
+# Понад 1 - історії розмов у Postgres, кеш статистики вимкнено.
+# Черга користувача (UserActors, save_in_order) діє лише в межах процесу: ядро розподіляє
+# з'єднання між воркерами, тож сусідні повідомлення користувача можуть обробитись паралельно
+# в різних процесах - без злиття серій, з паралельними запитами до OpenAI, а рядки messages
+# і conversation_history можуть записатись не в порядку відповідей
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))
+# /metrics на основному порті надійний лише при WEB_WORKERS=1: кожен запит потрапляє до
+# випадкового воркера, і лічильники однієї цілі Prometheus стрибають між процесами.
+# Якщо задано METRICS_PORT, воркер N додатково віддає свої /metrics на METRICS_PORT + N
+# (окрема ціль Prometheus на кожен воркер)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# Якщо задано, /metrics вимагає заголовок Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN') or None
+# Черга webhook: Telegram отримує відповідь одразу, оновлення обробляють воркери
+WEBHOOK_QUEUE_WORKERS = int(os.getenv('WEBHOOK_QUEUE_WORKERS', 8))  # Скільки оновлень обробляти одночасно
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))  # Більше - відповідаємо "зайнято"
+WEBHOOK_MAX_ACTIVE_USERS = int(os.getenv('WEBHOOK_MAX_ACTIVE_USERS', 500))  # Відповідей, що генеруються одночасно; 0 - без обмеження
+BUSY_MESSAGE = "⏳ Mam teraz bardzo dużo rozmów. Napisz do mnie ponownie za chwilę!"
+
+# Повторні доставки оновлень Telegram
+UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', 20000))  # Скільки останніх ключів оновлень пам'ятати
+# Зберігати id повідомлення Telegram: унікальний індекс у БД відкидає дублікати і між процесами.
+# Лише для приватних чатів (id повідомлення унікальний тільки в межах чату, а ключ - user_id).
+# При WRITE_BEHIND_ENABLED id не записується (COPY пакета впав би на одному дублікаті),
+# тож дублікати відкидає тільки UPDATE_DEDUP_SIZE у пам'яті процесу
+MESSAGE_DEDUP_ENABLED = os.getenv('MESSAGE_DEDUP_ENABLED', 'true').lower() == 'true'
+
+# Адміністратори (id через кому) - доступ до службових команд, наприклад /search
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+SEARCH_PAGE_SIZE = 10  # Результатів на сторінку /search
 
 # Налаштування OpenAI
 OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_STREAMING = os.getenv('OPENAI_STREAMING', 'true').lower() == 'true'  # Показувати відповідь частинами
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv('STREAM_EDIT_INTERVAL_SECONDS', 1.0))  # Як часто редагувати повідомлення
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None  # Інший сервер з API OpenAI (наприклад, тестовий)
+# Шлюз запитів до OpenAI: ліміт одночасних запитів підлаштовується під відповіді 429
+OPENAI_CONCURRENCY_INITIAL = int(os.getenv('OPENAI_CONCURRENCY_INITIAL', 8))
+OPENAI_CONCURRENCY_MIN = 1
+OPENAI_CONCURRENCY_MAX = int(os.getenv('OPENAI_CONCURRENCY_MAX', 64))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 3))  # Повтори після 429, 5xx і таймаутів
+OPENAI_RETRY_BASE_DELAY = 0.5  # Затримка першого повтору (с), далі подвоюється, з випадковим розкидом
+OPENAI_RETRY_MAX_DELAY = 8.0
+OPENAI_DEADLINE_SECONDS = float(os.getenv('OPENAI_DEADLINE_SECONDS', 45))  # Черга, повтори і очікування першої відповіді (показаний стрім не обривається)
+OPENAI_BREAKER_FAILURES = 5  # Збоїв поспіль (5xx, таймаути), після яких запити тимчасово не виконуються
+OPENAI_BREAKER_RESET_SECONDS = 30  # Через скільки секунд пробувати знову
+OPENAI_UNAVAILABLE_MESSAGE = "⏳ Serwis AI jest chwilowo przeciążony. Spróbuj ponownie za minutę."
 SYSTEM_PROMPT = """
 Jesteś przyjazną i empatyczną asystentką AI, działającą jako bot w Telegramie. Twoim głównym zadaniem jest prowadzenie swobodnej, angażującej i naturalnej rozmowy w języku polskim.
 
@@ -37,14 +82,83 @@ Zasady konwersacji:
 # Ліміти токенів для збору даних
 MIN_TOKEN_LIMIT = 200000
 MAX_TOKEN_LIMIT = 300000
+# Запас для швидкої перевірки ліміту: ближче до ліміту повідомлення зберігається до запиту в OpenAI
+LIMIT_CHECK_MARGIN_TOKENS = 2000
 
 # Фільтрація "шуму"
 MIN_MESSAGE_TOKENS = 10 # Мінімальна кількість токенів у повідомленні
 EXCLUDED_COMMANDS = ['/start', '/help', '/stats', '/stop', '/reminders', '/quality', '/export']
+TECHNICAL_PATTERNS = ['http://', 'https://', 'www.']  # Технічні тексти (посилання)
+
+# Словники для простого аналізу настрою
+POSITIVE_WORDS = ['dobrze', 'świetnie', 'super', 'klasowo', 'doskonale',
+                  'kocham', 'cieszę się', 'szczęśliwy', '😊', '😄', '❤️', '👍']
+NEGATIVE_WORDS = ['źle', 'okropnie', 'smutno', 'boli', 'nie podoba mi się',
+                  'nienawidzę', 'tęsknię', '😢', '😞', '😠', '💔']
+
+# Швидкий холодний старт: токенізатор вантажиться у фоні, DDL пропускається якщо схема актуальна
+FAST_STARTUP = os.getenv('FAST_STARTUP', 'true').lower() == 'true'
+
+# Налаштування токенізатора
+TOKENIZER_THREADS = int(os.getenv('TOKENIZER_THREADS', 2))  # Потоки для підрахунку токенів
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))  # Скільки підрахунків тримати в кеші
+TOKENIZER_INLINE_CHARS = 256  # Короткі тексти рахуємо одразу, без передачі в потік
+
+# Відкладений запис повідомлень (write-behind)
+# Якщо увімкнено - повідомлення накопичуються в пам'яті і записуються пакетами
+# Лічильники ведуться в пам'яті процесу, тож при WEB_WORKERS > 1 завжди вимкнено
+WRITE_BEHIND_REQUESTED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_BEHIND_ENABLED = WRITE_BEHIND_REQUESTED and WEB_WORKERS == 1
+WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', 200))  # Інтервал запису (мс)
+WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', 500))  # Запис раніше, якщо накопичилось стільки рядків
+WRITE_BEHIND_MAX_USERS = 10000  # Скільки користувачів тримати в кеші поточних лічильників
+# Найбільша черга, коли запис не вдається (БД недоступна); понад це найстаріші повідомлення відкидаються
+WRITE_BEHIND_MAX_BACKLOG_ROWS = int(os.getenv('WRITE_BEHIND_MAX_BACKLOG_ROWS', 50000))
+
+# Серії повідомлень: перше повідомлення отримує відповідь одразу, а ті, що надійшли під час
+# відповіді, чекають паузи COALESCE_DEBOUNCE_MS і отримують одну спільну відповідь
+COALESCE_DEBOUNCE_MS = int(os.getenv('COALESCE_DEBOUNCE_MS', 800))  # 0 - без очікування, лише по черзі
+COALESCE_MAX_WAIT_MS = int(os.getenv('COALESCE_MAX_WAIT_MS', 3000))  # Найдовше очікування від першого повідомлення серії
+
+# Історія розмов для контексту OpenAI
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'memory' if WEB_WORKERS == 1 else 'postgres')  # 'memory' або 'postgres'
+HISTORY_MAX_MESSAGES = 10  # Останні повідомлення (без system prompt)
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 2000))  # Токенів історії в запиті (без system prompt)
+HISTORY_MAX_USERS = int(os.getenv('HISTORY_MAX_USERS', 10000))  # Скільки історій тримати в пам'яті (memory)
+HISTORY_IDLE_TTL_SECONDS = float(os.getenv('HISTORY_IDLE_TTL_SECONDS', 6 * 3600))  # Забувати неактивних (відновлюється з БД)
+
+# Кеш статистики користувачів (user_stats) у пам'яті процесу
+# При кількох екземплярах бота вимкніть: кеш не бачить змін з інших процесів
+STATS_CACHE_ENABLED = os.getenv('STATS_CACHE_ENABLED', 'true' if WEB_WORKERS == 1 else 'false').lower() == 'true'
+STATS_CACHE_TTL_SECONDS = float(os.getenv('STATS_CACHE_TTL_SECONDS', 30))  # Скільки секунд вважати рядок актуальним
+STATS_CACHE_SIZE = 10000  # Скільки користувачів тримати в кеші
+
+# Експорт
+EXPORT_INCREMENTAL = os.getenv('EXPORT_INCREMENTAL', 'true').lower() == 'true'  # Дописувати тільки нові розмови
+EXPORT_CHECKPOINT_CONVERSATIONS = 200  # Як часто зберігати позначку експорту (для відновлення після збою)
+# Позначка експорту не просувається за повідомлення, новіші за стільки секунд: вони ще можуть
+# отримати сусідів з меншим (timestamp, id) і перечитуються наступним експортом
+EXPORT_SETTLE_SECONDS = int(os.getenv('EXPORT_SETTLE_SECONDS', 60))
+EXPORT_LOCK_TIMEOUT_SECONDS = 30  # Скільки чекати на експорт того ж користувача в іншому процесі
+EXPORT_CHECKPOINT_ACQUIRE_SECONDS = 1  # Пул зайнятий довше - контрольна точка пропускається
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION') or None  # None, 'gzip' або 'zstd' (потрібен пакет zstandard)
+EXPORT_MAX_PART_BYTES = int(os.getenv('EXPORT_MAX_PART_BYTES', 0))  # Розмір частини до стиснення, 0 - без обмеження
+EXPORT_MAX_PART_EXAMPLES = int(os.getenv('EXPORT_MAX_PART_EXAMPLES', 0))  # Розмов у частині, 0 - без обмеження
+TELEGRAM_MAX_UPLOAD_BYTES = 45 * 1024 * 1024  # Telegram приймає файли до 50 MB, залишаємо запас
 
 # Налаштування нагадувань
 REMINDER_INTERVAL_HOURS = 1  # Інтервал нагадувань (години)
 INACTIVITY_THRESHOLD_MINUTES = 30  # Нагадування тільки якщо користувач неактивний хв
+REMINDER_RATE_PER_SECOND = float(os.getenv('REMINDER_RATE_PER_SECOND', 25))  # Telegram дозволяє ~30 повідомлень/с на бота
+# Скільки екземплярів бота (окремих розгортань з планувальником) розсилають одночасно:
+# ліміт рахується в кожному процесі окремо, тож REMINDER_RATE_PER_SECOND ділиться між ними
+REMINDER_INSTANCES = max(1, int(os.getenv('REMINDER_INSTANCES', 1)))
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', 20))  # Одночасних відправок
+REMINDER_BATCH_SIZE = 500  # Скільки відправок записувати в БД одним UPDATE
+# Кілька екземплярів бота ділять розсилку через захоплення рядків у БД
+REMINDER_CLAIM_BATCH = 500  # Скільки користувачів захоплювати за раз
+REMINDER_CLAIM_LEASE_SECONDS = 300  # Через скільки захоплення впалого екземпляра спливає
+REMINDER_MIN_GAP_MINUTES = REMINDER_INTERVAL_HOURS * 45  # Не нагадувати частіше (запуски різних екземплярів не збігаються в часі)
 REMINDER_MESSAGES =[
     "👋 Cześć! Jak leci? Podziel się czymś ciekawym ze swojego dnia!",
     "💭 Co teraz masz na myśli? Opowiedz mi o tym!",
@@ -1,38 +1,652 @@
+import asyncio
 import asyncpg
+import functools
+import inspect
+import json
 import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Optional
-import tiktoken
 import config
+from metrics import Histogram
+from text_analysis import text_matcher
+from tokenizer import token_counter
 
 logger = logging.getLogger(__name__)
 
-# Ініціалізація токенізатора для підрахунку токенів
-encoding = tiktoken.encoding_for_model(config.OPENAI_MODEL)
+DB_METHOD_SECONDS = Histogram('db_method_seconds', 'Час виконання методів Database', ('method',))
+DB_POOL_ACQUIRE_SECONDS = Histogram('db_pool_acquire_seconds', "Очікування вільного з'єднання з пулу")
 
 
+# Атомарне збереження повідомлення за один round trip:
+# - prev блокує рядок user_stats і повертає стан збору ДО цього повідомлення
+# - stats створює/оновлює рядок, інкрементує лічильники і вимикає збір на ліміті
+#   (повертає весь рядок user_stats - він одразу потрапляє в кеш статистики)
+# - msg вставляє повідомлення тільки якщо збір був активний
+#   (повторна доставка того ж повідомлення Telegram порушує унікальний індекс
+#   idx_messages_user_telegram_id, і весь запит, включно з лічильниками, відкочується)
+# $1 user_id, $2 role, $3 content, $4 tokens_count, $5 sentiment, $6 is_filtered, $7 ліміт токенів,
+# $8 telegram_message_id (NULL - без перевірки дублікатів)
+SAVE_MESSAGE_QUERY = '''
+    WITH prev AS (
+        SELECT collection_active FROM user_stats WHERE user_id = $1 FOR UPDATE
+    ),
+    stats AS (
+        INSERT INTO user_stats AS s
+            (user_id, total_tokens, message_count, collection_active, collection_completed_at)
+        VALUES (
+            $1,
+            CASE WHEN $6::boolean THEN 0 ELSE $4::int END,
+            CASE WHEN $6::boolean THEN 0 ELSE 1 END,
+            $6::boolean OR $4::int < $7::int,
+            CASE WHEN $6::boolean OR $4::int < $7::int THEN NULL ELSE CURRENT_TIMESTAMP END
+        )
+        ON CONFLICT (user_id) DO UPDATE SET
+            last_activity_at = CASE
+                WHEN $2 = 'user' THEN CURRENT_TIMESTAMP ELSE s.last_activity_at END,
+            total_tokens = CASE
+                WHEN s.collection_active AND NOT $6::boolean THEN s.total_tokens + $4::int
+                ELSE s.total_tokens END,
+            message_count = CASE
+                WHEN s.collection_active AND NOT $6::boolean THEN s.message_count + 1
+                ELSE s.message_count END,
+            collection_active = s.collection_active
+                AND ($6::boolean OR s.total_tokens + $4::int < $7::int),
+            collection_completed_at = CASE
+                WHEN s.collection_active AND NOT $6::boolean AND s.total_tokens + $4::int >= $7::int
+                THEN CURRENT_TIMESTAMP ELSE s.collection_completed_at END
+        RETURNING s.*
+    ),
+    msg AS (
+        INSERT INTO messages (user_id, role, content, tokens_count, sentiment, is_filtered, telegram_message_id)
+        SELECT $1, $2, $3, $4::int, $5, $6::boolean, $8::bigint
+        WHERE COALESCE((SELECT collection_active FROM prev), TRUE)
+    )
+    SELECT COALESCE((SELECT collection_active FROM prev), TRUE) AS was_active, stats.*
+    FROM stats
+'''
+
+# Пакетне оновлення статистики після запису буфера: одна команда на всіх користувачів
+# $1 user_id[], $2 токени[], $3 кількість повідомлень[], $4 ліміт досягнуто[], $5 є повідомлення користувача[]
+FLUSH_STATS_QUERY = '''
+    INSERT INTO user_stats AS s
+        (user_id, total_tokens, message_count, collection_active,
+         collection_completed_at, last_activity_at)
+    SELECT d.user_id, d.tokens, d.messages, NOT d.completed,
+           CASE WHEN d.completed THEN CURRENT_TIMESTAMP END,
+           CASE WHEN d.touched THEN CURRENT_TIMESTAMP END
+    FROM unnest($1::bigint[], $2::int[], $3::int[], $4::boolean[], $5::boolean[])
+        AS d(user_id, tokens, messages, completed, touched)
+    ON CONFLICT (user_id) DO UPDATE SET
+        total_tokens = s.total_tokens + EXCLUDED.total_tokens,
+        message_count = s.message_count + EXCLUDED.message_count,
+        collection_active = s.collection_active AND EXCLUDED.collection_active,
+        collection_completed_at = CASE
+            WHEN s.collection_active AND NOT EXCLUDED.collection_active THEN CURRENT_TIMESTAMP
+            ELSE s.collection_completed_at END,
+        last_activity_at = COALESCE(EXCLUDED.last_activity_at, s.last_activity_at)
+    RETURNING user_id, total_tokens, collection_active
+'''
+
+# Версія схеми БД. Збільшуйте при кожній зміні DDL у create_tables
+SCHEMA_VERSION = 7
+
+# Читання повідомлень користувача з keyset-пагінацією. Текст запитів незмінний,
+# тож план завжди один - діапазонний скан по idx_messages_user_ts_unfiltered.
+# $1 user_id, $2 after_id (курсор: продовжити після цього повідомлення), $3 before_timestamp, $4 limit
+USER_MESSAGES_QUERY_ASC = '''
+    SELECT id, user_id, role, content, tokens_count, timestamp, sentiment, is_filtered FROM messages
+    WHERE user_id = $1 AND is_filtered = FALSE
+      AND ($2::int IS NULL OR (timestamp, id) > (SELECT timestamp, id FROM messages WHERE id = $2))
+      AND ($3::timestamp IS NULL OR timestamp < $3)
+    ORDER BY timestamp, id
+    LIMIT $4
+'''
+USER_MESSAGES_QUERY_DESC = '''
+    SELECT id, user_id, role, content, tokens_count, timestamp, sentiment, is_filtered FROM messages
+    WHERE user_id = $1 AND is_filtered = FALSE
+      AND ($2::int IS NULL OR (timestamp, id) < (SELECT timestamp, id FROM messages WHERE id = $2))
+      AND ($3::timestamp IS NULL OR timestamp < $3)
+    ORDER BY timestamp DESC, id DESC
+    LIMIT $4
+'''
+
+# Розподіл нефільтрованих повідомлень за роллю та настроєм для /quality
+# (кілька груп - впорядковуються вже в Python, без сортування історії в БД)
+MESSAGE_BREAKDOWN_QUERY = '''
+    SELECT role, sentiment, COUNT(*) AS count
+    FROM messages
+    WHERE user_id = $1 AND is_filtered = FALSE
+    GROUP BY role, sentiment
+'''
+
+# Конфігурація повнотекстового пошуку. 'simple' не залежить від словників мови
+# (польського стемера в стандартній поставці PostgreSQL немає) і знаходить точні
+# форми слів. Зміна вимагає перестворення колонки search_vector
+SEARCH_CONFIG = 'simple'
+
+# Повнотекстовий пошук з keyset-пагінацією від нових до старих.
+# $1 запит (синтаксис websearch: "фраза в лапках", -виключення, or), $2 user_id або NULL,
+# $3 before_id (курсор: продовжити з повідомлень, старіших за цей id), $4 limit
+SEARCH_MESSAGES_QUERY = f'''
+    SELECT id, user_id, role, content, timestamp, is_filtered FROM messages
+    WHERE search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', $1)
+      AND ($2::bigint IS NULL OR user_id = $2)
+      AND ($3::int IS NULL OR id < $3)
+    ORDER BY id DESC
+    LIMIT $4
+'''
+
+# Захоплення користувачів для розсилки нагадувань кількома екземплярами бота.
+# SKIP LOCKED пропускає рядки, які саме зараз захоплює інший екземпляр, а
+# reminder_claimed_until - рядки, захоплені раніше і ще не оброблені. Якщо
+# екземпляр впав, його захоплення просто спливають.
+# $1 хто захоплює, $2 тривалість захоплення (с), $3 поріг неактивності (хв),
+# $4 мінімальний інтервал між нагадуваннями (хв), $5 розмір пакета
+CLAIM_REMINDERS_QUERY = '''
+    UPDATE user_stats s
+    SET reminder_claimed_by = $1, reminder_claimed_until = NOW() + make_interval(secs => $2)
+    FROM (
+        SELECT user_id FROM user_stats
+        WHERE reminders_enabled = TRUE
+          AND collection_active = TRUE
+          AND (last_activity_at IS NULL OR last_activity_at < NOW() - make_interval(mins => $3))
+          AND (last_reminder_at IS NULL OR last_reminder_at < NOW() - make_interval(mins => $4))
+          AND (reminder_claimed_until IS NULL OR reminder_claimed_until < NOW())
+        ORDER BY user_id
+        LIMIT $5
+        FOR UPDATE SKIP LOCKED
+    ) claimed
+    WHERE s.user_id = claimed.user_id
+    RETURNING s.user_id
+'''
+
+# Додавання повідомлення до спільної історії розмови з обрізанням до останніх N
+# (історія - JSONB масив [role, content, tokens] від давніх до нових)
+# $1 user_id, $2 повідомлення (JSONB масив з одного елемента), $3 N
+APPEND_HISTORY_QUERY = '''
+    INSERT INTO conversation_history (user_id, messages, updated_at)
+    VALUES ($1, $2::jsonb, NOW())
+    ON CONFLICT (user_id) DO UPDATE SET
+        messages = (
+            SELECT COALESCE(jsonb_agg(item ORDER BY position), '[]'::jsonb)
+            FROM jsonb_array_elements(conversation_history.messages || EXCLUDED.messages)
+                WITH ORDINALITY AS items(item, position)
+            WHERE position > jsonb_array_length(conversation_history.messages) + 1 - $3
+        ),
+        updated_at = NOW()
+'''
+
+# Простір ключів advisory-блокувань експорту (другий ключ - хеш user_id)
+EXPORT_LOCK_NAMESPACE = 8001
+# Унікальний індекс, порушення якого означає повторну доставку повідомлення Telegram
+TELEGRAM_ID_INDEX = 'idx_messages_user_telegram_id'
+
+MESSAGE_COLUMNS = ['user_id', 'role', 'content', 'tokens_count', 'sentiment', 'is_filtered']
+
+
+class WriteBehindBuffer:
+    """
+    Буфер відкладеного запису повідомлень
+
+    Повідомлення накопичуються в пам'яті і записуються через COPY кожні
+    flush_interval_ms мс або після max_rows рядків. Дельти лічильників
+    user_stats об'єднуються в одну команду на запис. Ліміт токенів
+    перевіряється по поточних лічильниках у пам'яті, які звіряються з БД
+    після кожного запису.
+    """
+
+    def __init__(self, database: 'Database', flush_interval_ms: int, max_rows: int, max_users: int,
+                 max_backlog: int):
+        self.db = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max_rows
+        self.max_users = max_users
+        self.max_backlog = max_backlog
+
+        self._rows = []  # Рядки для messages
+        self._deltas = {}  # user_id -> {'tokens', 'messages', 'completed', 'touched'}
+        self._states = OrderedDict()  # user_id -> {'total_tokens', 'collection_active'}
+        self._loading = {}  # user_id -> Future із завантаженням стану
+
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+        self.flush_count = 0
+        self.flush_failures = 0
+        self.rows_flushed = 0
+        self.rows_dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def start(self):
+        """Запустити фоновий цикл запису"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _get_state(self, user_id: int) -> dict:
+        """Поточні лічильники користувача (з БД при першому зверненні)"""
+        state = self._states.get(user_id)
+        if state is not None:
+            self._states.move_to_end(user_id)
+            return state
+
+        # Одночасні повідомлення одного користувача чекають на одне завантаження
+        if user_id in self._loading:
+            return await asyncio.shield(self._loading[user_id])
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = future
+        try:
+            async with self.db.pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    'SELECT total_tokens, collection_active FROM user_stats WHERE user_id = $1', user_id
+                )
+            state = dict(row) if row else {'total_tokens': 0, 'collection_active': True}
+            self._remember(user_id, state)
+            future.set_result(state)
+            return state
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Щоб не було попередження про необроблену помилку
+            raise
+        finally:
+            del self._loading[user_id]
+
+    def _remember(self, user_id: int, state: dict):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_users:
+            # Не витісняємо користувачів з незаписаними дельтами
+            oldest = next(iter(self._states))
+            if oldest in self._deltas:
+                self._states.move_to_end(oldest)
+                break
+            self._states.popitem(last=False)
+
+    async def add(self, user_id: int, role: str, content: str, tokens_count: int,
+                  sentiment: Optional[str], is_filtered: bool):
+        """Поставити повідомлення в чергу. Повертає той самий результат, що й save_message"""
+        state = await self._get_state(user_id)
+        delta = self._deltas.setdefault(
+            user_id, {'tokens': 0, 'messages': 0, 'completed': False, 'touched': False}
+        )
+
+        # Час останньої активності (тільки для повідомлень користувача)
+        if role == 'user':
+            delta['touched'] = True
+
+        if not state['collection_active']:
+            return False
+
+        self._rows.append((user_id, role, content, tokens_count, sentiment, is_filtered))
+        if len(self._rows) >= self.max_rows:
+            self._wakeup.set()
+
+        if is_filtered:
+            return True
+
+        state['total_tokens'] += tokens_count
+        delta['tokens'] += tokens_count
+        delta['messages'] += 1
+
+        if state['total_tokens'] >= config.MIN_TOKEN_LIMIT:
+            state['collection_active'] = False
+            delta['completed'] = True
+            logger.info(f"Збір даних для користувача {user_id} зупинено")
+            return 'limit_reached'
+
+        return True
+
+    def mark_inactive(self, user_id: int):
+        """Відмітити що збір для користувача зупинено поза буфером"""
+        state = self._states.get(user_id)
+        if state is not None:
+            state['collection_active'] = False
+
+    def overlay(self, user_id: int, stats: dict) -> dict:
+        """Додати до статистики з БД ще не записані дельти"""
+        delta = self._deltas.get(user_id)
+        if delta:
+            stats['total_tokens'] += delta['tokens']
+            stats['message_count'] += delta['messages']
+            if delta['completed']:
+                stats['collection_active'] = False
+        return stats
+
+    async def flush(self):
+        """Записати накопичені повідомлення та дельти лічильників"""
+        async with self._flush_lock:
+            if not self._rows and not self._deltas:
+                return
+
+            rows, self._rows = self._rows, []
+            deltas, self._deltas = self._deltas, {}
+            started = time.perf_counter()
+            committed = False
+
+            try:
+                user_ids = list(deltas)
+                async with self.db.pool.acquire() as conn:
+                    async with conn.transaction():
+                        if rows:
+                            await conn.copy_records_to_table(
+                                'messages', records=rows, columns=MESSAGE_COLUMNS
+                            )
+                        results = await conn.fetch(
+                            FLUSH_STATS_QUERY,
+                            user_ids,
+                            [deltas[u]['tokens'] for u in user_ids],
+                            [deltas[u]['messages'] for u in user_ids],
+                            [deltas[u]['completed'] for u in user_ids],
+                            [deltas[u]['touched'] for u in user_ids],
+                        )
+                    committed = True
+            except asyncio.CancelledError:
+                # Скасування посеред запису: незакомічений пакет повертаємо в чергу і зупиняємось
+                if not committed:
+                    self._requeue(rows, deltas)
+                raise
+            except Exception as e:
+                if not committed:
+                    self.flush_failures += 1
+                    logger.error(f"Помилка запису буфера повідомлень: {e}")
+                    # Повертаємо все назад у чергу, щоб не втратити дані
+                    self._requeue(rows, deltas)
+                    return
+                # Пакет уже в БД, не вдалося тільки повернути з'єднання в пул
+                logger.warning(f"Помилка після запису буфера повідомлень: {e}")
+
+            # Звіряємо лічильники в пам'яті з БД (з урахуванням нових дельт)
+            for row in results:
+                self.db.invalidate_user_stats(row['user_id'])
+                state = self._states.get(row['user_id'])
+                if state is None:
+                    continue
+                pending = self._deltas.get(row['user_id'])
+                state['total_tokens'] = row['total_tokens'] + (pending['tokens'] if pending else 0)
+                state['collection_active'] = state['collection_active'] and row['collection_active']
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flush_count += 1
+            self.rows_flushed += len(rows)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    def _requeue(self, rows: list, deltas: dict):
+        """
+        Повернути незаписаний пакет на початок черги
+
+        Черга не росте понад max_backlog рядків: якщо БД довго недоступна,
+        найстаріші повідомлення відкидаються (з їхніми дельтами лічильників)
+        """
+        self._rows = rows + self._rows
+        for user_id, delta in deltas.items():
+            pending = self._deltas.setdefault(
+                user_id, {'tokens': 0, 'messages': 0, 'completed': False, 'touched': False}
+            )
+            pending['tokens'] += delta['tokens']
+            pending['messages'] += delta['messages']
+            pending['completed'] = pending['completed'] or delta['completed']
+            pending['touched'] = pending['touched'] or delta['touched']
+
+        overflow = len(self._rows) - self.max_backlog
+        if overflow <= 0:
+            return
+        dropped, self._rows = self._rows[:overflow], self._rows[overflow:]
+        for user_id, role, content, tokens_count, sentiment, is_filtered in dropped:
+            delta = self._deltas.get(user_id)
+            if delta is not None and not is_filtered:
+                delta['tokens'] -= tokens_count
+                delta['messages'] -= 1
+        self.rows_dropped += overflow
+        logger.error(f"Черга відкладеного запису переповнена: відкинуто {overflow} найстаріших повідомлень")
+
+    async def close(self):
+        """Зупинити фоновий цикл (дочекавшись поточного запису) і записати залишок"""
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def get_metrics(self) -> dict:
+        """Метрики буфера: глибина черги та час запису"""
+        return {
+            'queue_depth': len(self._rows),
+            'pending_users': len(self._deltas),
+            'flush_count': self.flush_count,
+            'flush_failures': self.flush_failures,
+            'rows_flushed': self.rows_flushed,
+            'rows_dropped': self.rows_dropped,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self._total_flush_ms / self.flush_count, 2) if self.flush_count else 0.0,
+        }
+
+
+class StatsCache:
+    """
+    Кеш рядків user_stats у пам'яті процесу (LRU з обмеженим часом життя)
+
+    Записи скидаються при кожній зміні рядка через Database (save_message
+    одразу кладе на їх місце свіжий рядок, який повертає запит). Щоб читання,
+    яке почалося до запису, не поклало в кеш застарілий рядок, put() приймає
+    покоління користувача, отримане до запиту, і нічого не робить, якщо з
+    того часу рядок цього користувача скидався. Кеш бачить лише зміни цього
+    процесу, тож при кількох екземплярах бота його варто вимикати
+    (STATS_CACHE_ENABLED=false).
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._rows = OrderedDict()  # user_id -> (час запису, рядок)
+        self._generations = OrderedDict()  # user_id -> покоління останнього скидання, від давніх до нових
+        self._counter = 0
+        self._base_generation = 0  # Покоління користувачів без запису (росте, коли записи витісняються)
+        self._writes = {}  # user_id -> [номер останнього запису, скільки записів виконується]
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._rows.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._rows[user_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[1])
+
+    def generation(self, user_id: int) -> int:
+        """Покоління рядка користувача: отримати до читання з БД і передати в put()"""
+        return self._generations.get(user_id, self._base_generation)
+
+    def put(self, user_id: int, row: dict, generation: int):
+        if generation != self.generation(user_id):
+            return
+        self._rows[user_id] = (time.monotonic(), dict(row))
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+    def begin_write(self, user_id: int) -> int:
+        """Почати зміну рядка; повертає номер запису для end_write()"""
+        entry = self._writes.setdefault(user_id, [0, 0])
+        entry[0] += 1
+        entry[1] += 1
+        return entry[0]
+
+    def end_write(self, user_id: int, write: int, row: Optional[dict]):
+        """
+        Завершити зміну рядка (write-through)
+
+        Відповіді на одночасні записи можуть прийти не по порядку, тому
+        свіжий рядок кладеться в кеш, тільки якщо після цього запису не
+        почався інший; інакше (або якщо запис не вдався) рядок лише скидається
+        """
+        entry = self._writes[user_id]
+        entry[1] -= 1
+        latest = write == entry[0]
+        if not entry[1]:
+            del self._writes[user_id]
+        self.invalidate(user_id)
+        if latest and row is not None:
+            self.put(user_id, row, self.generation(user_id))
+
+    def invalidate(self, user_id: int):
+        self._counter += 1
+        self._generations[user_id] = self._counter
+        self._generations.move_to_end(user_id)
+        if len(self._generations) > self.max_size:
+            # Витіснений користувач отримує базове покоління - воно має бути новим,
+            # щоб його незавершене читання не поклало в кеш застарілий рядок
+            self._generations.popitem(last=False)
+            self._base_generation = self._counter
+        self.invalidations += 1
+        self._rows.pop(user_id, None)
+
+    def get_metrics(self) -> dict:
+        """Метрики кешу: розмір і частка влучань"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._rows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class _TimedAcquire:
+    """pool.acquire(), що записує час очікування з'єднання"""
+
+    __slots__ = ('_ctx',)
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        conn = await self._ctx.__aenter__()
+        DB_POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._ctx.__aexit__(*exc)
+
+
+class TimedPool:
+    """Обгортка пулу asyncpg для метрик; решта атрибутів - з самого пулу"""
+
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+
+    def acquire(self, *, timeout: float = None):
+        return _TimedAcquire(self._pool.acquire(timeout=timeout))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def timed_methods(exclude: set):
+    """Декоратор класу: час кожного публічного async-методу в DB_METHOD_SECONDS"""
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.iscoroutinefunction(method):
+                continue
+
+            def wrap(method, name=name):
+                @functools.wraps(method)
+                async def timed(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await method(*args, **kwargs)
+                    finally:
+                        DB_METHOD_SECONDS.observe(time.perf_counter() - started, name)
+                return timed
+
+            setattr(cls, name, wrap(method))
+        return cls
+    return decorate
+
+
+@timed_methods(exclude={'connect', 'close', 'count_tokens', 'count_tokens_batch'})
 class Database:
     def __init__(self):
-        self.pool: Optional[asyncpg.Pool] = None
+        self.pool: Optional[TimedPool] = None
+        self.write_behind: Optional[WriteBehindBuffer] = None
+        self.stats_cache: Optional[StatsCache] = None
+        if config.STATS_CACHE_ENABLED:
+            self.stats_cache = StatsCache(config.STATS_CACHE_SIZE, config.STATS_CACHE_TTL_SECONDS)
+        self.startup_timings = {}  # Час етапів підключення (секунди)
+        self.save_errors = 0
+        self.duplicate_messages = 0  # Повторні доставки, відкинуті унікальним індексом
 
-    async def connect(self):
+    async def connect(self, max_size: int = 10):
         """Підключення до бази даних"""
         try:
-            self.pool = await asyncpg.create_pool(
+            started = time.perf_counter()
+            self.pool = TimedPool(await asyncpg.create_pool(
                 config.DATABASE_URL,
                 min_size=1,
-                max_size=10,
+                max_size=max_size,
                 statement_cache_size=0  # Вимикаємо prepared statements для Supabase/pgbouncer
-            )
+            ))
+            self.startup_timings['pool_connect'] = time.perf_counter() - started
             logger.info("✅ Підключення до бази даних успішне")
-            await self.create_tables()
+
+            started = time.perf_counter()
+            await self.create_tables(force=not config.FAST_STARTUP)
+            self.startup_timings['schema'] = time.perf_counter() - started
+
+            if config.WRITE_BEHIND_ENABLED:
+                self.write_behind = WriteBehindBuffer(
+                    self,
+                    flush_interval_ms=config.WRITE_BEHIND_FLUSH_MS,
+                    max_rows=config.WRITE_BEHIND_MAX_ROWS,
+                    max_users=config.WRITE_BEHIND_MAX_USERS,
+                    max_backlog=config.WRITE_BEHIND_MAX_BACKLOG_ROWS,
+                )
+                self.write_behind.start()
+                logger.info(f"✅ Відкладений запис повідомлень увімкнено ({config.WRITE_BEHIND_FLUSH_MS} мс)")
         except Exception as e:
             logger.error(f"❌ Помилка підключення до бази даних: {e}")
             raise
 
-    async def create_tables(self):
-        """Створення таблиць у базі даних"""
+    async def get_schema_version(self, conn) -> Optional[int]:
+        """Поточна версія схеми в БД (None якщо схема ще не створювалась)"""
+        try:
+            return await conn.fetchval('SELECT version FROM schema_version')
+        except asyncpg.UndefinedTableError:
+            return None
+
+    async def create_tables(self, force: bool = False):
+        """Створення таблиць у базі даних (пропускається, якщо схема актуальна)"""
         async with self.pool.acquire() as conn:
+            if not force and (await self.get_schema_version(conn) or 0) >= SCHEMA_VERSION:
+                logger.info(f"✅ Схема БД актуальна (версія {SCHEMA_VERSION}), DDL пропущено")
+                return
+
             # Таблиця для повідомлень
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS messages (
@@ -69,113 +683,173 @@ class Database:
             await conn.execute('''
                 CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)
             ''')
+            # Читання історії користувача: фільтр, сортування і пагінація по одному індексу
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_user_ts_unfiltered
+                ON messages(user_id, timestamp, id) WHERE is_filtered = FALSE
+            ''')
 
-            logger.info("✅ Таблиці створено або вже існують")
+            # Повнотекстовий пошук: колонка обчислюється самою БД при кожному INSERT/UPDATE,
+            # тож вставки (включно з COPY) не змінюються. На великій таблиці додавання
+            # колонки переписує таблицю - запускайте міграцію поза піковим часом
+            await conn.execute(f'''
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+                GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', content)) STORED
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector)
+            ''')
 
-    async def count_tokens(self, text: str) -> int:
-        """Підрахунок токенів у тексті"""
-        try:
-            tokens = encoding.encode(text)
-            return len(tokens)
-        except Exception as e:
-            logger.error(f"Помилка підрахунку токенів: {e}")
-            return 0
+            # Захист від повторної доставки оновлень Telegram: id повідомлення в приватному чаті користувача
+            # (у приватному чаті chat_id = user_id; з інших чатів id не зберігається)
+            await conn.execute('''
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS telegram_message_id BIGINT
+            ''')
+            await conn.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_user_telegram_id
+                ON messages(user_id, telegram_message_id) WHERE telegram_message_id IS NOT NULL
+            ''')
 
-    def analyze_sentiment(self, text: str) -> str:
-        """Простий аналіз настрою (можна покращити пізніше)"""
-        text_lower = text.lower()
+            # Захоплення нагадувань (кілька екземплярів бота ділять одну розсилку)
+            await conn.execute('''
+                ALTER TABLE user_stats
+                    ADD COLUMN IF NOT EXISTS reminder_claimed_by TEXT,
+                    ADD COLUMN IF NOT EXISTS reminder_claimed_until TIMESTAMP
+            ''')
 
-        positive_words = ['dobrze', 'świetnie', 'super', 'klasowo', 'doskonale',
-                         'kocham', 'cieszę się', 'szczęśliwy', '😊', '😄', '❤️', '👍']
-        negative_words = ['źle', 'okropnie', 'smutno', 'boli', 'nie podoba mi się',
-                         'nienawidzę', 'tęsknię', '😢', '😞', '😠', '💔']
+            # Історії розмов для контексту OpenAI, спільні для всіх процесів бота (HISTORY_BACKEND=postgres)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_history (
+                    user_id BIGINT PRIMARY KEY,
+                    messages JSONB NOT NULL DEFAULT '[]',
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        positive_count = sum(1 for word in positive_words if word in text_lower)
-        negative_count = sum(1 for word in negative_words if word in text_lower)
+            # Позначки інкрементального експорту
+            # committed_bytes - кінець файлу без останньої неповної розмови,
+            # tail - вікно групування на цей момент, final_bytes - повний розмір (NULL якщо експорт перервано)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS export_watermarks (
+                    user_id BIGINT PRIMARY KEY,
+                    file TEXT NOT NULL,
+                    last_timestamp TIMESTAMP,
+                    last_message_id INTEGER,
+                    committed_bytes BIGINT NOT NULL DEFAULT 0,
+                    conversations INTEGER NOT NULL DEFAULT 0,
+                    messages INTEGER NOT NULL DEFAULT 0,
+                    tail JSONB NOT NULL DEFAULT '{}',
+                    final_bytes BIGINT,
+                    final_messages INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-        if positive_count > negative_count:
-            return 'positive'
-        elif negative_count > positive_count:
-            return 'negative'
-        else:
-            return 'neutral'
+            # Версія схеми (одна строка)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    version INTEGER NOT NULL
+                )
+            ''')
+            await conn.execute('''
+                INSERT INTO schema_version (version) VALUES ($1)
+                ON CONFLICT (id) DO UPDATE SET version = GREATEST(schema_version.version, EXCLUDED.version)
+            ''', SCHEMA_VERSION)
 
-    def should_filter_message(self, text: str, tokens_count: int) -> bool:
-        """Перевірка чи потрібно фільтрувати повідомлення"""
-        # Фільтруємо команди
-        if any(text.startswith(cmd) for cmd in config.EXCLUDED_COMMANDS):
-            return True
+            logger.info("✅ Таблиці створено або вже існують")
 
-        # Фільтруємо надто короткі повідомлення
-        if tokens_count < config.MIN_MESSAGE_TOKENS:
-            return True
+    async def count_tokens(self, text: str) -> int:
+        """Підрахунок токенів у тексті (поза event loop, з кешем)"""
+        return await token_counter.count(text)
 
-        # Фільтруємо технічні тексти (можна розширити)
-        technical_patterns = ['http://', 'https://', 'www.']
-        if any(pattern in text for pattern in technical_patterns):
-            return True
+    async def count_tokens_batch(self, texts: list) -> list:
+        """Підрахунок токенів для багатьох текстів одразу (для бекфілів)"""
+        return await token_counter.count_many(texts)
 
-        return False
+    def analyze_sentiment(self, text: str) -> str:
+        """Простий аналіз настрою за словниками з конфігурації"""
+        return text_matcher.sentiment(text)
 
-    async def save_message(self, user_id: int, role: str, content: str) -> bool:
-        """Зберегти повідомлення у базу даних"""
-        try:
-            async with self.pool.acquire() as conn:
-                # Перевіряємо чи активний збір для користувача
-                stats = await conn.fetchrow(
-                    'SELECT total_tokens, collection_active FROM user_stats WHERE user_id = $1', user_id
-                )
+    def analyze_sentiment_batch(self, texts: list) -> list:
+        """Аналіз настрою для багатьох текстів одним проходом"""
+        return [flags.sentiment for flags in text_matcher.scan_many(texts)]
 
-                # Якщо користувача немає, створюємо запис
-                if not stats:
-                    await conn.execute(
-                        'INSERT INTO user_stats (user_id) VALUES ($1)', user_id
-                    )
-                    stats = {'total_tokens': 0, 'collection_active': True}
+    def should_filter_message(self, text: str, tokens_count: int) -> bool:
+        """Перевірка чи потрібно фільтрувати повідомлення"""
+        return text_matcher.should_filter(text, tokens_count)
 
-                # Оновлюємо час останньої активності (тільки для повідомлень користувача)
-                if role == 'user':
-                    await conn.execute(
-                        'UPDATE user_stats SET last_activity_at = CURRENT_TIMESTAMP WHERE user_id = $1',
-                        user_id
-                    )
+    async def may_reach_limit(self, user_id: int, content: str) -> bool:
+        """
+        Чи може це повідомлення вичерпати ліміт токенів
 
-                # Якщо збір неактивний, не зберігаємо
-                if not stats['collection_active']:
-                    return False
+        Дешева перевірка до збереження: статистика з кешу, токени з кешу токенізатора
+        (save_message потім візьме їх звідти ж). Запас LIMIT_CHECK_MARGIN_TOKENS
+        покриває одночасні повідомлення, яких ще немає в закешованій статистиці.
+        """
+        stats = await self.get_user_stats(user_id)
+        if stats and not stats['collection_active']:
+            return False
+        total = stats['total_tokens'] if stats else 0
+        tokens = await self.count_tokens(content)
+        return total + tokens + config.LIMIT_CHECK_MARGIN_TOKENS >= config.MIN_TOKEN_LIMIT
 
-                # Підраховуємо токени
-                tokens_count = await self.count_tokens(content)
+    async def save_message(self, user_id: int, role: str, content: str, telegram_message_id: int = None) -> bool:
+        """
+        Зберегти повідомлення у базу даних (один атомарний запит)
 
-                # Перевіряємо чи потрібно фільтрувати
-                is_filtered = self.should_filter_message(content, tokens_count)
+        З telegram_message_id повторне збереження того ж повідомлення
+        нічого не змінює і повертає 'duplicate'
+        """
+        try:
+            # Токени, фільтр і настрій рахуємо до звернення до БД (один прохід по тексту)
+            tokens_count = await self.count_tokens(content)
+            flags = text_matcher.scan(content)
+            is_filtered = text_matcher.should_filter(content, tokens_count, flags)
+            sentiment = flags.sentiment if role == 'user' else None
 
-                # Аналізуємо настрій (тільки для повідомлень користувача)
-                sentiment = self.analyze_sentiment(content) if role == 'user' else None
+            # Відкладений запис: повідомлення потрапить у БД з наступним пакетом
+            # (без telegram_message_id - див. MESSAGE_DEDUP_ENABLED у config)
+            if self.write_behind:
+                return await self.write_behind.add(
+                    user_id, role, content, tokens_count, sentiment, is_filtered
+                )
 
-                # Зберігаємо повідомлення
-                await conn.execute('''
-                    INSERT INTO messages
-                    (user_id, role, content, tokens_count, sentiment, is_filtered)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                ''', user_id, role, content, tokens_count, sentiment, is_filtered)
+            write = self.stats_cache.begin_write(user_id) if self.stats_cache else None
+            result = None
+            try:
+                async with self.pool.acquire() as conn:
+                    result = await conn.fetchrow(
+                        SAVE_MESSAGE_QUERY,
+                        user_id, role, content, tokens_count, sentiment, is_filtered,
+                        config.MIN_TOKEN_LIMIT, telegram_message_id
+                    )
+            finally:
+                if self.stats_cache:
+                    row = {key: value for key, value in result.items() if key != 'was_active'} if result else None
+                    self.stats_cache.end_write(user_id, write, row)
 
-                # Оновлюємо статистику (тільки нефільтровані повідомлення)
-                if not is_filtered:
-                    new_total = stats['total_tokens'] + tokens_count
-                    await conn.execute('''
-                        UPDATE user_stats SET total_tokens = $1, message_count = message_count + 1
-                        WHERE user_id = $2
-                    ''', new_total, user_id)
+            # Якщо збір неактивний, повідомлення не збережено
+            if not result['was_active']:
+                return False
 
-                    # Перевіряємо ліміт
-                    if new_total >= config.MIN_TOKEN_LIMIT:
-                        await self.stop_collection(user_id)
-                        return 'limit_reached'
+            # Ліміт досягнуто саме цим повідомленням
+            if not is_filtered and not result['collection_active']:
+                logger.info(f"Збір даних для користувача {user_id} зупинено")
+                return 'limit_reached'
 
-                return True
+            return True
 
+        except asyncpg.UniqueViolationError as e:
+            if e.constraint_name != TELEGRAM_ID_INDEX:
+                self.save_errors += 1
+                logger.error(f"Помилка збереження повідомлення: {e}")
+                return False
+            self.duplicate_messages += 1
+            logger.info(f"Повідомлення {telegram_message_id} користувача {user_id} вже збережено")
+            return 'duplicate'
         except Exception as e:
+            self.save_errors += 1
             logger.error(f"Помилка збереження повідомлення: {e}")
             return False
 
@@ -186,31 +860,258 @@ class Database:
                 UPDATE user_stats SET collection_active = FALSE, collection_completed_at = CURRENT_TIMESTAMP
                 WHERE user_id = $1
             ''', user_id)
+            self.invalidate_user_stats(user_id)
+            if self.write_behind:
+                self.write_behind.mark_inactive(user_id)
             logger.info(f"Збір даних для користувача {user_id} зупинено")
 
+    def invalidate_user_stats(self, user_id: int):
+        """Скинути закешований рядок user_stats після зміни"""
+        if self.stats_cache:
+            self.stats_cache.invalidate(user_id)
+
     async def get_user_stats(self, user_id: int) -> dict:
-        """Отримати статистику користувача"""
+        """Отримати статистику користувача (з кешу, якщо він увімкнений)"""
+        stats = self.stats_cache.get(user_id) if self.stats_cache else None
+        if stats is None:
+            generation = self.stats_cache.generation(user_id) if self.stats_cache else 0
+            async with self.pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    'SELECT * FROM user_stats WHERE user_id = $1', user_id
+                )
+            if not row:
+                return None
+            stats = dict(row)
+            if self.stats_cache:
+                self.stats_cache.put(user_id, stats, generation)
+
+        # Кеш зберігає рядок з БД, ще не записані дельти додаються зверху
+        if self.write_behind:
+            stats = self.write_behind.overlay(user_id, stats)
+        return stats
+
+
+    async def get_user_messages(self, user_id: int, limit: int = None, ascending: bool = False,
+                                after_id: int = None, before_timestamp: datetime = None):
+        """
+        Отримати нефільтровані повідомлення користувача
+
+        Args:
+            limit: Максимальна кількість повідомлень (None - всі)
+            ascending: Від старих до нових (за замовчуванням - від нових до старих)
+            after_id: Продовжити після цього повідомлення в обраному порядку (keyset-пагінація)
+            before_timestamp: Тільки повідомлення, старіші за цей час
+        """
+        query = USER_MESSAGES_QUERY_ASC if ascending else USER_MESSAGES_QUERY_DESC
+        async with self.pool.acquire() as conn:
+            messages = await conn.fetch(query, user_id, after_id, before_timestamp, limit)
+            return [dict(msp) for msp in messages]
+
+    async def search_messages(self, query: str, user_id: int = None, limit: int = 20,
+                              before_id: int = None) -> list:
+        """
+        Повнотекстовий пошук по всіх повідомленнях (включно з відфільтрованими)
+
+        Args:
+            query: Запит у синтаксисі websearch_to_tsquery
+            user_id: Шукати тільки в повідомленнях цього користувача
+            before_id: Продовжити після останнього результату попередньої сторінки
+        """
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(SEARCH_MESSAGES_QUERY, query, user_id, before_id, limit)
+            return [dict(row) for row in rows]
+
+    async def get_message_breakdown(self, user_id: int) -> list:
+        """
+        Кількість нефільтрованих повідомлень у розрізі (role, sentiment) одним запитом
+
+        Групи від найчисленніших, при рівності - за назвою (стабільний порядок у звіті)
+        """
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(MESSAGE_BREAKDOWN_QUERY, user_id)
+        return sorted((dict(row) for row in rows),
+                      key=lambda row: (-row['count'], row['role'], row['sentiment'] or ''))
+
+    @asynccontextmanager
+    async def _connection(self, conn=None, timeout: float = None):
+        """Передане з'єднання (наприклад, з блокуванням експорту) або нове з пулу"""
+        if conn is not None:
+            yield conn
+        else:
+            async with self.pool.acquire(timeout=timeout) as conn:
+                yield conn
+
+    async def iter_user_messages(self, user_id: int, after: tuple = None, prefetch: int = 500,
+                                 settle_seconds: float = 0, conn=None):
+        """
+        Потоково віддає нефільтровані повідомлення користувача від старих до нових
+
+        Читає через серверний курсор, тож у пам'яті одночасно не більше prefetch рядків.
+        after - ключ (timestamp, id) останнього вже обробленого повідомлення.
+        Колонка settled - чи повідомлення старіше за settle_seconds: новіші ще можуть
+        отримати сусідів з меншим ключем (довші транзакції, пакети відкладеного запису)
+        conn - з'єднання з export_lock (курсор іде в його транзакції)
+        """
+        after_timestamp, after_id = after or (None, None)
+        async with self._connection(conn) as conn:
+            # Курсори asyncpg працюють тільки всередині транзакції
+            async with conn.transaction():
+                async for message in conn.cursor('''
+                    SELECT id, role, content, tokens_count, timestamp,
+                           timestamp < LOCALTIMESTAMP - make_interval(secs => $4) AS settled
+                    FROM messages
+                    WHERE user_id = $1 AND is_filtered = FALSE
+                      AND ($2::timestamp IS NULL OR (timestamp, id) > ($2::timestamp, $3::int))
+                    ORDER BY timestamp, id
+                ''', user_id, after_timestamp, after_id, float(settle_seconds), prefetch=prefetch):
+                    yield message
+
+    async def has_messages_after(self, user_id: int, after: tuple, conn=None) -> bool:
+        """Чи є нефільтровані повідомлення новіші за ключ (timestamp, id)"""
+        async with self._connection(conn) as conn:
+            return await conn.fetchval('''
+                SELECT EXISTS(
+                    SELECT 1 FROM messages
+                    WHERE user_id = $1 AND is_filtered = FALSE AND (timestamp, id) > ($2::timestamp, $3::int)
+                )
+            ''', user_id, *after)
+
+    async def get_export_watermark(self, user_id: int, conn=None) -> Optional[dict]:
+        """Отримати позначку останнього експорту користувача"""
+        async with self._connection(conn) as conn:
+            row = await conn.fetchrow(
+                'SELECT * FROM export_watermarks WHERE user_id = $1', user_id
+            )
+            if not row:
+                return None
+            watermark = dict(row)
+            watermark['tail'] = json.loads(watermark['tail'])
+            return watermark
+
+    async def save_export_watermark(self, user_id: int, watermark: dict, conn=None, timeout: float = None):
+        """
+        Зберегти позначку експорту (контрольна точка або завершений експорт)
+
+        Контрольна точка пишеться окремим з'єднанням (щоб пережити збій експорту)
+        з timeout на його отримання; завершений - у транзакції export_lock
+        """
+        async with self._connection(conn, timeout) as conn:
+            await conn.execute('''
+                INSERT INTO export_watermarks
+                    (user_id, file, last_timestamp, last_message_id, committed_bytes,
+                     conversations, messages, tail, final_bytes, final_messages, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8::jsonb, $9, $10, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    file = EXCLUDED.file,
+                    last_timestamp = EXCLUDED.last_timestamp,
+                    last_message_id = EXCLUDED.last_message_id,
+                    committed_bytes = EXCLUDED.committed_bytes,
+                    conversations = EXCLUDED.conversations,
+                    messages = EXCLUDED.messages,
+                    tail = EXCLUDED.tail,
+                    final_bytes = EXCLUDED.final_bytes,
+                    final_messages = EXCLUDED.final_messages,
+                    updated_at = EXCLUDED.updated_at
+            ''', user_id, watermark['file'], watermark['last_timestamp'], watermark['last_message_id'],
+                watermark['committed_bytes'], watermark['conversations'], watermark['messages'],
+                json.dumps(watermark['tail'], ensure_ascii=False),
+                watermark['final_bytes'], watermark['final_messages'])
+
+    @asynccontextmanager
+    async def export_lock(self, user_id: int, timeout: float):
+        """
+        Блокування експорту користувача між процесами; повертає його з'єднання
+
+        pg_advisory_xact_lock тримається до кінця транзакції, тож працює і
+        через pgbouncer. Усі запити експорту (курсор, позначка) йдуть цим
+        з'єднанням, тож експорт не чекає на друге з'єднання, тримаючи перше.
+        Інший експорт того ж користувача чекає не довше timeout секунд.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{int(timeout * 1000)}ms'")
+                try:
+                    await conn.execute(
+                        'SELECT pg_advisory_xact_lock($1, hashtext($2))', EXPORT_LOCK_NAMESPACE, str(user_id)
+                    )
+                except asyncpg.LockNotAvailableError:
+                    raise RuntimeError(f"Експорт користувача {user_id} вже виконується") from None
+                await conn.execute('SET LOCAL lock_timeout TO DEFAULT')
+                yield conn
+
+    async def delete_export_watermark(self, user_id: int):
+        """Видалити позначку експорту (наступний експорт буде повним)"""
+        async with self.pool.acquire() as conn:
+            await conn.execute('DELETE FROM export_watermarks WHERE user_id = $1', user_id)
+
+    async def get_conversation_history(self, user_id: int) -> Optional[list]:
+        """Спільна історія розмови: список (role, content, tokens) або None, якщо її ще немає"""
         async with self.pool.acquire() as conn:
-            stats = await conn.fetchrow(
-                'SELECT * FROM user_stats WHERE user_id = $1', user_id
+            messages = await conn.fetchval(
+                'SELECT messages FROM conversation_history WHERE user_id = $1', user_id
             )
-            if stats:
-                return dict(stats)
+        if messages is None:
             return None
+        return [tuple(entry) for entry in json.loads(messages)]
 
+    async def init_conversation_history(self, user_id: int, messages: list):
+        """Записати відновлену історію, якщо інший процес не зробив цього раніше"""
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO conversation_history (user_id, messages) VALUES ($1, $2::jsonb)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', user_id, json.dumps([list(entry) for entry in messages], ensure_ascii=False))
 
-    async def get_user_messages(self, user_id: int, limit: int = None):
-        """Отримати повідомлення користувача"""
+    async def append_conversation_history(self, user_id: int, entry: tuple, max_messages: int):
+        """Додати повідомлення до історії, залишивши останні max_messages"""
         async with self.pool.acquire() as conn:
-            query = '''
-                SELECT * FROM messages WHERE user_id = $1 AND is_filtered = FALSE
-                ORDER BY timestamp DESC
-            '''
-            if limit:
-                query += f' LIMIT {limit}'
-
-            messages = await conn.fetch(query, user_id)
-            return [dict(msp) for msp in messages]
+            await conn.execute(
+                APPEND_HISTORY_QUERY, user_id, json.dumps([list(entry)], ensure_ascii=False), max_messages
+            )
+
+    async def delete_conversation_history(self, user_id: int):
+        """Видалити спільну історію розмови"""
+        async with self.pool.acquire() as conn:
+            await conn.execute('DELETE FROM conversation_history WHERE user_id = $1', user_id)
+
+    async def get_completed_users(self, min_tokens: int = 0) -> list:
+        """Користувачі із завершеним збором даних (для масового експорту)"""
+        async with self.pool.acquire() as conn:
+            users = await conn.fetch('''
+                SELECT user_id, total_tokens, message_count FROM user_stats
+                WHERE collection_active = FALSE AND total_tokens >= $1
+                ORDER BY user_id
+            ''', min_tokens)
+            return [dict(user) for user in users]
+
+    async def rescore_sentiments(self, batch_size: int = 1000) -> int:
+        """Перерахувати настрій усіх повідомлень користувачів (після зміни словників)"""
+        updated = 0
+        last_id = 0
+        async with self.pool.acquire() as conn:
+            while True:
+                rows = await conn.fetch('''
+                    SELECT id, content, sentiment FROM messages
+                    WHERE role = 'user' AND id > $1
+                    ORDER BY id LIMIT $2
+                ''', last_id, batch_size)
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+
+                sentiments = self.analyze_sentiment_batch([row['content'] for row in rows])
+                changed = [(row['id'], sentiment) for row, sentiment in zip(rows, sentiments)
+                           if row['sentiment'] != sentiment]
+                if changed:
+                    await conn.execute('''
+                        UPDATE messages SET sentiment = d.sentiment
+                        FROM unnest($1::int[], $2::varchar[]) AS d(id, sentiment)
+                        WHERE messages.id = d.id
+                    ''', [c[0] for c in changed], [c[1] for c in changed])
+                    updated += len(changed)
+
+        logger.info(f"Настрій перераховано для {updated} повідомлень")
+        return updated
 
     async def toggle_reminders(self, user_id: int, enabled: bool):
         """Увімкнути/вимкнути нагадування для користувача"""
@@ -234,6 +1135,7 @@ class Database:
                     enabled, user_id
                 )
 
+            self.invalidate_user_stats(user_id)
             logger.info(f"Нагадування для користувача {user_id}: {'увімкнено' if enabled else 'вимкнено'}")
 
 
@@ -245,25 +1147,55 @@ class Database:
                 SET last_reminder_at = CURRENT_TIMESTAMP
                 WHERE user_id = $1
             ''', user_id)
+            self.invalidate_user_stats(user_id)
 
 
-    async def get_users_for_reminders(self):
-        """Отримати список користувачів для нагадувань"""
+    async def claim_reminders(self, worker_id: str, limit: int, lease_seconds: float) -> list:
+        """
+        Захопити пакет користувачів для нагадувань
+
+        Захоплені користувачі не видаються іншим екземплярам до update_last_reminders
+        або поки не мине lease_seconds (наприклад, якщо екземпляр впав)
+        """
         async with self.pool.acquire() as conn:
-            users = await conn.fetch(f'''
-                SELECT user_id FROM user_stats 
-                WHERE reminders_enabled = TRUE 
-                AND collection_active = TRUE
-                AND (
-                last_activity_at IS NULL
-                OR last_activity_at < NOW() - INTERVAL '{config.INACTIVITY_THRESHOLD_MINUTES} minutes'
-              )
-            ''')
-            return [user['user_id'] for user in users]
+            rows = await conn.fetch(
+                CLAIM_REMINDERS_QUERY, worker_id, float(lease_seconds),
+                config.INACTIVITY_THRESHOLD_MINUTES, config.REMINDER_MIN_GAP_MINUTES, limit
+            )
+            return [row['user_id'] for row in rows]
 
+    async def update_last_reminders(self, user_ids: list):
+        """Оновити час останнього нагадування для багатьох користувачів одним запитом (і зняти захоплення)"""
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                UPDATE user_stats
+                SET last_reminder_at = CURRENT_TIMESTAMP, reminder_claimed_by = NULL, reminder_claimed_until = NULL
+                WHERE user_id = ANY($1::bigint[])
+            ''', user_ids)
+        for user_id in user_ids:
+            self.invalidate_user_stats(user_id)
+
+    async def flush_writes(self):
+        """Записати всі відкладені повідомлення"""
+        if self.write_behind:
+            await self.write_behind.close()
+            self.write_behind = None
+
+    def get_metrics(self) -> dict:
+        """Стан пулу з'єднань і помилки збереження"""
+        metrics = {'save_errors': self.save_errors, 'duplicate_messages': self.duplicate_messages}
+        if self.pool:
+            size = self.pool.get_size()
+            metrics.update(
+                pool_size=size,
+                pool_max_size=self.pool.get_max_size(),
+                pool_in_use=size - self.pool.get_idle_size(),
+            )
+        return metrics
 
     async def close(self):
         """Закрити з'єднання з базою даних"""
+        await self.flush_writes()
         if self.pool:
             await self.pool.close()
             logger.info("З'єднання з базою даних закрито")
@@ -0,0 +1,45 @@
+import logging
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator(BaseMiddleware):
+    """
+    Відкидає повторно доставлені оновлення Telegram
+
+    Telegram доставляє оновлення ще раз, якщо webhook відповів повільно або
+    з помилкою. Ключі - update_id та (chat_id, message_id) - зберігаються в
+    обмеженому наборі з max_size останніх ключів. Дублікат відкидається до
+    будь-якої роботи з БД чи OpenAI.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._seen = OrderedDict()  # ключ -> None, від давніх до нових
+        self.metrics = {'updates': 0, 'duplicates': 0}
+
+    def _remember(self, key: tuple):
+        self._seen[key] = None
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    async def __call__(self, handler, event: Update, data: dict):
+        keys = [('update', event.update_id)]
+        if event.message:
+            keys.append(('message', event.message.chat.id, event.message.message_id))
+
+        if any(key in self._seen for key in keys):
+            self.metrics['duplicates'] += 1
+            logger.info(f"Повторне оновлення {event.update_id} відкинуто")
+            return None
+
+        self.metrics['updates'] += 1
+        for key in keys:
+            self._remember(key)
+        return await handler(event, data)
+
+    def get_metrics(self) -> dict:
+        return {**self.metrics, 'tracked': len(self._seen)}
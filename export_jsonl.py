@@ -1,5 +1,11 @@
+import asyncio
+import gzip
+import hashlib
+import io
 import json
 import logging
+import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 from database import db
 import config
@@ -7,6 +13,227 @@ import config
 logger = logging.getLogger(__name__)
 
 
+class ConversationGrouper:
+    """
+    Покрокове групування повідомлень у розмови
+
+    Дає той самий результат, що й групування всього списку одразу, але не
+    потребує знати довжину списку: остання неповна розмова віддається у finish()
+    """
+
+    def __init__(self, max_context_length: int = 10):
+        self.max_context_length = max_context_length
+        self.current = []
+        self.has_new = False  # Чи є у вікні повідомлення крім перекриття з попередньою розмовою
+
+    def add(self, msg):
+        """Додати повідомлення. Повертає розмову, якщо вікно заповнилось"""
+        self.current.append(msg)
+        self.has_new = True
+        if len(self.current) < self.max_context_length:
+            return None
+
+        conversation = self.current if len(self.current) >= 2 else None
+
+        # Зберігаємо перекриття для контексту (останні 2 повідомлення)
+        self.current = self.current[-2:] if len(self.current) >= 4 else []
+        self.has_new = False
+        return conversation
+
+    def snapshot(self) -> dict:
+        """Стан вікна для збереження в позначці експорту"""
+        return {
+            'messages': [{'role': msg['role'], 'content': msg['content']} for msg in self.current],
+            'has_new': self.has_new,
+        }
+
+    @classmethod
+    def restore(cls, state: dict, max_context_length: int = 10) -> 'ConversationGrouper':
+        """Відновити вікно зі збереженого стану"""
+        grouper = cls(max_context_length)
+        grouper.current = list(state.get('messages', []))
+        grouper.has_new = state.get('has_new', False)
+        return grouper
+
+    def finish(self):
+        """Віддати останню неповну розмову (якщо вона має принаймні одну пару)"""
+        conversation = None
+        if self.has_new and len(self.current) >= 2:
+            conversation = self.current
+        self.current = []
+        self.has_new = False
+        return conversation
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Експорти одного користувача в цьому процесі - по черзі (user_id -> [Lock, скільки експортів чекає])
+_export_locks = {}
+
+
+@asynccontextmanager
+async def _user_export_lock(user_id: int):
+    """
+    Блокування експорту користувача: у процесі - asyncio.Lock, між процесами - у БД
+
+    Повертає з'єднання з блокуванням; у процесі експорт чекає, не займаючи з'єднання
+    """
+    entry = _export_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            async with db.export_lock(user_id, config.EXPORT_LOCK_TIMEOUT_SECONDS) as conn:
+                yield conn
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _export_locks[user_id]
+
+
+def _open_compressed(path: str, compression: str = None):
+    """Відкрити (можливо стиснений) JSONL файл для читання рядками"""
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
+
+
+class _HashingFile:
+    """Обгортка файлу, що рахує байти та sha256 того, що реально записано на диск"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ExportWriter:
+    """
+    Запис JSONL з опційним потоковим стисненням і розбиттям на частини
+
+    Кожен рядок - одна розмова, тож межа частини завжди між цілими розмовами
+    і кожна частина - валідний файл для навчання. Розмір частини рахується до
+    стиснення, тому стиснена частина гарантовано не більша за ліміт.
+    """
+
+    def __init__(self, path: str, compression: str = None, max_part_bytes: int = 0, max_part_examples: int = 0):
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f"Невідомий тип стиснення: {compression}")
+        self.stem = path[:-len('.jsonl')] if path.endswith('.jsonl') else path
+        self.compression = compression
+        self.max_part_bytes = max_part_bytes
+        self.max_part_examples = max_part_examples
+        self.parts = []  # Метадані закритих частин
+        self._path = None
+        self._raw = None
+        self._stream = None
+        self._part_bytes = 0
+        self._part_examples = 0
+
+    @property
+    def split(self) -> bool:
+        return bool(self.max_part_bytes or self.max_part_examples)
+
+    def _part_path(self) -> str:
+        suffix = f'.part{len(self.parts) + 1:03d}' if self.split else ''
+        return f'{self.stem}{suffix}.jsonl{COMPRESSION_EXTENSIONS[self.compression]}'
+
+    def _open_part(self):
+        self._path = self._part_path()
+        self._raw = _HashingFile(self._path)
+        if self.compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='wb', mtime=0)
+        elif self.compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("Для стиснення zstd встановіть пакет zstandard")
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._stream = self._raw
+        self._part_bytes = 0
+        self._part_examples = 0
+
+    def _close_part(self):
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+        self.parts.append({
+            'file': self._path,
+            'examples': self._part_examples,
+            'bytes': self._part_bytes,
+            'compressed_bytes': self._raw.bytes,
+            'sha256': self._raw.sha256.hexdigest(),
+        })
+        self._raw = self._stream = None
+
+    def write(self, line: bytes):
+        """Записати одну розмову (рядок JSONL)"""
+        if self._stream is not None and self._part_examples and (
+                (self.max_part_bytes and self._part_bytes + len(line) > self.max_part_bytes)
+                or (self.max_part_examples and self._part_examples >= self.max_part_examples)):
+            self._close_part()
+        if self._stream is None:
+            self._open_part()
+        self._stream.write(line)
+        self._part_bytes += len(line)
+        self._part_examples += 1
+
+    def tell(self) -> int:
+        """Кількість байтів (до стиснення) у поточній частині"""
+        return self._part_bytes
+
+    def close(self) -> list:
+        """Закрити останню частину. Повертає метадані всіх частин"""
+        if self._stream is None and not self.parts:
+            self._open_part()  # Порожній експорт - один порожній файл
+        if self._stream is not None:
+            self._close_part()
+        return self.parts
+
+    def discard(self):
+        """Закрити і видалити всі записані частини (зокрема недописану після помилки)"""
+        paths = self.files
+        if self._raw is not None:
+            paths.append(self._path)
+            try:
+                self._close_part()
+            except Exception as e:
+                self._raw.close()
+                logger.warning(f"Не вдалося закрити частину експорту {self._path}: {e}")
+            self._raw = self._stream = None
+        for path in dict.fromkeys(paths):
+            if os.path.exists(path):
+                os.remove(path)
+        self.parts = []
+
+    @property
+    def files(self) -> list:
+        return [part['file'] for part in self.parts]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # Після помилки часткові файли не залишаємо
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
 class DataExporter:
     """Клас для експорту даних у формат JSONL для Fine-tuning OpenAI"""
 
@@ -53,34 +280,71 @@ class DataExporter:
         Returns:
             Список розмов, кожна розмова - список повідомлень
         """
-        conversations = []
-        current_conversation = []
-
-        for i, msg in enumerate(messages):
-            current_conversation.append(msg)
+        return list(DataExporter.iter_conversations(messages, max_context_length))
 
-            # Якщо досягли максимальної довжини або це останнє повідомлення
-            if len(current_conversation) >= max_context_length or i == len(messages) - 1:
-                # Перевіряємо що розмова має принаймні одну пару user-assistant
-                if len(current_conversation) >= 2:
-                    conversations.append(current_conversation.copy())
+    @staticmethod
+    def iter_conversations(messages, max_context_length: int = 10):
+        """Генератор розмов: віддає кожну розмову одразу, як вона сформована"""
+        grouper = ConversationGrouper(max_context_length)
+        for msg in messages:
+            conversation = grouper.add(msg)
+            if conversation:
+                yield conversation
+        conversation = grouper.finish()
+        if conversation:
+            yield conversation
 
-                # Зберігаємо перекриття для контексту (останні 2 повідомлення)
-                if len(current_conversation) >= 4:
-                    current_conversation = current_conversation[-2:]
-                else:
-                    current_conversation = []
+    @staticmethod
+    async def aiter_conversations(messages, max_context_length: int = 10):
+        """Асинхронний генератор розмов для потокового читання з БД"""
+        grouper = ConversationGrouper(max_context_length)
+        async for msg in messages:
+            conversation = grouper.add(msg)
+            if conversation:
+                yield conversation
+        conversation = grouper.finish()
+        if conversation:
+            yield conversation
 
-        return conversations
+    @staticmethod
+    def _write_conversation(f, conversation: list) -> None:
+        formatted = DataExporter.format_conversation_for_finetuning(conversation)
+        f.write((json.dumps(formatted, ensure_ascii=False) + '\n').encode('utf-8'))
 
     @staticmethod
-    async def export_user_data(user_id: int, output_file: str = None) -> dict:
+    async def export_user_data(user_id: int, output_file: str = None, incremental: bool = None,
+                               compression: str = None, max_part_bytes: int = None,
+                               max_part_examples: int = None) -> dict:
         """
         Експортує дані користувача у формат JSONL
 
+        В інкрементальному режимі файл користувача дописується: обробляються тільки
+        повідомлення після позначки попереднього експорту, а якщо нових немає -
+        повертається попередній файл без змін. Перерваний експорт продовжується
+        з останньої контрольної точки. Позначка не просувається за повідомлення,
+        новіші за EXPORT_SETTLE_SECONDS: наступний експорт перечитає їх разом з
+        тими, що закомічено пізніше з меншим (timestamp, id).
+
+        Зі стисненням або обмеженням розміру частин експорт завжди повний
+        (дописати стиснений файл чи частини на місці не можна). Параметри None
+        беруться з config; compression='' і max_part_*=0 - явно без стиснення
+        і без розбиття. Після помилки записані частини видаляються.
+
         Returns:
             dict з інформацією про експорт
         """
+        if incremental is None:
+            incremental = config.EXPORT_INCREMENTAL
+        if compression is None:
+            compression = config.EXPORT_COMPRESSION
+        compression = compression or None  # '' - явно без стиснення
+        if max_part_bytes is None:
+            max_part_bytes = config.EXPORT_MAX_PART_BYTES
+        if max_part_examples is None:
+            max_part_examples = config.EXPORT_MAX_PART_EXAMPLES
+        if compression or max_part_bytes or max_part_examples:
+            incremental = False
+
         try:
             # Отримуємо статистику
             stats = await db.get_user_stats(user_id)
@@ -97,53 +361,130 @@ class DataExporter:
                     'error': f"Недостатньо токенів. Зібрано: {stats['total_tokens']}, потрібно: {config.MIN_TOKEN_LIMIT}"
                 }
 
-            # Отримуємо всі нефільтровані повідомлення
-            messages = await db.get_user_messages(user_id)
-
-            if not messages:
-                return {
-                    'success': False,
-                    'error': 'Немає повідомлень для експорту'
-                }
-
-            # Сортуємо за часом (від старих до нових)
-            messages.sort(key=lambda x: x['timestamp'])
-
-            # Групуємо в розмови
-            conversations = DataExporter.group_messages_into_conversations(messages)
-
-            # Форматуємо для Fine-tuning
-            jsonl_data = []
-            for conversation in conversations:
-                formatted = DataExporter.format_conversation_for_finetuning(conversation)
-                jsonl_data.append(formatted)
-
-            # Генеруємо ім'я файлу якщо не задано
-            if not output_file:
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                output_file = f'finetuning_data_{user_id}_{timestamp}.jsonl'
-
-            # Зберігаємо в JSONL формат
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for item in jsonl_data:
-                    f.write(json.dumps(item, ensure_ascii=False) + '\n')
-
-            # Статистика експорту
-            total_conversations = len(jsonl_data)
-            total_messages = sum(len(conv['messages']) - 1 for conv in jsonl_data)  # -1 для system prompt
-
-            logger.info(f"Експорт завершено для користувача {user_id}: {output_file}")
-
-            return {
-                'success': True,
-                'file': output_file,
-                'stats': {
-                    'total_tokens': stats['total_tokens'],
-                    'total_messages': total_messages,
-                    'total_conversations': total_conversations,
-                    'user_messages': stats['message_count']
-                }
-            }
+            # Експорт одного користувача одночасно виконується лише один (файл і позначка спільні)
+            async with _user_export_lock(user_id) as conn:
+                # Генеруємо ім'я файлу якщо не задано
+                if not output_file:
+                    if incremental:
+                        output_file = f'finetuning_data_{user_id}.jsonl'
+                    else:
+                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                        output_file = f'finetuning_data_{user_id}_{timestamp}.jsonl'
+
+                watermark = await db.get_export_watermark(user_id, conn=conn) if incremental else None
+                if watermark and (watermark['file'] != output_file or not os.path.exists(output_file)
+                                  or os.path.getsize(output_file) < watermark['committed_bytes']):
+                    # Файл інший або пошкоджений - робимо повний експорт
+                    watermark = None
+
+                after = None
+                if watermark and watermark['last_message_id'] is not None:
+                    after = (watermark['last_timestamp'], watermark['last_message_id'])
+
+                # Нових повідомлень немає і попередній експорт завершено - файл не чіпаємо
+                if (watermark and watermark['final_bytes'] is not None
+                        and os.path.getsize(output_file) == watermark['final_bytes']
+                        and (after is None or not await db.has_messages_after(user_id, after, conn=conn))):
+                    logger.info(f"Експорт для користувача {user_id} актуальний: {output_file}")
+                    return DataExporter._export_result([output_file], stats, watermark, mode='reused')
+
+                if watermark:
+                    grouper = ConversationGrouper.restore(watermark['tail'])
+                    conversations = watermark['conversations']
+                    exported_messages = watermark['messages']
+                    committed_bytes = watermark['committed_bytes']
+                    mode = 'appended'
+                else:
+                    grouper = ConversationGrouper()
+                    conversations = 0
+                    exported_messages = 0
+                    committed_bytes = 0
+                    mode = 'full'
+
+                last_key = after
+                new_messages = 0
+                # Позначка на останньому повідомленні, старішому за EXPORT_SETTLE_SECONDS:
+                # свіжіші пишуться у файл, але наступний експорт перечитає їх заново
+                settled = None
+
+                def make_watermark(tail: dict, final_bytes: int = None, final_messages: int = 0) -> dict:
+                    return {
+                        'file': output_file,
+                        'last_timestamp': last_key[0] if last_key else None,
+                        'last_message_id': last_key[1] if last_key else None,
+                        'committed_bytes': committed_bytes,
+                        'conversations': conversations,
+                        'messages': exported_messages,
+                        'tail': tail,
+                        'final_bytes': final_bytes,
+                        'final_messages': final_messages,
+                    }
+
+                if incremental:
+                    f = open(output_file, 'r+b' if watermark else 'wb')
+                    # Відкидаємо останню неповну розмову та все, що записано після контрольної точки
+                    f.truncate(committed_bytes)
+                    f.seek(committed_bytes)
+                else:
+                    f = ExportWriter(output_file, compression, max_part_bytes, max_part_examples)
+
+                with f:
+                    # Читаємо повідомлення курсором від старих до нових і одразу пишемо кожну розмову,
+                    # тож у пам'яті тримаємо не більше одного контекстного вікна
+                    async for msg in db.iter_user_messages(user_id, after=after, conn=conn,
+                                                           settle_seconds=config.EXPORT_SETTLE_SECONDS):
+                        if incremental and settled is None and not msg['settled']:
+                            settled = make_watermark(grouper.snapshot())
+                        last_key = (msg['timestamp'], msg['id'])
+                        new_messages += 1
+                        conversation = grouper.add(msg)
+                        if not conversation:
+                            continue
+
+                        DataExporter._write_conversation(f, conversation)
+                        committed_bytes = f.tell()
+                        conversations += 1
+                        exported_messages += len(conversation)
+
+                        # Контрольна точка: після збою експорт продовжиться звідси.
+                        # Окремим з'єднанням (транзакція блокування при збої відкотиться),
+                        # а якщо пул зайнятий - пропускаємо, щоб не чекати, тримаючи conn
+                        if (incremental and settled is None
+                                and conversations % config.EXPORT_CHECKPOINT_CONVERSATIONS == 0):
+                            f.flush()
+                            os.fsync(f.fileno())
+                            try:
+                                await db.save_export_watermark(user_id, make_watermark(grouper.snapshot()),
+                                                               timeout=config.EXPORT_CHECKPOINT_ACQUIRE_SECONDS)
+                            except asyncio.TimeoutError:
+                                logger.warning(f"Контрольну точку експорту користувача {user_id} пропущено: пул зайнятий")
+
+                    # Остання неповна розмова пишеться після committed_bytes,
+                    # щоб наступний експорт міг її відкинути і доповнити новими повідомленнями
+                    tail = grouper.snapshot()
+                    final = grouper.finish()
+                    if final:
+                        DataExporter._write_conversation(f, final)
+                    final_bytes = f.tell()
+
+                files = [output_file] if incremental else f.files
+                if mode == 'full' and new_messages == 0:
+                    if incremental:
+                        os.remove(output_file)
+                    else:
+                        f.discard()
+                    return {
+                        'success': False,
+                        'error': 'Немає повідомлень для експорту'
+                    }
+
+                watermark = make_watermark(tail, final_bytes=final_bytes, final_messages=len(final) if final else 0)
+                if incremental:
+                    await db.save_export_watermark(user_id, settled or watermark, conn=conn)
+
+                logger.info(f"Експорт завершено для користувача {user_id} ({mode}, нових повідомлень: {new_messages}): {', '.join(files)}")
+
+                return DataExporter._export_result(files, stats, watermark, mode=mode)
 
         except Exception as e:
             logger.error(f"Помилка експорту для користувача {user_id}: {e}")
@@ -152,6 +493,41 @@ class DataExporter:
                 'error': str(e)
             }
 
+    @staticmethod
+    def _export_result(files: list, stats: dict, watermark: dict, mode: str) -> dict:
+        final_conversations = 1 if watermark['final_messages'] else 0
+        return {
+            'success': True,
+            'file': files[0],
+            'files': files,
+            'mode': mode,
+            'stats': {
+                'total_tokens': stats['total_tokens'],
+                'total_messages': watermark['messages'] + watermark['final_messages'],
+                'total_conversations': watermark['conversations'] + final_conversations,
+                'user_messages': stats['message_count']
+            }
+        }
+
+    @staticmethod
+    def split_file(path: str, max_part_bytes: int, compression: str = None) -> list:
+        """
+        Розбити готовий JSONL файл на частини (наприклад, під ліміт завантаження Telegram)
+
+        Returns:
+            Список файлів частин
+        """
+        stem, source_compression = path, None
+        for name, extension in COMPRESSION_EXTENSIONS.items():
+            if extension and path.endswith(extension):
+                stem, source_compression = path[:-len(extension)], name
+
+        with _open_compressed(path, source_compression) as source, \
+                ExportWriter(stem, compression, max_part_bytes=max_part_bytes) as writer:
+            for line in source:
+                writer.write(line)
+        return writer.files
+
     @staticmethod
     async def validate_data_quality(user_id: int) -> dict:
         """
@@ -169,38 +545,36 @@ class DataExporter:
                     'error': 'Користувача не знайдено в базі даних. Спершу відправ звичайне повідомлення боту (не команду).'
                 }
 
-            messages = await db.get_user_messages(user_id)
+            # Лічильники рахує БД, вміст повідомлень не передається
+            breakdown = await db.get_message_breakdown(user_id)
 
-            if not messages:
+            if not breakdown:
                 return {
                     'valid': False,
                     'error': f'Немає нефільтрованих повідомлень. Всього повідомлень у БД: {stats["message_count"]}, але всі були відфільтровані як "шум". Напиши більш змістовні повідомлення (10+ токенів).'
                 }
 
             # Рахуємо метрики
-            total_messages = len(messages)
-            user_messages = [m for m in messages if m['role'] == 'user']
-            assistant_messages = [m for m in messages if m['role'] == 'assistant']
+            total_messages = sum(row['count'] for row in breakdown)
+            user_messages = sum(row['count'] for row in breakdown if row['role'] == 'user')
+            assistant_messages = sum(row['count'] for row in breakdown if row['role'] == 'assistant')
 
             # Аналіз настроїв
-            sentiments = {}
-            for msg in user_messages:
-                sentiment = msg.get('sentiment', 'neutral')
-                sentiments[sentiment] = sentiments.get(sentiment, 0) + 1
+            sentiments = {row['sentiment']: row['count'] for row in breakdown if row['role'] == 'user'}
 
             # Середня довжина повідомлень
             avg_tokens = stats['total_tokens'] / stats['message_count'] if stats['message_count'] > 0 else 0
 
             # Перевірка достатності даних
             is_sufficient = stats['total_tokens'] >= config.MIN_TOKEN_LIMIT
-            is_balanced = len(user_messages) > 0 and len(assistant_messages) > 0
+            is_balanced = user_messages > 0 and assistant_messages > 0
 
             return {
                 'valid': is_sufficient and is_balanced,
                 'total_tokens': stats['total_tokens'],
                 'total_messages': total_messages,
-                'user_messages': len(user_messages),
-                'assistant_messages': len(assistant_messages),
+                'user_messages': user_messages,
+                'assistant_messages': assistant_messages,
                 'avg_tokens_per_message': round(avg_tokens, 2),
                 'sentiment_distribution': sentiments,
                 'is_sufficient': is_sufficient,
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+import config
+from database import db
+from tokenizer import token_counter
+
+logger = logging.getLogger(__name__)
+
+
+class _Conversation:
+    """Історія одного користувача: кільцевий буфер (role, content, tokens)"""
+
+    __slots__ = ('messages', 'last_access')
+
+    def __init__(self, max_messages: int):
+        self.messages = deque(maxlen=max_messages)
+        self.last_access = time.monotonic()
+
+
+class HistoryStore(ABC):
+    """
+    Сховище історій розмов для контексту OpenAI
+
+    Зберігає останні max_messages повідомлень кожного користувача разом з
+    кількістю токенів, тож контекст обрізається під бюджет токенів без
+    повторного кодування. Системний промпт - один спільний об'єкт для всіх.
+    Де лежать історії, визначають підкласи через _messages() та _append().
+    """
+
+    def __init__(self, system_prompt: str, max_messages: int, token_budget: int, message_overhead: int = 4):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = None  # Рахується при першому зверненні
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.message_overhead = message_overhead
+
+        self.rehydrations = 0
+        self.rehydrate_failures = 0
+        self._rehydrate_seconds = 0.0
+
+        # Оцінка токенів запитів до OpenAI: зібраний контекст і скільки було б без бюджету
+        self.context_requests = 0
+        self.context_tokens = 0
+        self.untrimmed_tokens = 0
+        self.trimmed_messages = 0
+        self.last_context_tokens = 0
+        self.max_context_tokens = 0
+
+    @abstractmethod
+    async def _messages(self, user_id: int) -> list:
+        """Повідомлення користувача (role, content, tokens) від давніх до нових"""
+
+    @abstractmethod
+    async def _append(self, user_id: int, entry: tuple):
+        """Додати повідомлення (role, content, tokens) у кінець історії"""
+
+    async def _rehydrate(self, user_id: int) -> list:
+        """Останні повідомлення з таблиці messages (нефільтровані, як і в експорті)"""
+        started = time.perf_counter()
+        entries = []
+        try:
+            messages = await db.get_user_messages(user_id, limit=self.max_messages)
+            entries = [(msg['role'], msg['content'], msg['tokens_count']) for msg in reversed(messages)]
+        except Exception as e:
+            # Без історії розмова продовжиться, просто без попереднього контексту
+            self.rehydrate_failures += 1
+            logger.error(f"Помилка відновлення історії для користувача {user_id}: {e}")
+        self.rehydrations += 1
+        self._rehydrate_seconds += time.perf_counter() - started
+        return entries
+
+    async def load(self, user_id: int):
+        """Підготувати історію користувача (відновити з БД, якщо її ще немає)"""
+        await self._messages(user_id)
+
+    async def add(self, user_id: int, role: str, content: str, tokens: int = None):
+        """
+        Додати повідомлення до історії
+
+        Якщо tokens не передано, береться з кешу токенізатора - save_message
+        вже порахував цей текст, тож повторного кодування немає
+        """
+        if tokens is None:
+            tokens = await token_counter.count(content)
+        await self._append(user_id, (role, content, tokens))
+
+    async def get(self, user_id: int, token_budget: int = None, pending: str = None) -> list:
+        """
+        Історія у форматі OpenAI: системний промпт + останні повідомлення в межах бюджету
+
+        Повідомлення беруться від найновішого, поки вміщаються в token_budget.
+        Системний промпт та останнє повідомлення включаються завжди.
+        pending - нове повідомлення користувача, яке ще не додано до історії
+        (потрапляє в запит останнім, але в сховище не записується).
+        """
+        if token_budget is None:
+            token_budget = self.token_budget
+        if self.system_tokens is None:
+            self.system_tokens = await token_counter.count(self.system_message['content']) + self.message_overhead
+        messages = await self._messages(user_id)
+        if pending is not None:
+            # Як після add(): разом з новим не більше max_messages
+            kept = messages[max(0, len(messages) - self.max_messages + 1):]
+            messages = kept + [("user", pending, await token_counter.count(pending))]
+
+        selected = []
+        used = untrimmed = 0
+        fits = True
+        for role, content, tokens in reversed(messages):
+            cost = tokens + self.message_overhead
+            untrimmed += cost
+            # Після першого повідомлення, що не вмістилось, старіші теж не беремо (контекст без пропусків)
+            fits = fits and (not selected or used + cost <= token_budget)
+            if fits:
+                selected.append({"role": role, "content": content})
+                used += cost
+        selected.reverse()
+
+        self._record_context(self.system_tokens + used, self.system_tokens + untrimmed,
+                             len(messages) - len(selected))
+        return [self.system_message] + selected
+
+    def _record_context(self, tokens: int, untrimmed: int, trimmed: int):
+        self.context_requests += 1
+        self.context_tokens += tokens
+        self.untrimmed_tokens += untrimmed
+        self.trimmed_messages += trimmed
+        self.last_context_tokens = tokens
+        self.max_context_tokens = max(self.max_context_tokens, tokens)
+
+    @abstractmethod
+    async def clear(self, user_id: int):
+        """Забути історію користувача"""
+
+    def get_metrics(self) -> dict:
+        """Метрики відновлення історій і розміру контексту"""
+        return {
+            'rehydrations': self.rehydrations,
+            'rehydrate_failures': self.rehydrate_failures,
+            'avg_rehydrate_ms': round(self._rehydrate_seconds / self.rehydrations * 1000, 2) if self.rehydrations else 0.0,
+            'context_requests': self.context_requests,
+            'context_tokens': self.context_tokens,
+            'untrimmed_tokens': self.untrimmed_tokens,
+            'saved_tokens': self.untrimmed_tokens - self.context_tokens,
+            'trimmed_messages': self.trimmed_messages,
+            'avg_context_tokens': round(self.context_tokens / self.context_requests, 1) if self.context_requests else 0.0,
+            'last_context_tokens': self.last_context_tokens,
+            'max_context_tokens': self.max_context_tokens,
+        }
+
+
+class MemoryHistoryStore(HistoryStore):
+    """
+    Історії в пам'яті процесу
+
+    Для кожного користувача - deque з фіксованою довжиною, старі повідомлення
+    витісняються без перебудови списку. Користувачі, неактивні довше за
+    idle_ttl_seconds, та найдавніші понад max_users видаляються з пам'яті.
+    Після видалення або перезапуску історія ліниво відновлюється з таблиці messages.
+    """
+
+    def __init__(self, system_prompt: str, max_messages: int, token_budget: int,
+                 max_users: int, idle_ttl_seconds: float):
+        super().__init__(system_prompt, max_messages, token_budget)
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl_seconds
+        self._conversations = OrderedDict()  # user_id -> _Conversation, від давніх до нових звернень
+        self._loading = {}  # user_id -> Future з відновленням історії
+
+        self.hits = 0
+        self.lru_evictions = 0
+        self.idle_evictions = 0
+
+    def _evict(self, keep: int):
+        """Видалити неактивних та зайвих користувачів (найдавніші звернення - на початку)"""
+        now = time.monotonic()
+        while self._conversations:
+            user_id, conversation = next(iter(self._conversations.items()))
+            if user_id == keep:
+                break
+            if now - conversation.last_access > self.idle_ttl:
+                self.idle_evictions += 1
+            elif len(self._conversations) > self.max_users:
+                self.lru_evictions += 1
+            else:
+                break
+            del self._conversations[user_id]
+
+    async def _get(self, user_id: int) -> _Conversation:
+        conversation = self._conversations.get(user_id)
+        if conversation is None:
+            # Одночасні повідомлення одного користувача чекають на одне відновлення
+            if user_id in self._loading:
+                conversation = await asyncio.shield(self._loading[user_id])
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._loading[user_id] = future
+                try:
+                    conversation = _Conversation(self.max_messages)
+                    conversation.messages.extend(await self._rehydrate(user_id))
+                    self._conversations[user_id] = conversation
+                    future.set_result(conversation)
+                finally:
+                    del self._loading[user_id]
+        else:
+            self.hits += 1
+
+        conversation.last_access = time.monotonic()
+        self._conversations.move_to_end(user_id)
+        self._evict(keep=user_id)
+        return conversation
+
+    async def _messages(self, user_id: int) -> list:
+        return list((await self._get(user_id)).messages)
+
+    async def _append(self, user_id: int, entry: tuple):
+        (await self._get(user_id)).messages.append(entry)
+
+    async def clear(self, user_id: int):
+        """Забути історію користувача в пам'яті"""
+        self._conversations.pop(user_id, None)
+
+    def get_metrics(self) -> dict:
+        """Метрики сховища: кількість історій, пам'ять, витіснення і розмір контексту"""
+        messages = 0
+        memory_bytes = 0
+        for conversation in self._conversations.values():
+            messages += len(conversation.messages)
+            memory_bytes += sys.getsizeof(conversation.messages)
+            for role, content, tokens in conversation.messages:
+                memory_bytes += sys.getsizeof(content)
+        return {
+            'backend': 'memory',
+            'users': len(self._conversations),
+            'messages': messages,
+            'memory_bytes': memory_bytes,
+            'hits': self.hits,
+            'lru_evictions': self.lru_evictions,
+            'idle_evictions': self.idle_evictions,
+            **super().get_metrics(),
+        }
+
+
+class PostgresHistoryStore(HistoryStore):
+    """
+    Історії в таблиці conversation_history (один рядок на користувача)
+
+    Спільні для всіх процесів бота, тож будь-який воркер обслуговує будь-якого
+    користувача. Обрізання до max_messages виконує сам запит додавання.
+    Якщо рядка ще немає, історія відновлюється з таблиці messages.
+    """
+
+    async def _messages(self, user_id: int) -> list:
+        messages = await db.get_conversation_history(user_id)
+        if messages is None:
+            messages = await self._rehydrate(user_id)
+            await db.init_conversation_history(user_id, messages)
+        return messages
+
+    async def _append(self, user_id: int, entry: tuple):
+        await db.append_conversation_history(user_id, entry, self.max_messages)
+
+    async def clear(self, user_id: int):
+        """Забути історію користувача (наступне звернення відновить її з messages)"""
+        await db.delete_conversation_history(user_id)
+
+    def get_metrics(self) -> dict:
+        return {'backend': 'postgres', **super().get_metrics()}
+
+
+def create_history_store(backend: str = None) -> HistoryStore:
+    """Сховище історій за налаштуванням HISTORY_BACKEND ('memory' або 'postgres')"""
+    backend = backend or config.HISTORY_BACKEND
+    if backend == 'postgres':
+        return PostgresHistoryStore(
+            config.SYSTEM_PROMPT,
+            max_messages=config.HISTORY_MAX_MESSAGES,
+            token_budget=config.HISTORY_TOKEN_BUDGET,
+        )
+    if backend != 'memory':
+        raise ValueError(f"Невідоме сховище історій: {backend}")
+    return MemoryHistoryStore(
+        config.SYSTEM_PROMPT,
+        max_messages=config.HISTORY_MAX_MESSAGES,
+        token_budget=config.HISTORY_TOKEN_BUDGET,
+        max_users=config.HISTORY_MAX_USERS,
+        idle_ttl_seconds=config.HISTORY_IDLE_TTL_SECONDS,
+    )
+
+
+# Глобальний екземпляр
+history_store = create_history_store()
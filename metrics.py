@@ -0,0 +1,149 @@
+import time
+from bisect import bisect_left
+
+# Межі кошиків гістограм часу (секунди): від запитів до БД до відповідей OpenAI
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Розмір файлів експорту (байти)
+SIZE_BUCKETS = (1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 5e8)
+# Кількість токенів у запиті/відповіді
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    """Лічильник, що тільки зростає"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}  # значення міток -> сума
+        registry.register(self)
+
+    def inc(self, amount: float = 1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self, const_labels: dict) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels, const_labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """
+    Гістограма з фіксованими кошиками
+
+    observe() - один bisect і кілька додавань, без блокувань (усе в одному
+    event loop), тож її можна лишати увімкненою на гарячих шляхах
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # значення міток -> [лічильники кошиків..., сума, кількість]
+        registry.register(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, *labels):
+        """Контекстний менеджер: записати тривалість блоку"""
+        return _Timer(self, labels)
+
+    def collect(self, const_labels: dict) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, labels + (bound,), const_labels)} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(names, labels + ("+Inf",), const_labels)} {series[-1]}')
+            label_text = _format_labels(self.labelnames, labels, const_labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(float(series[-2]))}')
+            lines.append(f'{self.name}_count{label_text} {series[-1]}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    """
+    Усі метрики процесу у текстовому форматі Prometheus
+
+    Крім лічильників і гістограм, тут збираються готові словники метрик
+    компонентів (get_metrics()): ключі з counters стають counter, інші числові
+    значення - gauge, рядкові - gauge зі значенням 1 і міткою value
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._sources = []  # (префікс, функція, що повертає dict, опис, ключі-лічильники)
+        self.const_labels = {}  # Мітки для всіх рядків (наприклад, номер воркера)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_source(self, prefix: str, get_metrics, documentation: str, counters: tuple = ()):
+        """Додати словник метрик компонента; counters - ключі, значення яких тільки зростають"""
+        self._sources.append((prefix, get_metrics, documentation, frozenset(counters)))
+
+    def _collect_source(self, prefix: str, values: dict, documentation: str, counters: frozenset) -> list:
+        lines = []
+        for key, value in values.items():
+            name = f'{prefix}_{key}'
+            if isinstance(value, (int, float)):
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {"counter" if key in counters else "gauge"}')
+                lines.append(f'{name}{_format_labels((), (), self.const_labels)} {_format_value(value)}')
+            elif isinstance(value, str):
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name}{_format_labels(("value",), (value,), self.const_labels)} 1')
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect(self.const_labels))
+        for prefix, get_metrics, documentation, counters in self._sources:
+            lines.extend(self._collect_source(prefix, get_metrics(), documentation, counters))
+        return '\n'.join(lines) + '\n'
+
+
+# Глобальний реєстр
+registry = Registry()
@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """OpenAI недоступний: запити тимчасово не виконуються"""
+
+
+class DeadlineExceededError(Exception):
+    """Запит не встиг виконатись (разом з повторами) до дедлайну"""
+
+
+class AdaptiveLimiter:
+    """
+    Адаптивний ліміт одночасних запитів (AIMD)
+
+    Кожна успішна відповідь збільшує ліміт на 1/limit (приблизно +1 за
+    "раунд" запитів), кожна відповідь 429 зменшує його вдвічі. Зменшення
+    рахується лише для запитів, розпочатих після попереднього зменшення,
+    щоб пачка одночасних 429 не обвалила ліміт до мінімуму.
+    """
+
+    def __init__(self, initial: float, minimum: float, maximum: float):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._waiters = deque()  # Future тих, хто чекає на місце, у порядку черги
+        self._decreased_at = 0.0
+        self.metrics = {'increases': 0, 'decreases': 0, 'max_in_flight': 0, 'waited': 0}
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> float:
+        """Зайняти місце; повертає момент початку запиту"""
+        if self._waiters or self.in_flight >= int(self.limit):
+            self.metrics['waited'] += 1
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Місце вже видали, але його ніхто не займе - віддаємо наступному
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+        else:
+            self.in_flight += 1
+        self.metrics['max_in_flight'] = max(self.metrics['max_in_flight'], self.in_flight)
+        return time.monotonic()
+
+    def release(self, started: float, overloaded: bool = False, succeeded: bool = False):
+        """Звільнити місце і скоригувати ліміт за результатом запиту"""
+        self.in_flight -= 1
+        if overloaded and started >= self._decreased_at:
+            self.limit = max(self.minimum, self.limit / 2)
+            self._decreased_at = time.monotonic()
+            self.metrics['decreases'] += 1
+        elif succeeded and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.metrics['increases'] += 1
+        self._wake()
+
+
+class CircuitBreaker:
+    """
+    Запобіжник: після failure_threshold збоїв поспіль запити не виконуються
+    reset_seconds, потім один пробний запит вирішує, чи закрити його знову
+
+    check() повертає ознаку пробного запиту; її передають у record_success(),
+    record_failure() та abandon(), щоб пробу звільнив лише той, хто її тримає
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self.metrics = {'opened': 0, 'rejected': 0}
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return 'open'
+        return 'half_open'
+
+    def available(self) -> bool:
+        """Чи варто зараз починати запит"""
+        state = self.state
+        return state == 'closed' or (state == 'half_open' and not self._probing)
+
+    def check(self) -> bool:
+        """Дозволити запит; True - це пробний запит після паузи"""
+        state = self.state
+        if state == 'open' or (state == 'half_open' and self._probing):
+            self.metrics['rejected'] += 1
+            raise CircuitOpenError("OpenAI тимчасово недоступний")
+        if state == 'half_open':
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self, probe: bool = False):
+        self.failures = 0
+        self.opened_at = None
+        self.abandon(probe)
+
+    def abandon(self, probe: bool = False):
+        """Запит завершився без висновку про доступність API - стан не змінюється, проба звільняється"""
+        if probe:
+            self._probing = False
+
+    def record_failure(self, probe: bool = False):
+        self.failures += 1
+        if probe or self.failures >= self.failure_threshold:
+            if self.opened_at is None or probe:
+                self.metrics['opened'] += 1
+                logger.warning(f"Запобіжник OpenAI розімкнено після {self.failures} збоїв поспіль")
+            self.opened_at = time.monotonic()
+        self.abandon(probe)
+
+
+def retry_after_seconds(error) -> float:
+    """Затримка з заголовків Retry-After / retry-after-ms відповіді OpenAI (None якщо немає)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass  # Retry-After у форматі дати - використовуємо власну затримку
+    return None
+
+
+def classify_error(error) -> str:
+    """
+    Тип збою запиту до OpenAI:
+    'overloaded' - 429, повторити і зменшити ліміт;
+    'transient' - 5xx, таймаут, з'єднання: повторити, рахується запобіжником;
+    'fatal' - помилка запиту (4xx), повтор не допоможе
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return 'transient'
+    # openai імпортується ліниво (повільний імпорт), на момент помилки він уже завантажений
+    import openai
+    if isinstance(error, openai.RateLimitError):
+        return 'overloaded'
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return 'transient'
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return 'transient'
+    return 'fatal'
+
+
+class OpenAIGateway:
+    """
+    Усі запити до OpenAI: адаптивний ліміт одночасних запитів, повтори з
+    випадковою затримкою (або скільки просить Retry-After), дедлайн на запит
+    разом з повторами і запобіжник на випадок недоступності API
+
+    Дедлайн обмежує чергу, повтори і очікування першої відповіді: стрім,
+    що вже показує текст (retryable() повертає False), не обривається
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, breaker: CircuitBreaker, max_retries: int,
+                 deadline_seconds: float, base_delay: float, max_delay: float):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.max_retries = max_retries
+        self.deadline_seconds = deadline_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = {
+            'requests': 0, 'succeeded': 0, 'failed': 0, 'retries': 0,
+            'rate_limited': 0, 'transient_errors': 0, 'deadline_exceeded': 0,
+        }
+
+    def available(self) -> bool:
+        """False, якщо запобіжник розімкнено - запит зараз відхилили б"""
+        return self.breaker.available()
+
+    def _backoff(self, attempt: int, error) -> float:
+        delay = retry_after_seconds(error)
+        if delay is None:
+            # Повний джитер: одночасні запити не повторюються синхронно
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return delay
+
+    async def _request(self, request, deadline: float, retryable):
+        """Одна спроба: після дедлайну скасовується, якщо користувач ще нічого не побачив"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(request())
+        try:
+            done, _ = await asyncio.wait({task}, timeout=max(0.0, deadline - loop.time()))
+            if done:
+                return task.result()
+            if retryable is not None and not retryable():
+                # Відповідь вже показується - дочитуємо її без дедлайну
+                return await task
+            raise asyncio.TimeoutError
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+
+    async def call(self, request, retryable=None):
+        """
+        Виконати запит з повторами
+
+        Args:
+            request: async request() - сам запит (викликається на кожну спробу)
+            retryable: retryable() -> bool - чи можна ще повторити
+                (наприклад, стрім, що вже показав текст, повторювати не можна;
+                на такий запит дедлайн уже не діє)
+        """
+        self.metrics['requests'] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline_seconds
+        attempt = 0
+        while True:
+            try:
+                probe = self.breaker.check()
+                started = await asyncio.wait_for(self.limiter.acquire(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                self.breaker.abandon(probe)
+                self.metrics['failed'] += 1
+                self.metrics['deadline_exceeded'] += 1
+                raise DeadlineExceededError(f"Немає вільного місця для запиту до OpenAI за {self.deadline_seconds} с")
+            except CircuitOpenError:
+                self.metrics['failed'] += 1
+                raise
+            except BaseException:
+                self.breaker.abandon(probe)
+                raise
+
+            try:
+                result = await self._request(request, deadline, retryable)
+            except Exception as e:
+                kind = classify_error(e)
+                self.limiter.release(started, overloaded=kind == 'overloaded')
+                if kind == 'overloaded':
+                    # 429 - це навантаження, а не недоступність: запобіжник його не рахує
+                    self.metrics['rate_limited'] += 1
+                    self.breaker.abandon(probe)
+                elif kind == 'transient':
+                    self.metrics['transient_errors'] += 1
+                    self.breaker.record_failure(probe)
+                else:
+                    # Помилка самого запиту нічого не каже про доступність API
+                    self.breaker.abandon(probe)
+                    self.metrics['failed'] += 1
+                    raise
+
+                if attempt >= self.max_retries or (retryable is not None and not retryable()):
+                    self.metrics['failed'] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                if loop.time() + delay >= deadline:
+                    self.metrics['failed'] += 1
+                    self.metrics['deadline_exceeded'] += 1
+                    raise DeadlineExceededError(f"Запит до OpenAI не виконано за {self.deadline_seconds} с") from e
+
+                self.metrics['retries'] += 1
+                attempt += 1
+                logger.warning(f"Повтор запиту до OpenAI через {delay:.1f} с (спроба {attempt}): {e}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Запит скасовано (наприклад, відповідь вже не потрібна) - місце звільняємо
+                self.limiter.release(started)
+                self.breaker.abandon(probe)
+                raise
+
+            self.limiter.release(started, succeeded=True)
+            self.breaker.record_success(probe)
+            self.metrics['succeeded'] += 1
+            return result
+
+    def get_metrics(self) -> dict:
+        """Лічильники запитів, поточний ліміт і стан запобіжника"""
+        return {
+            **self.metrics,
+            'concurrency_limit': round(self.limiter.limit, 2),
+            'in_flight': self.limiter.in_flight,
+            **{f'limiter_{name}': value for name, value in self.limiter.metrics.items()},
+            'circuit_state': self.breaker.state,
+            **{f'circuit_{name}': value for name, value in self.breaker.metrics.items()},
+        }
+
+
+def create_gateway() -> OpenAIGateway:
+    """Шлюз з налаштуваннями з config"""
+    return OpenAIGateway(
+        AdaptiveLimiter(config.OPENAI_CONCURRENCY_INITIAL, config.OPENAI_CONCURRENCY_MIN,
+                        config.OPENAI_CONCURRENCY_MAX),
+        CircuitBreaker(config.OPENAI_BREAKER_FAILURES, config.OPENAI_BREAKER_RESET_SECONDS),
+        max_retries=config.OPENAI_MAX_RETRIES,
+        deadline_seconds=config.OPENAI_DEADLINE_SECONDS,
+        base_delay=config.OPENAI_RETRY_BASE_DELAY,
+        max_delay=config.OPENAI_RETRY_MAX_DELAY,
+    )
+
+
+# Глобальний екземпляр
+openai_gateway = create_gateway()
@@ -0,0 +1,184 @@
+import re
+from bisect import bisect_right
+from typing import NamedTuple
+import config
+
+# Роздільник текстів при пакетній обробці (не зустрічається у словниках)
+BATCH_SEPARATOR = '\x00'
+
+# З якої кількості слів вигідніше один regex, ніж окремі пошуки підрядків.
+# Для невеликих словників `in` у CPython швидший за regex (див. benchmarks/text_matching.py)
+REGEX_MIN_WORDS = 160
+
+
+class TextFlags(NamedTuple):
+    """Результат одного проходу по тексту"""
+    positive: int
+    negative: int
+    is_command: bool
+    is_technical: bool
+
+    @property
+    def sentiment(self) -> str:
+        if self.positive > self.negative:
+            return 'positive'
+        elif self.negative > self.positive:
+            return 'negative'
+        return 'neutral'
+
+
+def build_trie_pattern(words) -> str:
+    """
+    Будує regex у вигляді префіксного дерева: спільні префікси слів
+    перевіряються один раз, тож regex не перебирає всі слова на кожній позиції
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Слово закінчується тут, але є й довші слова з тим самим префіксом
+        if '' in node:
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return build(trie)
+
+
+def _can_overlap(a: str, b: str) -> bool:
+    """Чи можуть входження двох слів у тексті перекриватися"""
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:k]) or b.endswith(a[:k]) for k in range(1, min(len(a), len(b))))
+
+
+class TextMatcher:
+    """
+    Аналіз настрою і фільтрація шуму за один виклик
+
+    Словники збираються один раз при створенні. Для малих словників
+    використовуються попередньо зібрані кортежі і пошук підрядків на рівні C,
+    для великих - один regex у вигляді префіксного дерева. Regex знаходить
+    входження без перекриттів, тому слова, які могли сховатися під
+    сусіднім збігом, додатково перевіряються через `in` — результат
+    збігається з покроковою перевіркою кожного слова.
+    """
+
+    def __init__(self, positive_words, negative_words, technical_patterns, excluded_commands,
+                 engine: str = None):
+        # Слова настрою шукаємо в тексті в нижньому регістрі, технічні шаблони - з урахуванням регістру
+        self._kinds = {}
+        for word in positive_words:
+            self._kinds.setdefault(word, set()).add('positive')
+        for word in negative_words:
+            self._kinds.setdefault(word, set()).add('negative')
+        self._technical = {}
+        for pattern in technical_patterns:
+            self._technical.setdefault(pattern.lower(), []).append(pattern)
+            self._kinds.setdefault(pattern.lower(), set()).add('technical')
+
+        self._commands = tuple(excluded_commands)
+        self._positive = tuple(positive_words)
+        self._negative = tuple(negative_words)
+        self._technical_patterns = tuple(technical_patterns)
+
+        self.engine = engine or ('regex' if len(self._kinds) >= REGEX_MIN_WORDS else 'substring')
+        self._regex = re.compile(build_trie_pattern(self._kinds))
+
+        # Для кожного слова: (+позитив, +негатив, шаблони з регістром, слова що можуть перекриватися)
+        self._words = {
+            word: (
+                int('positive' in kinds),
+                int('negative' in kinds),
+                tuple(self._technical.get(word, ())),
+                tuple(other for other in self._kinds if other != word and _can_overlap(word, other)),
+            )
+            for word, kinds in self._kinds.items()
+        }
+
+    def _flags(self, text: str, text_lower: str, matches: list) -> TextFlags:
+        is_command = text.startswith(self._commands)
+        if not matches:
+            return TextFlags(0, 0, is_command, False)
+
+        # Слова, які могли сховатися під сусіднім збігом
+        found = set(matches)
+        for word in matches:
+            for other in self._words[word][3]:
+                if other not in found and other in text_lower:
+                    found.add(other)
+
+        positive = negative = 0
+        is_technical = False
+        for word in found:
+            pos, neg, patterns, _ = self._words[word]
+            positive += pos
+            negative += neg
+            if patterns and not is_technical:
+                is_technical = any(pattern in text for pattern in patterns)
+
+        return TextFlags(positive, negative, is_command, is_technical)
+
+    def _scan_substrings(self, text: str) -> TextFlags:
+        contains = text.lower().__contains__
+        return TextFlags(
+            sum(map(contains, self._positive)),
+            sum(map(contains, self._negative)),
+            text.startswith(self._commands),
+            any(map(text.__contains__, self._technical_patterns)),
+        )
+
+    def scan(self, text: str) -> TextFlags:
+        """Класифікувати один текст"""
+        if self.engine == 'substring':
+            return self._scan_substrings(text)
+        text_lower = text.lower()
+        return self._flags(text, text_lower, self._regex.findall(text_lower))
+
+    def scan_many(self, texts: list) -> list:
+        """Класифікувати багато текстів (regex - одним проходом по склеєному тексту)"""
+        if self.engine == 'substring':
+            scan = self._scan_substrings
+            return [scan(text) for text in texts]
+
+        lowered = [text.lower() for text in texts]
+        if any(BATCH_SEPARATOR in text for text in lowered):
+            return [self.scan(text) for text in texts]
+
+        starts = []
+        offset = 0
+        for text in lowered:
+            starts.append(offset)
+            offset += len(text) + 1
+
+        found = [[] for _ in texts]
+        for match in self._regex.finditer(BATCH_SEPARATOR.join(lowered)):
+            found[bisect_right(starts, match.start()) - 1].append(match.group())
+
+        return [self._flags(text, text_lower, words) for text, text_lower, words in zip(texts, lowered, found)]
+
+    def sentiment(self, text: str) -> str:
+        """Настрій тексту: positive / negative / neutral"""
+        return self.scan(text).sentiment
+
+    def should_filter(self, text: str, tokens_count: int, flags: TextFlags = None) -> bool:
+        """Чи є текст "шумом": команда, надто короткий або технічний"""
+        if flags is None:
+            flags = self.scan(text)
+        return flags.is_command or tokens_count < config.MIN_MESSAGE_TOKENS or flags.is_technical
+
+
+# Глобальний екземпляр, зібраний зі словників конфігурації
+text_matcher = TextMatcher(
+    config.POSITIVE_WORDS,
+    config.NEGATIVE_WORDS,
+    config.TECHNICAL_PATTERNS,
+    config.EXCLUDED_COMMANDS,
+)
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """
+    Підрахунок токенів поза event loop з LRU-кешем
+
+    Довгі тексти кодуються в пулі потоків (tiktoken відпускає GIL),
+    результати кешуються за хешем вмісту, тож повтори не кодуються вдруге.
+    Сам токенізатор завантажується при першому використанні або у фоні через warm().
+    """
+
+    def __init__(self, model: str, threads: int, cache_size: int, inline_chars: int):
+        self.model = model
+        self._encoding = None
+        self._encoding_lock = threading.Lock()
+        self._warm_future = None
+        self.load_seconds = None
+        self.cache_size = cache_size
+        self.inline_chars = inline_chars
+        self._cache = OrderedDict()  # хеш тексту -> кількість токенів
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='tokenizer')
+
+        self.hits = 0
+        self.misses = 0
+        self.encoded_texts = 0
+        self.encode_seconds = 0.0
+        self.max_encode_ms = 0.0
+
+    @property
+    def encoding(self):
+        """Токенізатор (завантажується при першому зверненні)"""
+        if self._encoding is None:
+            with self._encoding_lock:
+                if self._encoding is None:
+                    started = time.perf_counter()
+                    import tiktoken
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                    self.load_seconds = time.perf_counter() - started
+                    logger.info(f"✅ Токенізатор завантажено за {self.load_seconds * 1000:.0f} мс")
+        return self._encoding
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._encoding is not None
+
+    def load(self):
+        """Завантажити токенізатор одразу (звичайний режим запуску)"""
+        return self.encoding
+
+    def warm(self):
+        """Завантажити токенізатор у фоновому потоці"""
+        if self._warm_future is None and not self.is_loaded:
+            self._warm_future = self._executor.submit(lambda: self.encoding)
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def _lookup(self, key: bytes):
+        count = self._cache.get(key)
+        if count is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def _store(self, key: bytes, count: int):
+        self._cache[key] = count
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _encode(self, text: str) -> int:
+        """Синхронне кодування одного тексту"""
+        try:
+            return len(self.encoding.encode(text))
+        except Exception as e:
+            logger.error(f"Помилка підрахунку токенів: {e}")
+            return 0
+
+    def _encode_many(self, texts: list) -> list:
+        """Синхронне кодування пакета текстів"""
+        try:
+            return [len(tokens) for tokens in self.encoding.encode_batch(texts)]
+        except Exception:
+            # Один проблемний текст не повинен зламати весь пакет
+            return [self._encode(text) for text in texts]
+
+    def _record_encode(self, started: float, texts: int):
+        elapsed = time.perf_counter() - started
+        self.encoded_texts += texts
+        self.encode_seconds += elapsed
+        self.max_encode_ms = max(self.max_encode_ms, elapsed * 1000)
+
+    async def count(self, text: str) -> int:
+        """Кількість токенів у тексті"""
+        key = self._key(text)
+        count = self._lookup(key)
+        if count is not None:
+            return count
+
+        started = time.perf_counter()
+        # Поки токенізатор не завантажено, навіть короткі тексти йдуть у потік
+        if self.is_loaded and len(text) <= self.inline_chars:
+            count = self._encode(text)
+        else:
+            loop = asyncio.get_running_loop()
+            count = await loop.run_in_executor(self._executor, self._encode, text)
+        self._record_encode(started, 1)
+
+        self._store(key, count)
+        return count
+
+    async def count_many(self, texts: list) -> list:
+        """Кількість токенів для багатьох текстів за один прохід (для бекфілів)"""
+        keys = [self._key(text) for text in texts]
+        counts = [self._lookup(key) for key in keys]
+
+        # Кодуємо тільки унікальні тексти, яких немає в кеші
+        missing = {}
+        for key, text, count in zip(keys, texts, counts):
+            if count is None and key not in missing:
+                missing[key] = text
+
+        if missing:
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(self._executor, self._encode_many, list(missing.values()))
+            self._record_encode(started, len(missing))
+            for key, count in zip(missing, encoded):
+                self._store(key, count)
+            resolved = dict(zip(missing, encoded))
+            counts = [resolved[key] if count is None else count for key, count in zip(keys, counts)]
+
+        return counts
+
+    def get_metrics(self) -> dict:
+        """Метрики кешу та часу кодування"""
+        lookups = self.hits + self.misses
+        return {
+            'cache_size': len(self._cache),
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'encoded_texts': self.encoded_texts,
+            'encode_seconds': round(self.encode_seconds, 4),
+            'avg_encode_ms': round(self.encode_seconds * 1000 / self.encoded_texts, 3) if self.encoded_texts else 0.0,
+            'max_encode_ms': round(self.max_encode_ms, 3),
+            'load_ms': round(self.load_seconds * 1000, 1) if self.load_seconds is not None else None,
+        }
+
+    def close(self):
+        """Зупинити пул потоків"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Глобальний лічильник токенів
+token_counter = TokenCounter(
+    config.OPENAI_MODEL,
+    threads=config.TOKENIZER_THREADS,
+    cache_size=config.TOKEN_CACHE_SIZE,
+    inline_chars=config.TOKENIZER_INLINE_CHARS,
+)
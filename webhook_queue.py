@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot, Dispatcher
+from aiogram.methods import SendMessage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook з миттєвим підтвердженням і обмеженою чергою оновлень
+
+    Кожне оновлення одразу отримує відповідь 200 і потрапляє в чергу, яку
+    розбирають workers задач. Якщо черга заповнена, оновлення відкидається,
+    а користувачу у відповіді на webhook надсилається busy_text - без окремого
+    запиту до Telegram API. Коли overloaded() повертає True, відкидаються лише
+    звичайні текстові повідомлення (їм потрібен OpenAI), а команди та інші
+    оновлення обробляються як завжди.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, max_size: int,
+                 busy_text: str, overloaded=None, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.workers = workers
+        self.busy_text = busy_text
+        self.overloaded = overloaded
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self._worker_tasks = []
+
+        self.metrics = {
+            'received': 0, 'processed': 0, 'failed': 0,
+            'dropped_queue_full': 0, 'dropped_overloaded': 0, 'busy_replies': 0,
+            'max_depth': 0,
+        }
+        self._waited = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def register(self, app: web.Application, /, path: str, **kwargs):
+        super().register(app, path=path, **kwargs)
+        app.on_startup.append(self._start)
+
+    async def _start(self, app: web.Application):
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            enqueued_at, update = await self.queue.get()
+            wait = time.monotonic() - enqueued_at
+            self._waited += 1
+            self._wait_seconds += wait
+            self._max_wait_seconds = max(self._max_wait_seconds, wait)
+            try:
+                await self._background_feed_update(self.bot, update)
+                self.metrics['processed'] += 1
+            except Exception as e:
+                self.metrics['failed'] += 1
+                logger.error(f"Помилка обробки оновлення {update.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _sheddable(update: dict) -> bool:
+        """Чи можна відкинути оновлення при перевантаженні: тільки текст, що не є командою"""
+        text = (update.get('message') or {}).get('text')
+        return bool(text) and not text.startswith('/')
+
+    def _busy_response(self, update: dict) -> web.Response:
+        """Відповідь на webhook: коротке повідомлення про завантаженість (якщо є кому)"""
+        chat = (update.get('message') or {}).get('chat')
+        if not chat:
+            return web.json_response({})
+        self.metrics['busy_replies'] += 1
+        method = SendMessage(chat_id=chat['id'], text=self.busy_text)
+        return web.Response(body=self._build_response_writer(bot=self.bot, result=method))
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        self.metrics['received'] += 1
+
+        if self.overloaded is not None and self._sheddable(update) and self.overloaded():
+            self.metrics['dropped_overloaded'] += 1
+            return self._busy_response(update)
+        try:
+            self.queue.put_nowait((time.monotonic(), update))
+        except asyncio.QueueFull:
+            self.metrics['dropped_queue_full'] += 1
+            return self._busy_response(update)
+
+        self.metrics['max_depth'] = max(self.metrics['max_depth'], self.queue.qsize())
+        return web.json_response({})
+
+    async def drain(self, timeout: float = 30):
+        """Дообробити оновлення з черги і зупинити воркери (перед зупинкою бота)"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дочекались обробки {self.queue.qsize()} оновлень з черги")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def get_metrics(self) -> dict:
+        """Глибина черги, час очікування в ній та відкинуті оновлення"""
+        return {
+            **self.metrics,
+            'depth': self.queue.qsize(),
+            'workers': len(self._worker_tasks),
+            'avg_wait_ms': round(self._wait_seconds / self._waited * 1000, 2) if self._waited else 0.0,
+            'max_wait_ms': round(self._max_wait_seconds * 1000, 2),
+        }